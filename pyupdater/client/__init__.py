@@ -16,15 +16,19 @@
 from __future__ import unicode_literals
 
 from pyupdater import settings, __version__
-from pyupdater.client.downloader import FileDownloader
+from pyupdater.client.downloader import FileDownloader, get_http_pool
+from pyupdater.client.hash_cache import HashCache
+from pyupdater.client.mirrors import MirrorScoreboard
 from pyupdater.client.updates import AppUpdate, LibUpdate
 from pyupdater.utils import (convert_to_list,
                              EasyAccessDict,
+                             get_hash,
                              get_highest_version,
                              gzip_decompress,
                              lazy_import,
                              Version)
 from pyupdater.utils.config import TransistionDict
+from pyupdater.utils.manifest import apply_delta
 
 
 @lazy_import
@@ -39,6 +43,12 @@ def json():
     return json
 
 
+@lazy_import
+def marshal():
+    import marshal
+    return marshal
+
+
 @lazy_import
 def logging():
     import logging
@@ -79,6 +89,12 @@ def six():
     return six
 
 
+@lazy_import
+def sys():
+    import sys
+    return sys
+
+
 log = logging.getLogger(__name__)
 
 log_path = os.path.join(jms_utils.paths.app_cwd, 'pyu.log')
@@ -114,6 +130,14 @@ class Client(object):
         self.json_data = None
         self.verified = False
         self.ready = False
+        # Set when the server says the version file hasn't changed
+        self._manifest_not_modified = False
+        # Validators of the last downloaded version file
+        self._manifest_validators = None
+        # Verified index of version file shards & the names of the
+        # shards loaded from it
+        self._shard_index = None
+        self._shard_names = set()
         self.progress_hooks = []
         if call_back is not None:
             self.progress_hooks.append(call_back)
@@ -178,11 +202,35 @@ class Client(object):
         # Ensuring only one occurrence of a public key is present
         # Would be a waste to test a bad key twice
         self.public_keys = list(set(self.public_keys))
+        # Built once on the first signature check
+        self._verifying_keys = None
         # Config option to disable tls cert verification
         self.verify = config.get('VERIFY_SERVER_CERT', True)
+        # Config option to download large updates in concurrent
+        # segments spread across all update urls
+        self.max_download_segments = config.get('MAX_DOWNLOAD_SEGMENTS', 1)
+        # Config option to limit how many patches are downloaded
+        # at the same time
+        self.max_concurrent_downloads = config.get('MAX_CONCURRENT_DOWNLOADS',
+                                                   4)
+        # Config option to patch on disk instead of in memory
+        self.low_memory_patching = config.get('LOW_MEMORY_PATCHING', False)
         self.version_file = settings.VERSION_FILE
+        self.version_file_validators = settings.VERSION_FILE_VALIDATORS
+        self.version_file_cache = settings.VERSION_FILE_CACHE
+        # Config option to only download the parts of the version
+        # file for the apps this client checks
+        self.shard_version_file = config.get('SHARD_VERSION_FILE', False)
 
         self._setup()
+        # Keeps track of the fastest & most reliable update urls
+        self.mirrors = MirrorScoreboard(self.data_dir)
+        # Saves re-reading update archives that haven't changed
+        self.hash_cache = HashCache(self.data_dir)
+        # Shared by all downloads so connections are reused
+        self.http_pool = get_http_pool(self.verify,
+                                       max(self.max_download_segments,
+                                           self.max_concurrent_downloads, 1))
         if refresh is True:
             self.refresh()
 
@@ -237,6 +285,10 @@ class Client(object):
             log.error('Failed version file verification')
             return None
         log.info('Checking for {} updates...'.format(name))
+        # Shards are only downloaded once they're needed
+        if self._shard_index is not None and \
+                name not in self._shard_names:
+            self._load_shard(name)
 
         # If None is returned get_highest_version could
         # not find the supplied name in the version file
@@ -265,6 +317,12 @@ class Client(object):
             'platform': self.platform,
             'app_name': self.app_name,
             'verify': self.verify,
+            'max_download_segments': self.max_download_segments,
+            'max_concurrent_downloads': self.max_concurrent_downloads,
+            'low_memory_patching': self.low_memory_patching,
+            'mirrors': self.mirrors,
+            'http_pool': self.http_pool,
+            'hash_cache': self.hash_cache,
             'progress_hooks': self.progress_hooks,
             }
         # Return update object with which handles downloading,
@@ -310,12 +368,24 @@ class Client(object):
                 return decompressed_data
 
     # Downloading the manifest. If successful also writes it to file-system
-    def _download_manifest(self):
+    def _download_manifest(self, validators=None):
         log.info('Downloading online version file')
+        self._manifest_not_modified = False
+        self._manifest_validators = None
         try:
             fd = FileDownloader(self.version_file, self.update_urls,
-                                verify=self.verify)
+                                verify=self.verify, mirrors=self.mirrors,
+                                http_pool=self.http_pool,
+                                validators=validators)
             data = fd.download_verify_return()
+            if fd.not_modified is True:
+                log.info('Version file not modified')
+                self._manifest_not_modified = True
+                return None
+            if data is None:
+                # Don't overwrite the version file on disk
+                log.error('Version file download failed')
+                return None
             try:
                 decompressed_data = gzip_decompress(data)
             except IOError:
@@ -325,6 +395,7 @@ class Client(object):
             log.info('Version file download successful')
             # Writing version file to application data directory
             self._write_manifest_2_filesystem(decompressed_data)
+            self._manifest_validators = fd.response_validators
             return decompressed_data
         except Exception as err:
             log.error('Version file download failed')
@@ -337,16 +408,379 @@ class Client(object):
             with gzip.open(self.version_file, 'wb') as f:
                 f.write(data)
 
+    def _download_manifest_sig(self):
+        # Detached signature of the downloaded version file.
+        # None if the repo doesn't have one.
+        try:
+            fd = FileDownloader(settings.VERSION_FILE_SIG, self.update_urls,
+                                verify=self.verify, mirrors=self.mirrors,
+                                http_pool=self.http_pool)
+            data = fd.download_verify_return()
+            if data is None:
+                log.debug('No version file signature')
+                return None
+            sig_info = json.loads(data.decode('utf-8'))
+        except Exception as err:
+            log.debug(str(err), exc_info=True)
+            log.warning('Failed to load version file signature')
+            return None
+        self._write_manifest_sig(sig_info)
+        return sig_info
+
+    def _write_manifest_sig(self, sig_info):
+        # Kept next to the version file for offline checks
+        path = os.path.join(self.data_dir, settings.VERSION_FILE_SIG)
+        try:
+            with open(path, 'w') as f:
+                f.write(json.dumps(sig_info, sort_keys=True))
+        except Exception as err:
+            log.debug(str(err), exc_info=True)
+            log.warning('Cannot save version file signature')
+
+    def _load_manifest_sig(self):
+        path = os.path.join(self.data_dir, settings.VERSION_FILE_SIG)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r') as f:
+                return json.loads(f.read())
+        except Exception as err:
+            log.debug(str(err), exc_info=True)
+            return None
+
+    def _load_manifest_validators(self):
+        # Validators, digest & verification status of the version
+        # file on disk
+        path = os.path.join(self.data_dir, self.version_file_validators)
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path, 'r') as f:
+                info = json.loads(f.read())
+        except Exception as err:
+            log.debug(str(err), exc_info=True)
+            log.warning('Cannot load version file validators')
+            return {}
+        if not isinstance(info, dict):
+            return {}
+        return info
+
+    def _write_manifest_validators(self, data):
+        # Saved after the signature check so a later 304 can reuse
+        # the result
+        info = {'validators': self._manifest_validators,
+                'file_hash': get_hash(data),
+                'keys_hash': self._get_public_keys_hash(),
+                'verified': self.verified}
+        path = os.path.join(self.data_dir, self.version_file_validators)
+        temp_path = path + '.tmp'
+        try:
+            with open(temp_path, 'w') as f:
+                f.write(json.dumps(info, sort_keys=True))
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(temp_path, path)
+        except Exception as err:
+            log.debug(str(err), exc_info=True)
+            log.warning('Cannot save version file validators')
+        self._write_manifest_cache(info)
+
+    def _get_manifest_stat(self):
+        # Size & modified time of the version file on disk. Changes
+        # without reading the file.
+        path = os.path.join(self.data_dir, self.version_file)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return [stat.st_size, stat.st_mtime]
+
+    def _write_manifest_cache(self, info):
+        # Parsed version data, stamped with the version file & keys
+        # it was checked with. Loading it needs no json or signature
+        # checks. Marshal format changes between python versions.
+        cache = {'python': list(sys.version_info[:2]),
+                 'file_hash': info['file_hash'],
+                 'keys_hash': info['keys_hash'],
+                 'verified': self.verified,
+                 'stat': self._get_manifest_stat(),
+                 'data': self.json_data}
+        path = os.path.join(self.data_dir, self.version_file_cache)
+        temp_path = path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(marshal.dumps(cache))
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(temp_path, path)
+        except Exception as err:
+            log.debug(str(err), exc_info=True)
+            log.warning('Cannot save version file cache')
+
+    def _load_manifest_cache(self, info):
+        # Version data checked with the version file info describes.
+        # None if there isn't any.
+        path = os.path.join(self.data_dir, self.version_file_cache)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                cache = marshal.loads(f.read())
+        except Exception as err:
+            log.debug(str(err), exc_info=True)
+            return None
+        if not isinstance(cache, dict):
+            return None
+        if cache.get('python') != list(sys.version_info[:2]):
+            return None
+        for key in ('file_hash', 'keys_hash'):
+            if cache.get(key) != info.get(key):
+                return None
+        # Version file on disk was changed
+        if cache.get('stat') != self._get_manifest_stat():
+            return None
+        return cache
+
+    def _get_public_keys_hash(self):
+        # Different keys need a new signature check
+        keys = json.dumps(sorted(self.public_keys))
+        return get_hash(keys.encode('utf-8'))
+
+    def _load_verified_manifest(self, info):
+        # Uses the version file on disk without checking its signature
+        # again. Only if it's the same file that was checked, with
+        # the same public keys. Version files that failed the
+        # signature check are downloaded again.
+        if info.get('verified') is not True:
+            log.debug('Version file on disk not verified')
+            return False
+        if info.get('keys_hash') != self._get_public_keys_hash():
+            log.debug('Public keys changed')
+            return False
+        cache = self._load_manifest_cache(info)
+        if cache is not None:
+            json_data = cache['data']
+        else:
+            data = self._get_manifest_filesystem()
+            if data is None or get_hash(data) != info.get('file_hash'):
+                log.debug('Version file on disk changed')
+                return False
+            try:
+                json_data = json.loads(data)
+            except ValueError as err:
+                log.debug(str(err), exc_info=True)
+                return False
+            if 'sigs' in json_data.keys():
+                del json_data['sigs']
+        self.json_data = json_data
+        self.verified = True
+        self.ready = True
+        self.easy_data = EasyAccessDict(self.json_data)
+        log.info('Using version file on disk')
+        return True
+
+    def _download_json(self, filename):
+        # Downloads a small gzipped json file. None if it's missing
+        # or can't be loaded
+        try:
+            fd = FileDownloader(filename, self.update_urls,
+                                verify=self.verify, mirrors=self.mirrors,
+                                http_pool=self.http_pool)
+            data = fd.download_verify_return()
+            if data is None:
+                log.debug('{} not found'.format(filename))
+                return None
+            data = json.loads(gzip_decompress(data))
+        except Exception as err:
+            log.debug(str(err), exc_info=True)
+            log.warning('Failed to load {}'.format(filename))
+            return None
+        if not isinstance(data, dict):
+            return None
+        return data
+
+    def _download_delta(self, serial):
+        # Downloads the changes since version file serial
+        log.info('Downloading version file delta')
+        delta = self._download_json(
+            settings.VERSION_FILE_DELTA.format(serial))
+        if delta is None or delta.get('expired') is True:
+            return None
+        if delta.get('from_serial') != serial:
+            return None
+        return delta
+
+    def _get_delta_manifest(self, validators):
+        # Brings the version file on disk up to date with a delta.
+        # Returns False if the full version file is needed.
+        cache = self._load_manifest_cache(validators)
+        if cache is not None:
+            json_data = cache['data']
+        else:
+            data = self._get_manifest_filesystem()
+            if data is None:
+                return False
+            try:
+                json_data = json.loads(data)
+            except ValueError:
+                return False
+        # Made by an older version of PyUpdater
+        serial = json_data.get('serial')
+        if serial is None:
+            return False
+
+        delta = self._download_delta(serial)
+        if delta is None:
+            return False
+        if delta.get('serial') == serial:
+            # Nothing changed. The delta isn't signed so the conditional
+            # download of the version file makes sure of it.
+            log.debug('Version file delta has no changes')
+            return False
+
+        if 'sigs' in json_data.keys():
+            del json_data['sigs']
+        try:
+            json_data = apply_delta(json_data, delta)
+        except Exception as err:
+            log.debug(str(err), exc_info=True)
+            log.warning('Failed to apply version file delta')
+            return False
+        json_data['sigs'] = delta.get('sigs', [])
+        data = json.dumps(json_data, sort_keys=True).encode('utf-8')
+        # Same check as a downloaded version file. The full version
+        # file is downloaded if it fails.
+        json_data = self._verify_sig(json_data)
+        if self.verified is False:
+            log.warning('Version file from delta not verified')
+            return False
+
+        self._write_manifest_2_filesystem(data)
+        self.json_data = json_data
+        self._manifest_validators = {}
+        self._write_manifest_validators(data)
+        self.ready = True
+        self.easy_data = EasyAccessDict(self.json_data)
+        log.info('Version file updated from delta')
+        return True
+
+    def _get_sharded_manifest(self):
+        # Downloads the signed index of version file shards & the
+        # shards of the apps checked so far. Returns False if the
+        # full version file is needed.
+        log.info('Downloading version file index')
+        index = self._download_json(settings.VERSION_FILE_INDEX)
+        if index is None:
+            return False
+        signatures = index.pop('sigs', [])
+        index_data = json.dumps(index, sort_keys=True)
+        if self._check_sigs(signatures, index_data) is False:
+            log.warning('Version file index not verified')
+            return False
+        log.info('Version file index verified')
+        self._shard_index = index
+        self.json_data = {settings.UPDATES_KEY: {}, 'latest': {},
+                          'serial': index.get('serial')}
+        self.verified = True
+        self.ready = True
+        names = self._shard_names | set([self.app_name])
+        self._shard_names = set()
+        for name in names:
+            self._load_shard(name)
+        self.easy_data = EasyAccessDict(self.json_data)
+        return True
+
+    def _load_shard(self, name):
+        # Adds the shard of name for this platform to the version data.
+        # Shards are checked against the hash in the verified index.
+        self._shard_names.add(name)
+        try:
+            info = self._shard_index['shards'][name][self.platform]
+        except (KeyError, TypeError):
+            log.debug('No version file shard for {}'.format(name))
+            return False
+        data = self._get_shard(info['filename'], info['file_hash'])
+        if data is None:
+            log.warning('Failed to load version file shard')
+            return False
+        try:
+            shard = json.loads(gzip_decompress(data))
+            updates = shard[settings.UPDATES_KEY].get(name, {})
+            latest = shard['latest'].get(name, {})
+        except Exception as err:
+            log.debug(str(err), exc_info=True)
+            log.warning('Failed to load version file shard')
+            return False
+        self.json_data[settings.UPDATES_KEY][name] = updates
+        self.json_data['latest'][name] = latest
+        self.easy_data = EasyAccessDict(self.json_data)
+        return True
+
+    def _get_shard(self, filename, file_hash):
+        # Shards on disk are only downloaded again if they changed
+        shard_dir = os.path.join(self.data_dir,
+                                 settings.VERSION_FILE_SHARD_FOLDER)
+        path = os.path.join(shard_dir, filename)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+            if get_hash(data) == file_hash:
+                log.debug('Using version file shard on disk')
+                return data
+        fd = FileDownloader(filename, self.update_urls,
+                            hexdigest=file_hash, verify=self.verify,
+                            mirrors=self.mirrors, http_pool=self.http_pool)
+        data = fd.download_verify_return()
+        if data is None:
+            return None
+        try:
+            if not os.path.exists(shard_dir):
+                os.makedirs(shard_dir)
+            with open(path, 'wb') as f:
+                f.write(data)
+        except Exception as err:
+            log.debug(str(err), exc_info=True)
+            log.warning('Cannot save version file shard')
+        return data
+
     def _get_update_manifest(self):
         #  Downloads & Verifies version file signature.
         log.info('Loading version file...')
+        self.verified = False
 
-        data = self._download_manifest()
+        # Only the shards this client needs are downloaded
+        if self.shard_version_file is True:
+            if self._get_sharded_manifest() is True:
+                return
+            log.info('Using full version file')
+        self._shard_index = None
+
+        validators = self._load_manifest_validators()
+        # Only the changes since the version file on disk are
+        # downloaded if possible
+        if self._get_delta_manifest(validators) is True:
+            return
+
+        # Only downloads the version file if it changed
+        data = self._download_manifest(validators.get('validators'))
+        if self._manifest_not_modified is True:
+            if self._load_verified_manifest(validators) is True:
+                return
+            # Can't use the version file on disk. Get a new one
+            data = self._download_manifest()
+        downloaded = data is not None
         if data is None:
+            # Offline. The version data checked last time is used
+            # if the version file on disk didn't change.
+            if self._load_verified_manifest(validators) is True:
+                return
             # Its ok if this is None. If any exceptions are raised
             # that we can't handle we will just return an empty
             # dictionary.
             data = self._get_manifest_filesystem()
+            sig_info = self._load_manifest_sig()
+        else:
+            sig_info = self._download_manifest_sig()
 
         try:
             log.debug('Data type: {}'.format(type(data)))
@@ -373,7 +807,16 @@ class Client(object):
 
         # If verified we set self.verified to True.
         # We return the data either way
-        self.json_data = self._verify_sig(self.json_data)
+        if data is not None and \
+                self._verify_detached_sig(data, sig_info) is True:
+            log.info('Version file verified')
+            self.verified = True
+            self.json_data.pop('sigs', None)
+        else:
+            self.json_data = self._verify_sig(self.json_data)
+        # Only checked version files are reused later
+        if downloaded is True and self.verified is True:
+            self._write_manifest_validators(data)
 
         self.easy_data = EasyAccessDict(self.json_data)
         log.debug('Version Data:\n{}'.format(str(self.easy_data)))
@@ -388,30 +831,9 @@ class Client(object):
             # After removing the signatures we turn the json data back
             # into a string to use as data to verify the sig.
             update_data = json.dumps(data, sort_keys=True)
-
-            # Attempting to verify signature of version file by
-            # looping through public keys and testing. If found
-            # will break out of the loop
-            for pk in self.public_keys:
-                log.debug('Public Key: {}'.format(pk))
-                for s in signatures:
-                    log.debug('Signature: {}'.format(s))
-                    # I added this try/except block because sometimes a
-                    # None value in json_data would find its way down here.
-                    # Hopefully i fixed it by return right under the Exception
-                    # block above.  But just in case will leave anyway.
-                    try:
-                        pub_key = ed25519.VerifyingKey(pk, encoding='base64')
-                        pub_key.verify(s, update_data, encoding='base64')
-                    except Exception as err:
-                        log.error(str(err))
-                    else:
-                        log.info('Version file verified')
-                        self.verified = True
-                        break
-                if self.verified is True:
-                    # No longer need to iterate through public keys
-                    break
+            if self._check_sigs(signatures, update_data) is True:
+                log.info('Version file verified')
+                self.verified = True
             else:
                 # Couldn't verify with any public keys
                 log.warning('Version file not verified')
@@ -421,6 +843,50 @@ class Client(object):
 
         return data
 
+    def _verify_detached_sig(self, data, sig_info):
+        # The signature covers the hash of the version file bytes,
+        # so one hash & signature check is all that's needed
+        if not isinstance(sig_info, dict):
+            return False
+        file_hash = sig_info.get('file_hash')
+        if file_hash is None or get_hash(data) != file_hash:
+            log.debug('Version file signature is for another file')
+            return False
+        return self._check_sigs(sig_info.get('sigs', []),
+                                file_hash.encode('ascii'))
+
+    def _get_verifying_keys(self):
+        keys = []
+        for pk in self.public_keys:
+            log.debug('Public Key: {}'.format(pk))
+            try:
+                keys.append(ed25519.VerifyingKey(pk, encoding='base64'))
+            except Exception as err:
+                log.error('Invalid public key: {}'.format(pk))
+                log.debug(str(err), exc_info=True)
+        return keys
+
+    def _check_sigs(self, signatures, update_data):
+        # Attempting to verify signature of version file by
+        # looping through public keys and testing. If found
+        # will return True
+        if self._verifying_keys is None:
+            self._verifying_keys = self._get_verifying_keys()
+        for pub_key in self._verifying_keys:
+            for s in signatures:
+                log.debug('Signature: {}'.format(s))
+                # I added this try/except block because sometimes a
+                # None value in json_data would find its way down here.
+                # Hopefully i fixed it by return right under the Exception
+                # block above.  But just in case will leave anyway.
+                try:
+                    pub_key.verify(s, update_data, encoding='base64')
+                except Exception as err:
+                    log.error(str(err))
+                else:
+                    return True
+        return False
+
     def _setup(self):
         # Sets up required directories on end-users computer
         # to place verified update data
@@ -467,5 +933,10 @@ class Client(object):
                 sanatized_urls.append(u + '/')
             else:
                 sanatized_urls.append(u)
-        # Removing duplicates
-        return list(set(sanatized_urls))
+        # Removing duplicates. Keeping config order so it's used
+        # as the tie breaker when ranking mirrors
+        unique_urls = []
+        for u in sanatized_urls:
+            if u not in unique_urls:
+                unique_urls.append(u)
+        return unique_urls
@@ -16,10 +16,15 @@
 from __future__ import unicode_literals
 
 from io import BytesIO
+import hashlib
+import json
 import logging
+import os
+import sys
+import threading
 import time
 
-from pyupdater.utils import get_hash, lazy_import
+from pyupdater.utils import lazy_import
 
 log = logging.getLogger(__name__)
 
@@ -36,10 +41,37 @@ def urllib3():
     return urllib3
 
 
+def get_http_pool(verify=True, maxsize=1):
+    """Creates a connection pool that can be shared between
+    FileDownloader instances so connections are kept alive
+    across downloads.
+
+    Kwargs:
+
+        verify (bool) Meaning:
+
+            True: Verify https connection
+
+            False: Don't verify https connection
+
+        maxsize (int): Number of connections to keep per host
+
+    Returns:
+
+        (urllib3.PoolManager): Connection pool
+    """
+    if verify is True:
+        return urllib3.PoolManager(cert_reqs=str('CERT_REQUIRED'),
+                                   ca_certs=certifi.where(),
+                                   maxsize=maxsize)
+    return urllib3.PoolManager(maxsize=maxsize)
+
+
 class FileDownloader(object):
-    """The FileDownloader object downloads files to memory and
-    verifies their hash.  If hash is verified data is either
-    written to disk to returned to calling object
+    """The FileDownloader object downloads files and verifies their
+    hash.  Data returned to the calling object is downloaded to memory.
+    Data written to disk is streamed to a temporary file which is
+    renamed once the hash is verified.
 
     Args:
 
@@ -56,31 +88,81 @@ class FileDownloader(object):
             True: Verify https connection
 
             False: Don't verify https connection
+
+        max_segments (int): Max number of byte ranges to download
+        concurrently when writing to disk. Ranges are spread across
+        all urls.
+
+        mirrors (MirrorScoreboard): Used to try the best performing
+        url first & to record how each url performed.
+
+        http_pool (urllib3.PoolManager): Connection pool to reuse.
+        If None a new pool is created.
+
+        validators (dict): ETag & Last-Modified of a copy of the file
+        we already have, keyed by the url it came from. Requests to
+        that url are made conditional. If the file hasn't changed
+        nothing is downloaded & not_modified is set to True.
     """
     def __init__(self, filename, urls, hexdigest=None, verify=True,
-                 progress_hooks=[]):
+                 progress_hooks=[], max_segments=1, mirrors=None,
+                 http_pool=None, validators=None):
         self.filename = filename
         if isinstance(urls, list) is False:
             self.urls = [urls]
         else:
             self.urls = urls
+        self.mirrors = mirrors
+        if self.mirrors is not None:
+            self.urls = self.mirrors.rank(self.urls)
         self.hexdigest = hexdigest
         self.verify = verify
         self.b_size = 4096 * 4
         self.file_binary_data = None
+        # sha256 hexdigest of the downloaded data. Computed
+        # block by block while downloading.
+        self.file_hash = None
         self.my_file = BytesIO()
+        # Used while streaming a download to disk.  Only renamed
+        # to filename after the hash has been verified.
+        self.temp_filename = self.filename + '.part'
+        # Holds url, hash & offset of an interrupted download
+        # so it can be resumed later.
+        self.resume_filename = self.temp_filename + '.json'
+        # Url the current download is coming from
+        self.file_url = None
+        # Update url file_url belongs to
+        self.mirror = None
         self.content_length = None
         self.progress_hooks = progress_hooks
-        if self.verify is True:
-            self.http_pool = urllib3.PoolManager(cert_reqs=str('CERT_'
-                                                 'REQUIRED'),
-                                                 ca_certs=certifi.where())
-        else:
-            self.http_pool = urllib3.PoolManager()
+        self.max_segments = max_segments
+        # Files smaller then 2 segments are downloaded in one go
+        self.min_segment_size = 1024 * 1024 * 4
+        self._segment_lock = threading.Lock()
+        # Set from another thread to stop the download
+        self._cancelled = False
+        self._segment_recieved = 0
+        if validators is None:
+            validators = {}
+        self.validators = validators
+        # True if the server said our copy is still current
+        self.not_modified = False
+        # Validators sent with the downloaded file. Keyed by file_url
+        self.response_validators = {}
+        if http_pool is None:
+            http_pool = get_http_pool(self.verify, max_segments)
+        self.http_pool = http_pool
 
     def download_verify_write(self):
-        """Downloads file then verifies against provided hash
-        If hash verfies then writes data to disk
+        """Downloads file to disk then verifies against provided hash
+        If hash verfies then moves the download to filename
+
+        The download is streamed to a temporary file & hashed as it
+        arrives so memory usage stays the same regardless of file size.
+        If the download is interrupted the partial file is kept and
+        the next call resumes it with a range request.
+        Large files are downloaded in segments when max_segments
+        is greater then 1.
 
         Returns:
 
@@ -90,18 +172,26 @@ class FileDownloader(object):
 
                 False - Hashes don't match
         """
-        # Downloading data internally
-        self._download_to_memory()
+        # Streaming data to a temporary file
+        if self._download_segmented() is False and \
+                self._cancelled is False:
+            self._download_to_storage()
+        self._save_mirror_scores()
         check = self._check_hash()
         # Nothing to verify against so return true
-        if check is None:
-            return True
-        if check is True:
-            self._write_to_file()
+        if check is None or check is True:
+            try:
+                self._write_to_file()
+            except Exception as err:
+                log.debug(str(err), exc_info=True)
+                log.error('Failed to move download into place')
+                self._remove_temp_file()
+                return False
             return True
         else:
-            del self.file_binary_data
-            del self.my_file
+            # Interrupted downloads are kept so they can be resumed
+            if not os.path.exists(self.resume_filename):
+                self._remove_temp_file()
             return False
 
     def download_verify_return(self):
@@ -119,6 +209,7 @@ class FileDownloader(object):
                 None - If any verification didn't pass
         """
         self._download_to_memory()
+        self._save_mirror_scores()
         check = self._check_hash()
         if check is None:
             return self.file_binary_data
@@ -127,6 +218,12 @@ class FileDownloader(object):
         else:
             return None
 
+    def cancel(self):
+        """Stops a running download. Safe to call from another thread.
+        The download will fail hash verification.
+        """
+        self._cancelled = True
+
     @staticmethod
     def _best_block_size(elapsed_time, bytes):
         # Returns best block size for current Internet connection speed
@@ -148,14 +245,314 @@ class FileDownloader(object):
         data = self._create_response()
         if data is None or data == '':
             return None
+        if data.status == 304:
+            log.debug('{} not modified'.format(self.filename))
+            self.not_modified = True
+            data.release_conn()
+            return None
+        self.response_validators = self._get_validators(data)
+
+        self._stream_response(data, self.my_file)
+
+        # Flushing data to prepare to write to file
+        self.my_file.flush()
+        self.my_file.seek(0)
+        self.file_binary_data = self.my_file.read()
+
+    def _download_to_storage(self):
+        # Streams download to a temporary file while hashing it.
+        # Keeps memory usage flat for large archives.
+        offset, resume_url = self._get_resume_info()
+        headers = None
+        if offset > 0:
+            log.info('Resuming download of {} at byte '
+                     '{}'.format(self.filename, offset))
+            headers = {'Range': 'bytes={}-'.format(offset)}
+        data = self._create_response(headers, resume_url)
+        if data is None or data == '':
+            return None
+
+        hasher = hashlib.sha256()
+        if offset > 0:
+            if data.status == 206 and \
+                    self._get_range_start(data) == offset:
+                # Server sent the rest of the file. Hash what we
+                # already have before appending to it.
+                self._hash_temp_file(hasher, offset)
+            else:
+                # Server ignored our range request. Start over.
+                log.debug('Range request not honored. Restarting '
+                          'download')
+                offset = 0
+                if data.status != 200:
+                    data.release_conn()
+                    data = self._create_response()
+                    if data is None or data == '':
+                        return None
+
+        if offset > 0:
+            mode = 'r+b'
+        else:
+            mode = 'wb'
+        with open(self.temp_filename, mode) as f:
+            f.seek(offset)
+            f.truncate()
+            try:
+                self._stream_response(data, f, hasher, offset)
+                self._check_length(data, offset, f.tell())
+            except Exception as err:
+                log.debug(str(err), exc_info=True)
+                log.error('Download of {} interrupted'.format(self.filename))
+                if self.mirrors is not None:
+                    self.mirrors.record_failure(self.mirror)
+                self.file_hash = None
+                f.flush()
+                self._write_resume_info(f.tell())
+                return None
+        self._remove_resume_info()
+
+    def _check_length(self, data, offset, size):
+        # Connections can close early without an error. Anything
+        # short of Content-Length is handled as an interruption.
+        length = data.headers.get('Content-Length')
+        if self._cancelled is True or length is None:
+            return
+        if size < offset + int(length):
+            raise IOError('Connection closed after {} of {} '
+                          'bytes'.format(size, offset + int(length)))
+
+    def _download_segmented(self):
+        # Splits download into byte ranges & fetches them concurrently
+        # spread across all mirrors.  Segments are written in place to
+        # the temporary file.  Returns False if a segmented download
+        # isn't possible so caller can fall back to a normal download.
+        if self.max_segments < 2:
+            return False
+        # Resuming a previous download takes precedence
+        if os.path.exists(self.resume_filename):
+            return False
 
+        data = self._create_response({'Range': 'bytes=0-0'})
+        if data is None or data == '':
+            return False
+        total = self._get_range_total(data)
+        data.close()
+        if data.status != 206 or total is None:
+            log.debug('Range requests not supported. Cannot segment')
+            return False
+
+        segments = min(self.max_segments, total // self.min_segment_size)
+        if segments < 2:
+            log.debug('File too small to segment')
+            return False
+        log.info('Downloading {} in {} segments'.format(self.filename,
+                                                        segments))
+
+        # Filename may have been corrected for spaces by _create_response
+        mirror = [u for u in self.urls if self.file_url.startswith(u)]
+        if len(mirror) > 0:
+            filename = self.file_url[len(mirror[0]):]
+        else:
+            filename = self.filename
+
+        # Allocating file so segments can be written in place
+        with open(self.temp_filename, 'wb') as f:
+            f.truncate(total)
+
+        self.content_length = total
+        self._segment_recieved = 0
+        segment_size = total // segments
+        results = [False] * segments
+        threads = []
+        for i in range(segments):
+            start = i * segment_size
+            if i == segments - 1:
+                end = total - 1
+            else:
+                end = start + segment_size - 1
+            # Rotating mirrors so each segment starts on a different one
+            urls = self.urls[i % len(self.urls):] + \
+                self.urls[:i % len(self.urls)]
+            t = threading.Thread(target=self._download_segment,
+                                 args=(filename, urls, start, end,
+                                       results, i))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+        if False in results:
+            log.error('Segmented download of {} failed'.format(self.filename))
+            self._remove_temp_file()
+            return False
+
+        # Segments arrive out of order so hash once all are written
+        hasher = hashlib.sha256()
+        self._hash_temp_file(hasher, total)
+        self.file_hash = hasher.hexdigest()
+        status = {'total': total,
+                  'downloaed': total,
+                  'status': 'finished',
+                  'time': '00:00'}
+        self._call_progress_hooks(status)
+        log.debug('Download Complete')
+        return True
+
+    def _download_segment(self, filename, urls, start, end, results, index):
+        # Downloads bytes start through end to the temporary file.
+        # Tries the next mirror if one fails.
+        headers = {'Range': 'bytes={}-{}'.format(start, end)}
+        for url in urls:
+            if self._cancelled is True:
+                return
+            file_url = url + filename
+            recieved = 0
+            try:
+                data = self._urlopen(url, file_url, headers)
+                if data.status != 206 or \
+                        self._get_range_start(data) != start:
+                    log.debug('Range not honored by {}'.format(url))
+                    if self.mirrors is not None:
+                        self.mirrors.record_failure(url)
+                    data.close()
+                    continue
+                start_download = time.time()
+                with open(self.temp_filename, 'r+b') as f:
+                    f.seek(start)
+                    while start + recieved <= end:
+                        if self._cancelled is True:
+                            break
+                        size = min(self.b_size, end + 1 - start - recieved)
+                        block = data.read(size)
+                        if len(block) == 0:
+                            break
+                        f.write(block)
+                        recieved += len(block)
+                        self._update_segment_progress(len(block))
+            except Exception as err:
+                log.debug(str(err), exc_info=True)
+                log.warning('Segment download from {} failed'.format(url))
+                if self.mirrors is not None:
+                    self.mirrors.record_failure(url)
+            if start + recieved == end + 1:
+                if self.mirrors is not None:
+                    self.mirrors.record_throughput(url, recieved,
+                                                   time.time() -
+                                                   start_download)
+                results[index] = True
+                return
+            # Segment will be downloaded again from the next mirror
+            self._update_segment_progress(-recieved)
+
+    def _update_segment_progress(self, recieved):
+        with self._segment_lock:
+            self._segment_recieved += recieved
+            if recieved <= 0:
+                return
+            percent = self._calc_progress_percent(self._segment_recieved,
+                                                  self.content_length)
+            status = {'total': self.content_length,
+                      'downloaded': self._segment_recieved,
+                      'status': 'downloading',
+                      'percent_complete': percent,
+                      'time': '--:--'}
+            self._call_progress_hooks(status)
+
+    def _get_resume_info(self):
+        # Returns offset & url to resume a previous download from.
+        # Partial downloads are only resumed if we can verify them
+        # against the same hash once finished.
+        if not os.path.exists(self.resume_filename):
+            self._remove_temp_file()
+            return 0, None
+        try:
+            with open(self.resume_filename, 'r') as f:
+                info = json.loads(f.read())
+            offset = int(info['offset'])
+            url = info.get('url')
+            file_hash = info.get('file_hash')
+        except Exception as err:
+            log.debug(str(err), exc_info=True)
+            log.warning('Cannot read resume info for {}'.format(self.filename))
+            self._remove_temp_file()
+            return 0, None
+        if self.hexdigest is None or file_hash != self.hexdigest:
+            log.debug('Partial download is for a different file')
+            self._remove_temp_file()
+            return 0, None
+        if not os.path.exists(self.temp_filename) or \
+                os.path.getsize(self.temp_filename) < offset:
+            log.debug('Partial download is missing data')
+            self._remove_temp_file()
+            return 0, None
+        return offset, url
+
+    def _write_resume_info(self, offset):
+        # Saves everything needed to resume this download later
+        if self.hexdigest is None or offset == 0:
+            self._remove_temp_file()
+            return
+        info = {'url': self.file_url,
+                'file_hash': self.hexdigest,
+                'offset': offset}
+        log.debug('Saving resume info: {}'.format(info))
+        with open(self.resume_filename, 'w') as f:
+            f.write(json.dumps(info))
+
+    def _remove_resume_info(self):
+        if os.path.exists(self.resume_filename):
+            os.remove(self.resume_filename)
+
+    def _hash_temp_file(self, hasher, length):
+        # Adds the first length bytes of the partial download to hasher
+        with open(self.temp_filename, 'rb') as f:
+            while length > 0:
+                block = f.read(min(length, 1024 * 1024))
+                if len(block) == 0:
+                    break
+                hasher.update(block)
+                length -= len(block)
+
+    @staticmethod
+    def _get_range_total(data):
+        # Parses complete length from Content-Range header.
+        # Example: bytes 0-0/1000
+        content_range = data.headers.get('Content-Range', '')
+        try:
+            return int(content_range.split('/')[1])
+        except (IndexError, ValueError):
+            return None
+
+    @staticmethod
+    def _get_range_start(data):
+        # Parses first byte position from Content-Range header.
+        # Example: bytes 100-999/1000
+        content_range = data.headers.get('Content-Range', '')
+        try:
+            return int(content_range.split()[1].split('-')[0])
+        except (IndexError, ValueError):
+            return None
+
+    def _stream_response(self, data, out, hasher=None, offset=0):
+        # Reads response in blocks & writes them to out.
+        # Each block is added to a running sha256 so the hash
+        # is ready as soon as the last block arrives.
+        # offset is the number of bytes received by a previous
+        # download when resuming.
+        if hasher is None:
+            hasher = hashlib.sha256()
         # Getting length of file to show progress
-        self.content_length = self._get_content_length(data)
+        self.content_length = self._get_content_length(data) + offset
         # Setting start point to show progress
-        recieved_data = 0
+        recieved_data = offset
 
         start_download = time.time()
         while 1:
+            if self._cancelled is True:
+                log.debug('Download cancelled')
+                self.file_hash = None
+                return
             # Grabbing start time for use with best block size
             start_block = time.time()
             block = data.read(self.b_size)
@@ -169,16 +566,14 @@ class FileDownloader(object):
             self.b_size = self._best_block_size(end_block - start_block,
                                                 len(block))
             log.debug('Block size: %s' % self.b_size)
-            # Saving data to memory
-            # ToDo: Consider writing file to cache to enable resumable
-            #       downloads
-            self.my_file.write(block)
+            out.write(block)
+            hasher.update(block)
             recieved_data += len(block)
             percent = self._calc_progress_percent(recieved_data,
                                                   self.content_length)
             time_left = FileDownloader._calc_eta(start_download, time.time(),
-                                                 self.content_length,
-                                                 recieved_data)
+                                                 self.content_length - offset,
+                                                 recieved_data - offset)
             status = {'total': self.content_length,
                       'downloaded': recieved_data,
                       'status': 'downloading',
@@ -186,10 +581,11 @@ class FileDownloader(object):
                       'time': time_left}
             self._call_progress_hooks(status)
 
-        # Flushing data to prepare to write to file
-        self.my_file.flush()
-        self.my_file.seek(0)
-        self.file_binary_data = self.my_file.read()
+        self.file_hash = hasher.hexdigest()
+        if self.mirrors is not None:
+            self.mirrors.record_throughput(self.mirror,
+                                           recieved_data - offset,
+                                           time.time() - start_download)
         status = {'total': self.content_length,
                   'downloaed': recieved_data,
                   'status': 'finished',
@@ -210,17 +606,33 @@ class FileDownloader(object):
 
     # Creating response object to start download
     # Attempting to do some error correction for aws s3 urls
-    def _create_response(self):
+    def _create_response(self, headers=None, first_url=None):
         data = None
-        for url in self.urls:
+        url = None
+        file_url = None
+        urls = list(self.urls)
+        # Used to resume a download from the url it was started on
+        if first_url is not None:
+            for u in urls:
+                if first_url.startswith(u):
+                    urls.remove(u)
+                    urls.insert(0, u)
+                    break
+        for url in urls:
             file_url = url + self.filename
             log.debug('Url for request: {}'.format(file_url))
             try:
-                data = self.http_pool.urlopen('GET', file_url,
-                                              preload_content=False)
+                data = self._urlopen(url, file_url, headers)
                 # Have to catch url with spaces
                 if data.status == 505:
                     raise urllib3.exceptions.HTTPError
+                # Mirror doesn't have the file. Try the next one
+                if self._is_failed_response(data):
+                    log.debug('Got status {} from {}'.format(data.status,
+                                                             url))
+                    data.release_conn()
+                    data = ''
+                    continue
             except urllib3.exceptions.HTTPError:
                 log.debug('There may be spaces in an S3 url...')
                 file_url = file_url.replace(' ', '+')
@@ -241,42 +653,117 @@ class FileDownloader(object):
             if data is None:
                 # Let's try one more time with the fixed url
                 try:
-                    data = self.http_pool.urlopen('GET', file_url,
-                                                  preload_content=False)
+                    data = self._urlopen(url, file_url, headers)
                 except urllib3.exceptions.SSLError:
                     log.error('SSL cert not verified')
                 except Exception as e:
                     log.error(str(e), exc_info=True)
                     self.file_binary_data = None
                 else:
+                    if self._is_failed_response(data):
+                        data.release_conn()
+                        data = ''
+                        continue
                     break
 
+        self.file_url = file_url
+        self.mirror = url
         log.debug('Downloading {} from:\n{}'.format(self.filename, file_url))
         return data
 
+    def _urlopen(self, url, file_url, headers=None):
+        # Makes request for file_url & records how the mirror did
+        headers = self._add_validators(file_url, headers)
+        start = time.time()
+        try:
+            data = self.http_pool.urlopen('GET', file_url, headers=headers,
+                                          preload_content=False)
+        except Exception:
+            if self.mirrors is not None:
+                self.mirrors.record_failure(url)
+            raise
+        if self.mirrors is not None:
+            if self._is_mirror_failure(data):
+                self.mirrors.record_failure(url)
+            elif data.status != 505:
+                self.mirrors.record_response(url, time.time() - start)
+        return data
+
+    def _add_validators(self, file_url, headers):
+        # Only whole file requests are made conditional
+        validators = self.validators.get(file_url)
+        if validators is None or headers is not None:
+            return headers
+        headers = {}
+        if validators.get('etag') is not None:
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified') is not None:
+            headers['If-Modified-Since'] = validators['last_modified']
+        if len(headers) == 0:
+            return None
+        return headers
+
+    def _get_validators(self, data):
+        # Validators of the response so the next request can be
+        # conditional
+        validators = {'etag': data.headers.get('ETag'),
+                      'last_modified': data.headers.get('Last-Modified')}
+        if validators['etag'] is None and \
+                validators['last_modified'] is None:
+            return {}
+        return {self.file_url: validators}
+
+    @staticmethod
+    def _is_failed_response(data):
+        # 505 is handled as a url with spaces & 416 means our
+        # range request was off, not that the mirror is bad.
+        return data.status >= 400 and data.status not in (416, 505)
+
+    @staticmethod
+    def _is_mirror_failure(data):
+        # Only server errors count against the mirror. Optional files
+        # like version file deltas & signatures are missing on older
+        # repos, so 404s are normal answers from a healthy mirror.
+        return data.status >= 500 and data.status != 505
+
+    def _save_mirror_scores(self):
+        if self.mirrors is not None:
+            self.mirrors.save()
+
     def _write_to_file(self):
-        # Writes download data in memory to disk
-        with open(self.filename, 'wb') as f:
-            f.write(self.file_binary_data)
+        # Moves verified temporary download to its final name.
+        # Rename is atomic so filename is never partially written.
+        # Windows will not rename over an existing file.
+        if sys.platform == 'win32' and os.path.exists(self.filename):
+            os.remove(self.filename)
+        os.rename(self.temp_filename, self.filename)
+
+    def _remove_temp_file(self):
+        if os.path.exists(self.temp_filename):
+            log.debug('Removing {}'.format(self.temp_filename))
+            os.remove(self.temp_filename)
+        self._remove_resume_info()
 
     def _check_hash(self):
         # Checks hash of downloaded file
+        if self._cancelled is True:
+            log.debug('Download was cancelled')
+            return False
         if self.hexdigest is None:
             # No hash provided to check.
             # So just return any data recieved
             log.debug('No hash to verify')
             return None
-        if self.file_binary_data is None:
+        if self.file_hash is None:
             # Exit quickly if we got nohting to compare
-            # Also I'm sure we'll get an exception trying to
-            # pass None to get hash :)
             log.debug('Cannot verify file hash - No Data')
             return False
         log.debug('Checking file hash')
         log.debug('Update hash: {}'.format(self.hexdigest))
 
-        file_hash = get_hash(self.file_binary_data)
-        if file_hash == self.hexdigest:
+        # Hash was computed while downloading. No need for
+        # another pass over the data.
+        if self.file_hash == self.hexdigest:
             log.debug('File hash verified')
             return True
         log.debug('Cannot verify file hash')
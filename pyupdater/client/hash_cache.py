@@ -0,0 +1,137 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import json
+import logging
+import os
+import threading
+
+from pyupdater import settings
+from pyupdater.utils import get_package_hashes
+
+log = logging.getLogger(__name__)
+
+
+class HashCache(object):
+    """Remembers the hash of files so they are only read again
+    once they change.
+
+    A file is considered unchanged if its size, modification time
+    & inode are the same as when it was hashed.
+
+    Kwargs:
+
+        data_dir (str): Directory to save hashes in. If None hashes
+        are only kept in memory.
+    """
+
+    def __init__(self, data_dir=None):
+        if data_dir is not None:
+            self.filename = os.path.join(data_dir,
+                                         settings.HASH_CACHE_FILE)
+        else:
+            self.filename = None
+        self.hashes = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        "Loads saved hashes from disk"
+        if self.filename is None or not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename, 'r') as f:
+                hashes = json.loads(f.read())
+        except Exception as err:
+            log.debug(str(err), exc_info=True)
+            log.warning('Cannot load hash cache')
+            return
+        if isinstance(hashes, dict):
+            self.hashes = hashes
+
+    def save(self):
+        "Saves hashes to disk. Files that no longer exist are dropped."
+        if self.filename is None:
+            return
+        temp_filename = self.filename + '.tmp'
+        with self._lock:
+            for path in list(self.hashes.keys()):
+                if not os.path.exists(path):
+                    del self.hashes[path]
+            data = json.dumps(self.hashes, sort_keys=True)
+        try:
+            with open(temp_filename, 'w') as f:
+                f.write(data)
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+            os.rename(temp_filename, self.filename)
+        except Exception as err:
+            log.debug(str(err), exc_info=True)
+            log.warning('Cannot save hash cache')
+
+    def get_hash(self, filename):
+        """Gets sha256 hash of filename. Only reads the file if it
+        changed since it was last hashed.
+
+        Args:
+
+            filename (str): Path to file
+
+        Returns:
+
+            (str): sha256 hash
+        """
+        path = os.path.abspath(filename)
+        stat = self._get_stat(path)
+        with self._lock:
+            entry = self.hashes.get(path)
+        if entry is not None and entry['stat'] == stat:
+            log.debug('Hash cache hit: {}'.format(filename))
+            return entry['hash']
+
+        file_hash = get_package_hashes(path)
+        # File may have changed while hashing
+        if self._get_stat(path) == stat:
+            self._set(path, stat, file_hash)
+        return file_hash
+
+    def add(self, filename, file_hash):
+        """Records the hash of a file whose hash is already known,
+        like a download that was just verified.
+
+        Args:
+
+            filename (str): Path to file
+
+            file_hash (str): sha256 hash of filename
+        """
+        path = os.path.abspath(filename)
+        self._set(path, self._get_stat(path), file_hash)
+
+    def _set(self, path, stat, file_hash):
+        with self._lock:
+            self.hashes[path] = {'stat': stat, 'hash': file_hash}
+        self.save()
+
+    @staticmethod
+    def _get_stat(path):
+        # Size, modification time in ns & inode
+        st = os.stat(path)
+        mtime = getattr(st, 'st_mtime_ns', None)
+        if mtime is None:
+            mtime = int(st.st_mtime * 1000000000)
+        return [st.st_size, mtime, st.st_ino]
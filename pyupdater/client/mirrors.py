@@ -0,0 +1,212 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import json
+import logging
+import os
+import random
+import threading
+
+from pyupdater import settings
+
+log = logging.getLogger(__name__)
+
+
+class MirrorScoreboard(object):
+    """Keeps track of how each update url performs so downloads can
+    try the best mirror first.
+
+    Time to first byte, throughput & failures are kept as moving
+    averages and saved to the data dir between runs.
+
+    Kwargs:
+
+        data_dir (str): Directory to save scores in. If None scores
+        are only kept in memory.
+    """
+
+    # Weight given to the newest measurement
+    alpha = 0.3
+
+    # Chance of trying a mirror other then the best one first.
+    # Keeps scores of the other mirrors up to date.
+    explore_rate = 0.1
+
+    # Size used to turn throughput into an expected download time
+    typical_size = 1024 * 1024
+
+    # Seconds assumed for a mirror that has never answered
+    unanswered_time = 1.0
+
+    def __init__(self, data_dir=None):
+        if data_dir is not None:
+            self.filename = os.path.join(data_dir,
+                                         settings.MIRROR_SCORES_FILE)
+        else:
+            self.filename = None
+        self.scores = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        "Loads saved scores from disk"
+        if self.filename is None or not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename, 'r') as f:
+                scores = json.loads(f.read())
+        except Exception as err:
+            log.debug(str(err), exc_info=True)
+            log.warning('Cannot load mirror scores')
+            return
+        if isinstance(scores, dict):
+            self.scores = scores
+
+    def save(self):
+        "Saves scores to disk"
+        if self.filename is None:
+            return
+        temp_filename = self.filename + '.tmp'
+        with self._lock:
+            data = json.dumps(self.scores, sort_keys=True)
+        try:
+            with open(temp_filename, 'w') as f:
+                f.write(data)
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+            os.rename(temp_filename, self.filename)
+        except Exception as err:
+            log.debug(str(err), exc_info=True)
+            log.warning('Cannot save mirror scores')
+
+    def record_response(self, url, ttfb):
+        """Records time to first byte of a successful request
+
+        Args:
+
+            url (str): Mirror url
+
+            ttfb (float): Seconds until response headers were received
+        """
+        with self._lock:
+            score = self._get_score(url)
+            score['ttfb'] = self._average(score['ttfb'], ttfb)
+            score['failures'] = self._average(score['failures'], 0.0)
+
+    def record_throughput(self, url, size, elapsed):
+        """Records download speed of a completed transfer
+
+        Args:
+
+            url (str): Mirror url
+
+            size (int): Bytes downloaded
+
+            elapsed (float): Seconds it took to download size
+        """
+        if size <= 0 or elapsed <= 0:
+            return
+        with self._lock:
+            score = self._get_score(url)
+            score['throughput'] = self._average(score['throughput'],
+                                                size / elapsed)
+
+    def record_failure(self, url):
+        """Records a failed request
+
+        Args:
+
+            url (str): Mirror url
+        """
+        log.debug('Mirror failed: {}'.format(url))
+        with self._lock:
+            score = self._get_score(url)
+            score['failures'] = self._average(score['failures'], 1.0)
+
+    def rank(self, urls):
+        """Sorts urls best first. Once in a while a random url is moved
+        to the front to keep its score fresh.
+
+        Args:
+
+            urls (list): Mirror urls
+
+        Returns:
+
+            (list): Sorted urls
+        """
+        with self._lock:
+            # Sort is stable so untested mirrors keep config order
+            ranked = sorted(urls, key=self._expected_time)
+        if len(ranked) > 1 and random.random() < self.explore_rate:
+            explore = ranked.pop(random.randint(1, len(ranked) - 1))
+            ranked.insert(0, explore)
+            log.debug('Exploring mirror: {}'.format(explore))
+        return ranked
+
+    def estimate(self, urls):
+        """Gets measurements of the best url with data
+
+        Args:
+
+            urls (list): Mirror urls
+
+        Returns:
+
+            (tuple): Time to first byte & throughput in bytes per
+            second. Either may be None if not known.
+        """
+        with self._lock:
+            ranked = sorted(urls, key=self._expected_time)
+            for url in ranked:
+                score = self.scores.get(url)
+                if score is not None and score['ttfb'] is not None:
+                    return score['ttfb'], score['throughput']
+        return None, None
+
+    def _expected_time(self, url):
+        # Estimated seconds to download a typical file from url.
+        # Mirrors we have no data on come first so they get measured.
+        score = self.scores.get(url)
+        if score is None:
+            return 0.0
+        if score['ttfb'] is None:
+            # Has only ever failed. Exploring will give it another go.
+            if score['failures'] > 0:
+                return float('inf')
+            ttfb = self.unanswered_time
+        else:
+            ttfb = score['ttfb']
+        if score['throughput']:
+            transfer = self.typical_size / score['throughput']
+        else:
+            transfer = 0.0
+        # A mirror that always fails is never worth trying first
+        success_rate = max(1.0 - score['failures'], 0.01)
+        return (ttfb + transfer) / success_rate
+
+    def _get_score(self, url):
+        if url not in self.scores:
+            self.scores[url] = {'ttfb': None,
+                                'throughput': None,
+                                'failures': 0.0}
+        return self.scores[url]
+
+    def _average(self, current, value):
+        if current is None:
+            return value
+        return current + self.alpha * (value - current)
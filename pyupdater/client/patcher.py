@@ -16,12 +16,9 @@
 from __future__ import unicode_literals
 
 import logging
+from multiprocessing.pool import ThreadPool
 import os
-
-try:
-    import bsdiff4
-except ImportError:  # pragma: no cover
-    bsdiff4 = None
+import threading
 
 from pyupdater.client.downloader import FileDownloader
 from pyupdater import settings
@@ -29,11 +26,10 @@ from pyupdater.utils import (get_package_hashes,
                              EasyAccessDict,
                              lazy_import,
                              Version)
+from pyupdater.utils import archive_patch
+from pyupdater.utils.diff_engines import DEFAULT_ENGINE, ENGINES
 from pyupdater.utils.exceptions import PatcherError
 
-if bsdiff4 is None:  # pragma: no cover
-    from pyupdater.utils import bsdiff4_py as bsdiff4
-
 log = logging.getLogger(__name__)
 
 
@@ -70,6 +66,25 @@ class Patcher(object):
             True: Verify https connection
 
             False: Don't verify https connection
+
+        mirrors (MirrorScoreboard): Used to rank update_urls
+
+        http_pool (urllib3.PoolManager): Connection pool shared by all
+        patch downloads
+
+        max_concurrent_downloads (int): Number of patches to download
+        at the same time
+
+        hash_cache (HashCache): Used to skip hashing archives that
+        haven't changed
+
+        low_memory (bool) Meaning:
+
+            True: Spool patches to disk & stream patches from file to
+            file. Memory usage stays small regardless of binary size &
+            how many patches are applied.
+
+            False: Patch in memory
     """
 
     def __init__(self, **kwargs):
@@ -82,9 +97,23 @@ class Patcher(object):
         self.update_urls = kwargs.get('update_urls', [])
         self.verify = kwargs.get('verify', True)
         self.progress_hooks = kwargs.get('progress_hooks', [])
+        self.mirrors = kwargs.get('mirrors')
+        self.http_pool = kwargs.get('http_pool')
+        self.max_concurrent_downloads = kwargs.get('max_concurrent_downloads',
+                                                   1)
+        self.low_memory = kwargs.get('low_memory', False)
+        self.hash_cache = kwargs.get('hash_cache')
         self.patch_data = []
-        self.patch_binary_data = []
         self.og_binary = None
+        self.new_binary = None
+        # Used when patching on disk. Holds the filename of the
+        # latest patched binary.
+        self.new_filename = None
+        # Used to stop other patch downloads once one has failed
+        self._download_lock = threading.Lock()
+        self._downloaders = []
+        self._downloads_cancelled = False
+        self._downloaded = 0
         # ToDo: Update tests with linux archives.
         # Used for testing.
         self.platform = kwargs.get('platform', _platform)
@@ -113,24 +142,43 @@ class Patcher(object):
             log.debug('Cannot find all patches...')
             return False
 
-        # Download and verify patches in 1 go
-        download_check = self._download_verify_patches()
-        if download_check is False:
+        # Download, verify & apply patches. Each patch is applied
+        # while the following patches are still downloading.
+        try:
+            patch_check = self._download_apply_patches()
+        except PatcherError:
+            return False
+        if patch_check is False:
             log.debug('Patch check failed...')
             return False
 
         try:
-            self._apply_patches_in_memory()
+            self._write_update_to_disk()
         except PatcherError:
             return False
-        else:
-            try:
-                self._write_update_to_disk()
-            except PatcherError:
-                return False
         # Looks like all is well
         return True
 
+    def get_patch_sizes(self):
+        """Gets the size of each patch needed to reach highest_version
+
+        Returns:
+
+            (list) Meanings:
+
+                Sizes of the patches in bytes - In the order
+                they will be applied
+
+                None - Patches or their sizes are missing from the
+                version file
+        """
+        if self._get_patch_info(self.name) is False:
+            return None
+        sizes = [p['patch_size'] for p in self.patch_data]
+        if None in sizes:
+            return None
+        return sizes
+
     def _verify_installed_binary(self):
         # Verifies latest downloaded archive against known hash
         log.debug('Checking for current installed binary to patch')
@@ -140,100 +188,289 @@ class Patcher(object):
                 log.debug('Cannot find archive to patch')
                 return False
 
-            installed_file_hash = get_package_hashes(self.current_filename)
+            installed_file_hash = self._get_file_hash(self.current_filename)
             if self.current_file_hash != installed_file_hash:
                 log.debug('Binary hash mismatch')
                 return False
             # Read binary into memory to begin patching
-            with open(self.current_filename, 'rb') as f:
-                self.og_binary = f.read()
+            if self.low_memory is False:
+                with open(self.current_filename, 'rb') as f:
+                    self.og_binary = f.read()
         log.debug('Binary found and verified')
         return True
 
-    # We will take all versions.  Then append any version
-    # thats greater then the current version to the list
-    # of needed patches.
     def _get_patch_info(self, name):
         # Taking the list of needed patches and extracting the
-        # patch data from it. If any loop fails, will return False
-        # and start full binary update.
+        # patch data from it. If no chain of patches reaches the
+        # newest version, will return False and start full
+        # binary update.
         log.debug('Getting patch meta-data')
         required_patches = self._get_required_patches(name)
+        self.patch_data = []
+        if required_patches is None:
+            log.error('Missing required patch meta-data')
+            return False
 
         for p in required_patches:
             info = {}
-            platform_key = '{}*{}*{}*{}'.format(settings.UPDATES_KEY, name,
-                                                str(p), self.platform)
-            platform_info = self.star_access_update_data.get(platform_key)
-
-            try:
-                info['patch_name'] = platform_info['patch_name']
-                info['patch_urls'] = self.update_urls
-                info['patch_hash'] = platform_info['patch_hash']
-                self.patch_data.append(info)
-            except Exception as err:  # pragma: no cover
-                log.debug(str(err), exc_info=True)
-                log.error('Missing required patch meta-data')
+            info['patch_name'] = p['patch_name']
+            info['patch_urls'] = self.update_urls
+            info['patch_hash'] = p['patch_hash']
+            # Missing from version files made by older versions
+            info['patch_size'] = p.get('patch_size')
+            info['patch_engine'] = p.get('patch_engine') or DEFAULT_ENGINE
+            # Made by a newer version of PyUpdater
+            if info['patch_engine'] not in ENGINES:
+                log.error('Unknown patch engine: '
+                          '{}'.format(info['patch_engine']))
+                return False
+            # Patch of the uncompressed data of an archive
+            info['patch_archive'] = p.get('patch_archive')
+            if info['patch_archive'] is not None and \
+                    info['patch_archive'].get('format') not in \
+                    archive_patch.FORMATS:
+                log.error('Unknown patch archive format')
                 return False
+            self.patch_data.append(info)
         return True
 
     def _get_required_patches(self, name):
-        # Gathers patch name, hash & URL
-        needed_patches = []
+        # Finds the shortest chain of patches from the current version
+        # to the newest version. Each version has a patch from the
+        # version before it & may have skip patches from older anchor
+        # versions. Returns None if the newest version can't be reached.
         try:
             # Get list of Version objects initialized with keys
             # from update manifest
             version_key = '{}*{}'.format(settings.UPDATES_KEY, name)
             version_info = self.star_access_update_data(version_key)
-            versions = map(Version, version_info.keys())
-        except KeyError:  # pragma: no cover
+            versions = [Version(v) for v in version_info.keys()
+                        if self.platform in version_info[v].keys()]
+        except (AttributeError, KeyError):  # pragma: no cover
             log.debug('No updates found in updates dict')
-            # Will cause error to be thrown in _get_pacth_info
-            # which will cause patch update to return False
-            versions = [1]
+            return None
 
         # Ensuring we apply patches in correct order
         versions = sorted(versions)
         log.debug('getting required patches')
-        for i in versions:
-            if i > self.current_version:
-                needed_patches.append(i)
-        # Used to guarantee patches are only added once
-        return list(set(needed_patches))
-
-    def _download_verify_patches(self):
-        # Downloads & verifies all patches
-        log.debug('Downloading patches')
-        downloaded = 0
+        # Version string -> (number of patches, bytes, patches)
+        chains = {str(self.current_version): (0, 0, [])}
+        previous = self.current_version
+        for v in versions:
+            if not v > self.current_version:
+                # Regular patch to the next version starts here
+                if not v < self.current_version:
+                    previous = v
+                continue
+            platform_info = version_info[str(v)][self.platform]
+            # Patch from the version before this one
+            edges = []
+            if platform_info.get('patch_name') and \
+                    platform_info.get('patch_hash'):
+                edges.append((str(previous), platform_info))
+            for skip in platform_info.get('skip_patches', []):
+                edges.append((str(Version(skip['src'])), skip))
+
+            best = None
+            for src, patch in edges:
+                if src not in chains:
+                    continue
+                count, size, patches = chains[src]
+                chain = (count + 1, size + (patch.get('patch_size') or 0),
+                         patches + [patch])
+                # Fewest patches first then fewest bytes
+                if best is None or chain[:2] < best[:2]:
+                    best = chain
+            if best is not None:
+                chains[str(v)] = best
+            previous = v
+
+        if len(versions) == 0 or not versions[-1] > self.current_version:
+            return []
+        chain = chains.get(str(versions[-1]))
+        if chain is None:
+            return None
+        log.debug('Patch chain length: {}'.format(chain[0]))
+        return chain[2]
+
+    def _download_apply_patches(self):
+        # Downloads & verifies all patches concurrently and applies
+        # them in version order as soon as each one is available.
+        # Only the current binary & the patch being applied are
+        # kept in memory.
+        log.debug('Downloading & applying patches')
         total = len(self.patch_data)
-        for p in self.patch_data:
-            # Initialize downloader
-            fd = FileDownloader(p['patch_name'], p['patch_urls'],
-                                p['patch_hash'], self.verify)
-
-            # Attempt to download resource
-            data = fd.download_verify_return()
-            if data is not None:
-                self.patch_binary_data.append(data)
-                downloaded += 1
-                status = {'total': total,
-                          'downloaed': downloaded,
-                          'status': 'downloading'}
-                self._call_progress_hooks(status)
-            else:
-                # Since patches are applied sequentially
-                # we cannot continue successfully
-                status = {'total': total,
-                          'downloaded': downloaded,
-                          'status': 'failed to download all patches'}
-                self._call_progress_hooks(status)
-                return False
+        self._downloaded = 0
+        self.new_binary = self.og_binary
+        self.og_binary = None
+        self.new_filename = self.current_filename
+        # Archive info of the latest binary while it's unpacked
+        unpacked = None
+        workers = max(1, min(self.max_concurrent_downloads, total))
+        pool = ThreadPool(workers)
+        # Patches spooled to disk are downloaded to the update folder
+        with jms_utils.paths.ChDir(self.update_folder):
+            success = False
+            try:
+                # imap returns results in the order they were submitted
+                results = pool.imap(self._download_patch, self.patch_data)
+                for i, data in enumerate(results):
+                    engine = ENGINES[self.patch_data[i]['patch_engine']]
+                    archive = self.patch_data[i]['patch_archive']
+                    if data is None:
+                        # Since patches are applied sequentially
+                        # we cannot continue successfully
+                        self._cancel_downloads()
+                        status = {'total': total,
+                                  'downloaded': self._downloaded,
+                                  'status': 'failed to download all '
+                                  'patches'}
+                        self._call_progress_hooks(status)
+                        return False
+                    try:
+                        # Archive patches apply to uncompressed data
+                        if archive is not None and unpacked is None:
+                            self._unpack_binary()
+                        elif archive is None and unpacked is not None:
+                            self._pack_binary(unpacked)
+                        unpacked = archive
+                        if self.low_memory is True:
+                            self._apply_patch_on_disk(data, engine)
+                        else:
+                            self.new_binary = engine.patch(self.new_binary,
+                                                           data)
+                        log.debug('Applied patch successfully')
+                    except Exception as err:
+                        self._cancel_downloads()
+                        log.debug(err, exc_info=True)
+                        log.error(err)
+                        raise PatcherError('Patch failed to apply')
+                    # Patch isn't needed anymore
+                    del data
+                if unpacked is not None:
+                    try:
+                        self._pack_binary(unpacked)
+                    except Exception as err:
+                        log.debug(err, exc_info=True)
+                        raise PatcherError('Failed to pack archive')
+                success = True
+            finally:
+                pool.close()
+                pool.join()
+                if success is False:
+                    self._remove_patch_files()
         status = {'total': total,
-                  'downloaed': downloaded,
+                  'downloaed': self._downloaded,
                   'status': 'finished'}
         self._call_progress_hooks(status)
         return True
 
+    def _apply_patch_on_disk(self, patch_filename, engine):
+        # Applies patch_filename to the latest patched binary
+        # without loading either into memory.
+        # The previous intermediate binary & the patch are removed
+        # right away.
+        dst = self._get_update_filename() + '.patching'
+        src = self.new_filename
+        # Streams the patch so binaries larger then memory can be patched
+        engine.file_patch(src, dst, patch_filename)
+        os.remove(patch_filename)
+        self._replace_patched(dst)
+
+    def _replace_patched(self, filename):
+        # Makes filename the latest patched binary.
+        # Never remove the installed binary
+        patched = self._get_update_filename() + '.patched'
+        if os.path.exists(patched):
+            os.remove(patched)
+        os.rename(filename, patched)
+        self.new_filename = patched
+
+    def _unpack_binary(self):
+        # Replaces the latest binary with its uncompressed data
+        log.debug('Unpacking archive')
+        if self.low_memory is True:
+            dst = self._get_update_filename() + '.patching'
+            archive_patch.unpack_file(self.new_filename, dst)
+            self._replace_patched(dst)
+        else:
+            self.new_binary = archive_patch.unpack(self.new_binary)
+
+    def _pack_binary(self, archive):
+        # Replaces the latest binary with an archive of it. The hash
+        # check of the finished update catches archives that didn't
+        # rebuild exactly.
+        log.debug('Packing archive')
+        if self.low_memory is True:
+            dst = self._get_update_filename() + '.patching'
+            archive_patch.pack_file(self.new_filename, dst, archive)
+            self._replace_patched(dst)
+        else:
+            self.new_binary = archive_patch.pack(self.new_binary, archive)
+
+    def _remove_patch_files(self):
+        # Cleans up spooled patches & intermediate binaries
+        if self.low_memory is False:
+            return
+        for p in self.patch_data:
+            if os.path.exists(p['patch_name']):
+                os.remove(p['patch_name'])
+        filename = self._get_update_filename()
+        for ext in ['.patching', '.patched']:
+            if os.path.exists(filename + ext):
+                os.remove(filename + ext)
+
+    def _download_patch(self, patch):
+        # Downloads & verifies a single patch. Runs in a worker thread.
+        with self._download_lock:
+            if self._downloads_cancelled is True:
+                return None
+            # Initialize downloader
+            fd = FileDownloader(patch['patch_name'], patch['patch_urls'],
+                                patch['patch_hash'], self.verify,
+                                mirrors=self.mirrors,
+                                http_pool=self.http_pool)
+            self._downloaders.append(fd)
+
+        # Attempt to download resource
+        try:
+            if self.low_memory is True:
+                # Patch is spooled to disk. The filename is
+                # passed on in place of the patch data.
+                if fd.download_verify_write() is True:
+                    data = patch['patch_name']
+                else:
+                    data = None
+            else:
+                data = fd.download_verify_return()
+        except Exception as err:
+            log.debug(str(err), exc_info=True)
+            data = None
+
+        if data is None:
+            log.debug('Failed to download {}'.format(patch['patch_name']))
+            # No need to wait on the other patches
+            self._cancel_downloads()
+            return None
+
+        with self._download_lock:
+            self._downloaded += 1
+            status = {'total': len(self.patch_data),
+                      'downloaed': self._downloaded,
+                      'status': 'downloading'}
+            self._call_progress_hooks(status)
+        return data
+
+    def _cancel_downloads(self):
+        # Stops all running patch downloads & any that haven't started
+        with self._download_lock:
+            if self._downloads_cancelled is True:
+                return
+            log.debug('Cancelling patch downloads')
+            self._downloads_cancelled = True
+            for fd in self._downloaders:
+                fd.cancel()
+
     def _call_progress_hooks(self, data):
         for ph in self.progress_hooks:
             try:
@@ -243,22 +480,8 @@ class Patcher(object):
                 log.error('Exception in callback: '
                           '{}'.format(ph.__name__))
 
-    def _apply_patches_in_memory(self):
-        # Applies a sequence of patches in memory
-        log.debug('Applying patches')
-        self.new_binary = self.og_binary
-        for i in self.patch_binary_data:
-            try:
-                self.new_binary = bsdiff4.patch(self.new_binary, i)
-                log.debug('Applied patch successfully')
-            except Exception as err:
-                log.debug(err, exc_info=True)
-                log.error(err)
-                raise PatcherError('Patch failed to apply')
-
-    def _write_update_to_disk(self):  # pragma: no cover
-        # Writes updated binary to disk
-        log.debug('Writing update to disk')
+    def _get_update_filename(self):
+        # Returns filename of the newest version
         filename_key = '{}*{}*{}*{}*{}'.format(settings.UPDATES_KEY, self.name,
                                                self.highest_version,
                                                self.platform,
@@ -267,13 +490,27 @@ class Patcher(object):
         filename = self.star_access_update_data.get(filename_key)
         if filename is None:
             raise PatcherError('Filename missing in version file')
+        return filename
+
+    def _write_update_to_disk(self):  # pragma: no cover
+        # Writes updated binary to disk
+        log.debug('Writing update to disk')
+        filename = self._get_update_filename()
 
         with jms_utils.paths.ChDir(self.update_folder):
             try:
-                with open(filename, 'wb') as f:
-                    f.write(self.new_binary)
+                if self.low_memory is True:
+                    # Binary was patched on disk. Just move it into place
+                    if self.new_filename == self.current_filename:
+                        raise PatcherError('No patches were applied')
+                    if os.path.exists(filename):
+                        os.remove(filename)
+                    os.rename(self.new_filename, filename)
+                else:
+                    with open(filename, 'wb') as f:
+                        f.write(self.new_binary)
                 log.debug('Wrote update file')
-            except IOError:
+            except (IOError, OSError):
                 # Removes file if it got created
                 if os.path.exists(filename):
                     os.remove(filename)
@@ -285,10 +522,20 @@ class Patcher(object):
 
                 new_file_hash = file_info['file_hash']
                 log.debug('checking file hash match')
+                # Always hashed. The file was just written so a
+                # cached hash could be stale.
                 if new_file_hash != get_package_hashes(filename):
                     log.error('File hash does not match')
                     os.remove(filename)
                     raise PatcherError('Bad hash on patched file')
+                if self.hash_cache is not None:
+                    self.hash_cache.add(filename, new_file_hash)
+
+    def _get_file_hash(self, filename):
+        # Only hashes filename if it changed since last time
+        if self.hash_cache is not None:
+            return self.hash_cache.get_hash(filename)
+        return get_package_hashes(filename)
 
     def _current_file_info(self, name, version):
         # Returns filename and hash for given name and version
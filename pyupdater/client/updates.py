@@ -21,9 +21,9 @@ from pyupdater.client.downloader import FileDownloader
 from pyupdater.client.patcher import Patcher
 from pyupdater import settings
 from pyupdater.utils import (get_filename,
-                             get_hash,
                              get_highest_version,
                              get_mac_dot_app_dir,
+                             get_package_hashes,
                              lazy_import,
                              Version)
 from pyupdater.utils.exceptions import ClientError, UtilsError, VersionError
@@ -90,6 +90,14 @@ class LibUpdate(object):
         data (dict): Info dict
     """
 
+    # Used to estimate if patching is cheaper then a full download.
+    # Bytes per second of the binary bsdiff4 can patch
+    patch_apply_rate = 1024 * 1024 * 50
+
+    # Used when nothing is known about the update urls yet
+    default_ttfb = 0.5
+    default_throughput = 1024 * 1024
+
     def __init__(self, data):
         self.updates_key = settings.UPDATES_KEY
         self.update_urls = data.get('update_urls')
@@ -105,6 +113,13 @@ class LibUpdate(object):
         self.update_folder = os.path.join(self.data_dir,
                                           settings.UPDATE_FOLDER)
         self.verify = data.get('verify', True)
+        self.max_download_segments = data.get('max_download_segments', 1)
+        self.max_concurrent_downloads = data.get('max_concurrent_downloads',
+                                                 1)
+        self.low_memory_patching = data.get('low_memory_patching', False)
+        self.mirrors = data.get('mirrors')
+        self.http_pool = data.get('http_pool')
+        self.hash_cache = data.get('hash_cache')
         self.current_app_dir = os.path.dirname(sys.argv[0])
         self.status = False
         # If user is using async download this will be True.
@@ -162,7 +177,6 @@ class LibUpdate(object):
                     self.status = True
                     log.info('Patch download successful')
                 else:
-                    log.error('Patch update failed')
                     log.info('Starting full download')
                     update_success = self._full_update(self.name)
                     if update_success:
@@ -264,12 +278,14 @@ class LibUpdate(object):
             if not os.path.exists(filename):
                 return False
             try:
-                with open(filename, 'rb') as f:
-                    data = f.read()
+                if self.hash_cache is not None:
+                    file_hash = self.hash_cache.get_hash(filename)
+                else:
+                    file_hash = get_package_hashes(filename)
             except Exception as err:
                 log.debug(err, exc_info=True)
                 return False
-            if _hash == get_hash(data):
+            if _hash == file_hash:
                 return True
             else:
                 return False
@@ -297,12 +313,62 @@ class LibUpdate(object):
                     current_version=version, highest_version=latest,
                     update_folder=self.update_folder,
                     update_urls=self.update_urls, verify=self.verify,
-                    progress_hooks=self.progress_hooks)
+                    progress_hooks=self.progress_hooks,
+                    mirrors=self.mirrors, http_pool=self.http_pool,
+                    max_concurrent_downloads=self.max_concurrent_downloads,
+                    low_memory=self.low_memory_patching,
+                    hash_cache=self.hash_cache)
+
+        # A long patch chain can cost more then the full archive
+        if self._full_update_is_cheaper(name, latest, p) is True:
+            log.info('Full update is cheaper then patching')
+            return False
 
         # Returns True if everything went well
         # If False is returned then we will just do the full
         # update.
-        return p.start()
+        if p.start() is True:
+            return True
+        log.error('Patch update failed')
+        return False
+
+    def _full_update_is_cheaper(self, name, latest, patcher):
+        # Estimates how long patching & a full download would take.
+        # Transfer time is based on the best known update url. Patches
+        # are applied while downloading so only the slower of the two
+        # counts. Version files without sizes always patch first.
+        size_key = '{}*{}*{}*{}*{}'.format(self.updates_key, name,
+                                           latest, self.platform,
+                                           'file_size')
+        full_size = self.easy_data.get(size_key)
+        if full_size is None:
+            log.debug('No archive size in version file')
+            return False
+        patch_sizes = patcher.get_patch_sizes()
+        if patch_sizes is None:
+            log.debug('No patch sizes in version file')
+            return False
+
+        ttfb, throughput = None, None
+        if self.mirrors is not None:
+            ttfb, throughput = self.mirrors.estimate(self.update_urls)
+        if ttfb is None:
+            ttfb = self.default_ttfb
+        if not throughput:
+            throughput = self.default_throughput
+
+        # Requests for patches overlap
+        requests = len(patch_sizes) / float(max(self.max_concurrent_downloads,
+                                                1))
+        transfer_time = sum(patch_sizes) / float(throughput)
+        # Every patch is applied to a binary about the size of the archive
+        apply_time = len(patch_sizes) * full_size / \
+            float(self.patch_apply_rate)
+        patch_time = max(requests, 1) * ttfb + max(transfer_time, apply_time)
+        full_time = ttfb + full_size / float(throughput)
+        log.debug('Estimated patch time: {:.2f}s Full download time: '
+                  '{:.2f}s'.format(patch_time, full_time))
+        return full_time < patch_time
 
     # Starting full update
     def _full_update(self, name):
@@ -319,10 +385,16 @@ class LibUpdate(object):
         with jms_utils.paths.ChDir(self.update_folder):
             log.info('Downloading update...')
             fd = FileDownloader(filename, self.update_urls,
-                                file_hash, self.verify, self.progress_hooks)
+                                file_hash, self.verify, self.progress_hooks,
+                                max_segments=self.max_download_segments,
+                                mirrors=self.mirrors,
+                                http_pool=self.http_pool)
             result = fd.download_verify_write()
             if result:
                 log.info('Download Complete')
+                # Hash was just verified. No need to read it again.
+                if self.hash_cache is not None and file_hash is not None:
+                    self.hash_cache.add(filename, file_hash)
                 return True
             else:  # pragma: no cover
                 log.error('Failed To Download Latest Version')
@@ -350,9 +422,16 @@ class LibUpdate(object):
         with jms_utils.paths.ChDir(self.update_folder):
             temp = os.listdir(os.getcwd())
             for t in temp:
+                # Partial downloads & their resume info are versioned
+                # by the archive they belong to
+                archive_name = t
+                if archive_name.endswith('.part.json'):
+                    archive_name = archive_name[:-5]
+                if archive_name.endswith('.part'):
+                    archive_name = archive_name[:-5]
                 try:
-                    old_version = Version(t)
-                except UtilsError:  # pragma: no cover
+                    old_version = Version(archive_name)
+                except (UtilsError, VersionError):  # pragma: no cover
                     log.warning('Cannot parse version info')
                     # Skip file since we can't parse
                     continue
@@ -17,8 +17,9 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 from pyupdater import settings
-from pyupdater.utils import lazy_import
+from pyupdater.utils import get_hash, lazy_import
 from pyupdater.utils.keydb import KeyDB
+from pyupdater.utils.manifest import make_delta
 
 
 @lazy_import
@@ -27,6 +28,12 @@ def gzip():
     return gzip
 
 
+@lazy_import
+def io():
+    import io
+    return io
+
+
 @lazy_import
 def json():
     import json
@@ -76,6 +83,9 @@ class KeyHandler(object):
         db (dict): Framework metadata
     """
 
+    # Number of older version files clients can get a delta from
+    delta_history = 10
+
     def __init__(self, app=None, db=None):
         self.key_encoding = 'base64'
         if app is not None:
@@ -93,6 +103,8 @@ class KeyHandler(object):
         self.app_name = obj.get('APP_NAME')
         self.private_key_name = self.app_name + '.pem'
         self.public_key_name = self.app_name + '.pub'
+        # Also write a signed index & one shard per app & platform
+        self.shard_version_file = obj.get('SHARD_VERSION_FILE', False)
         data_dir = obj.get('DATA_DIR', os.getcwd())
         self.db = db
         self.keysdb = KeyDB(db)
@@ -100,6 +112,9 @@ class KeyHandler(object):
         self.deploy_dir = os.path.join(self.data_dir, 'deploy')
         self.version_file = os.path.join(self.deploy_dir,
                                          settings.VERSION_FILE)
+        self.history_dir = os.path.join(data_dir,
+                                        settings.CONFIG_DATA_FOLDER,
+                                        settings.VERSION_FILE_HISTORY_FOLDER)
 
     def make_keys(self, count=3):
         """Makes public and private keys for signing and verification
@@ -170,8 +185,26 @@ class KeyHandler(object):
         if 'sigs' in update_data:
             log.debug('Removing signatures from version file')
             del update_data['sigs']
+        # Goes up with every signed version file. Clients use it to
+        # ask for the changes since the version file they have.
+        update_data['serial'] = update_data.get('serial', 0) + 1
         update_data_str = json.dumps(update_data, sort_keys=True)
+        signatures = self._sign(update_data_str, private_keys)
 
+        og_data = json.loads(update_data_str)
+        update_data = og_data.copy()
+        # Add signatures to update data
+        update_data['sigs'] = signatures
+        log.info('Adding sig to update data')
+        # Write updated version file to filesystem
+        version_data = self._write_update_data(og_data, update_data)
+        self._write_detached_sig(version_data, private_keys)
+        self._write_deltas(og_data, signatures)
+        if self.shard_version_file is True:
+            self._write_shards(og_data, private_keys)
+
+    def _sign(self, data_str, private_keys):
+        # Returns a signature of data_str from each private key
         signatures = []
         for p in private_keys:
             if six.PY2 is True and isinstance(p, unicode) is True:
@@ -180,18 +213,59 @@ class KeyHandler(object):
             log.debug('Key type: {}'.format(type(p)))
             privkey = ed25519.SigningKey(p, encoding=self.key_encoding)
             # Signs update data with private key
-            sig = privkey.sign(six.b(update_data_str),
+            sig = privkey.sign(six.b(data_str),
                                encoding=self.key_encoding)
             log.debug('Sig: {}'.format(sig))
             signatures.append(sig)
-
-        og_data = json.loads(update_data_str)
-        update_data = og_data.copy()
-        # Add signatures to update data
-        update_data['sigs'] = signatures
-        log.info('Adding sig to update data')
-        # Write updated version file to filesystem
-        self._write_update_data(og_data, update_data)
+        return signatures
+
+    def _write_shards(self, data, private_keys):
+        # Splits the version file by app & platform. The signed index
+        # has the hash of each shard, so clients only download shards
+        # that changed.
+        shards = {}
+        for name, versions in data.get(settings.UPDATES_KEY, {}).items():
+            for version, platforms in versions.items():
+                for platform, info in platforms.items():
+                    key = (name, platform)
+                    if key not in shards:
+                        latest = data.get('latest', {}).get(name, {})
+                        shards[key] = {
+                            settings.UPDATES_KEY: {name: {}},
+                            'latest': {name: {}}}
+                        if platform in latest:
+                            shards[key]['latest'][name][platform] = \
+                                latest[platform]
+                    shards[key][settings.UPDATES_KEY][name][version] = \
+                        {platform: info}
+
+        index = {'serial': data.get('serial'), 'shards': {}}
+        for (name, platform), shard in shards.items():
+            shard_str = json.dumps(shard, sort_keys=True)
+            shard['sigs'] = self._sign(shard_str, private_keys)
+            filename = settings.VERSION_FILE_SHARD.format(name, platform)
+            shard_data = self._gzip(json.dumps(shard, sort_keys=True))
+            with open(os.path.join(self.deploy_dir, filename), 'wb') as f:
+                f.write(shard_data)
+            index['shards'].setdefault(name, {})[platform] = {
+                'filename': filename,
+                'file_hash': get_hash(shard_data)}
+
+        index_str = json.dumps(index, sort_keys=True)
+        index['sigs'] = self._sign(index_str, private_keys)
+        with open(os.path.join(self.deploy_dir,
+                               settings.VERSION_FILE_INDEX), 'wb') as f:
+            f.write(self._gzip(json.dumps(index, sort_keys=True)))
+        log.info('Created version file shards in deploy dir')
+
+    @staticmethod
+    def _gzip(data):
+        # No timestamp so unchanged shards keep the same hash
+        f = io.BytesIO()
+        with gzip.GzipFile(filename='', mode='wb', fileobj=f,
+                           mtime=0) as gz:
+            gz.write(six.b(data))
+        return f.getvalue()
 
     def _write_update_data(self, data, version):
         # Save update data to repo database
@@ -199,9 +273,62 @@ class KeyHandler(object):
         log.debug('Saved version meta data')
 
         # Gzip update date
+        version_data = json.dumps(version, indent=2, sort_keys=True)
         with gzip.open(self.version_file, 'wb') as f:
-            f.write(json.dumps(version, indent=2, sort_keys=True))
+            f.write(version_data)
         log.info('Created gzipped version manifest in deploy dir')
+        return version_data
+
+    def _write_detached_sig(self, version_data, private_keys):
+        # Signs the hash of the version file bytes as written, so
+        # clients don't have to parse & dump it again to check it
+        file_hash = get_hash(six.b(version_data))
+        sig_data = {'file_hash': file_hash,
+                    'sigs': self._sign(file_hash, private_keys)}
+        with open(os.path.join(self.deploy_dir,
+                               settings.VERSION_FILE_SIG), 'w') as f:
+            f.write(json.dumps(sig_data, sort_keys=True))
+        log.info('Created version file signature in deploy dir')
+
+    def _write_deltas(self, data, signatures):
+        # Writes the changes from each recent version file to data.
+        # Deltas carry the signatures of data, so clients check the
+        # version file they rebuild the same as a downloaded one.
+        if not os.path.exists(self.history_dir):
+            os.makedirs(self.history_dir)
+        serial = data['serial']
+        with gzip.open(self._get_history_path(serial), 'wb') as f:
+            f.write(json.dumps(data, sort_keys=True))
+
+        serials = []
+        for f in os.listdir(self.history_dir):
+            if f.endswith('.json.gz'):
+                serials.append(int(f.split('.')[0]))
+        serials.sort()
+        # Clients with older version files need the full file.
+        # Their old deltas are replaced so they aren't used anymore.
+        expired = serials[:-(self.delta_history + 1)]
+        for s in expired:
+            self._write_delta(s, {'from_serial': s, 'expired': True})
+            os.remove(self._get_history_path(s))
+
+        for s in serials[len(expired):]:
+            with gzip.open(self._get_history_path(s), 'rb') as f:
+                old_data = json.loads(f.read())
+            delta = make_delta(old_data, data)
+            delta['from_serial'] = s
+            delta['serial'] = serial
+            delta['sigs'] = signatures
+            self._write_delta(s, delta)
+        log.info('Created version file deltas in deploy dir')
+
+    def _write_delta(self, serial, delta):
+        filename = settings.VERSION_FILE_DELTA.format(serial)
+        with gzip.open(os.path.join(self.deploy_dir, filename), 'wb') as f:
+            f.write(json.dumps(delta, sort_keys=True))
+
+    def _get_history_path(self, serial):
+        return os.path.join(self.history_dir, '{}.json.gz'.format(serial))
 
     def _load_update_data(self):
         log.debug("Loading version data")
@@ -16,23 +16,27 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import json
 import logging
 import multiprocessing
+from multiprocessing.pool import ThreadPool
+from multiprocessing.queues import SimpleQueue
 import os
 import shutil
-
-try:  # pragma: no cover
-    import bsdiff4
-except ImportError:  # pragma: no cover
-    bsdiff4 = None
+import tempfile
+import time
 
 from pyupdater import settings
 from pyupdater.utils import (EasyAccessDict,
+                             get_hash,
                              get_package_hashes as gph,
                              lazy_import,
-                             remove_dot_files
+                             remove_dot_files,
+                             Version
                              )
-from pyupdater.utils.exceptions import PackageHandlerError
+from pyupdater.utils import archive_patch
+from pyupdater.utils.diff_engines import get_engine
+from pyupdater.utils.exceptions import PackageHandlerError, UtilsError
 from pyupdater.utils.package import Package, Patch
 
 log = logging.getLogger(__name__)
@@ -77,6 +81,22 @@ class PackageHandler(object):
         else:
             log.info('Patch support disabled')
             self.patch_support = False
+        # Every Nth release is kept to make skip patches from
+        self.skip_patch_interval = obj.get('SKIP_PATCH_INTERVAL', 0)
+        # Number of most recent anchors skip patches are made from
+        self.skip_patch_anchors = obj.get('SKIP_PATCH_ANCHORS', 3)
+        # Name of the diff engine used to create patches
+        self.patch_engine = obj.get('PATCH_ENGINE')
+        try:
+            get_engine(self.patch_engine)
+        except UtilsError as err:
+            raise PackageHandlerError(str(err), expected=True)
+        # Patch the uncompressed data of archives
+        self.archive_patches = obj.get('ARCHIVE_PATCHES', False)
+        # Max MB of memory patch creation may use at once
+        self.patch_memory_budget = obj.get('PATCH_MEMORY_BUDGET')
+        if self.patch_memory_budget is None:
+            self.patch_memory_budget = _get_default_memory_budget()
         data_dir = obj.get('DATA_DIR', os.getcwd())
         self.db = db
         self.data_dir = os.path.join(data_dir, settings.USER_DATA_FOLDER)
@@ -85,6 +105,8 @@ class PackageHandler(object):
         self.new_dir = os.path.join(self.data_dir, 'new')
         self.config_dir = os.path.join(os.path.dirname(self.data_dir),
                                        settings.CONFIG_DATA_FOLDER)
+        self.patch_cache_dir = os.path.join(self.config_dir,
+                                            settings.PATCH_CACHE_FOLDER)
         self.config = None
         self.json_data = None
 
@@ -120,6 +142,28 @@ class PackageHandler(object):
         self._write_json_to_file(self.json_data)
         self._write_config_to_file(self.config)
         self._move_packages(package_manifest)
+        self._prune_patch_cache(self.json_data)
+
+    def _prune_patch_cache(self, json_data):
+        # Removes cached patches from or to archives that aren't in
+        # the version file anymore
+        if not os.path.exists(self.patch_cache_dir):
+            return
+        hashes = set()
+        for versions in json_data.get(settings.UPDATES_KEY, {}).values():
+            for platforms in versions.values():
+                for info in platforms.values():
+                    hashes.add(info.get('file_hash'))
+        for f in os.listdir(self.patch_cache_dir):
+            parts = f.split('.')[0].split('-')
+            if len(parts) == 3 and parts[0] in hashes and \
+                    parts[1] in hashes:
+                continue
+            log.debug('Removing cached patch {}'.format(f))
+            try:
+                os.remove(os.path.join(self.patch_cache_dir, f))
+            except OSError as err:
+                log.debug(str(err), exc_info=True)
 
     def _setup_work_dirs(self):
         # Sets up work dirs on dev machine.  Creates the following folder
@@ -128,11 +172,12 @@ class PackageHandler(object):
         #    - New - for new updates that need to be signed
         #    - Deploy - All files ready to upload are placed here.
         #    - Files - All updates are placed here for future reference
+        # Patches are cached in the config folder for reuse
         #
         # This is non destructive
         dirs = [self.data_dir, self.new_dir,
                 self.deploy_dir, self.files_dir,
-                self.config_dir]
+                self.config_dir, self.patch_cache_dir]
         for d in dirs:
             if not os.path.exists(d):
                 log.info('Creating dir: {}'.format(d))
@@ -171,23 +216,30 @@ class PackageHandler(object):
         patch_manifest = list()
         bad_packages = list()
         with jms_utils.paths.ChDir(self.new_dir):
-            # Getting a list of all files in the new dir
-            packages = os.listdir(os.getcwd())
-            for p in packages:
-                # On package initialization we do the following
+            # Getting a list of all files in the new dir. Sorted so
+            # the version file is updated in the same order every time.
+            packages = sorted(os.listdir(os.getcwd()))
+            # Hashing is the slow part so it's done concurrently.
+            # Hashlib releases the GIL so threads are enough.
+            pool = ThreadPool(processes=self._get_worker_count())
+            try:
+                package_info = pool.map(_get_package_info, packages)
+            finally:
+                pool.close()
+                pool.join()
+            # Results are merged in order
+            for p, package in zip(packages, package_info):
+                # On package initialization _get_package_info does
                 # 1. Check for a supported archive
                 # 2. get required info: version, platform, hash
                 # If any check fails package.info['status'] will be False
                 # You can query package.info['reason'] for the reason
-                package = Package(p)
                 if package.info['status'] is False:
                     # Package failed at something
                     # package.info['reason'] will tell why
                     bad_packages.append(package)
                     continue
 
-                # Add package hash
-                package.file_hash = gph(package.filename)
                 self.json_data = self._update_file_list(self.json_data,
                                                         package)
 
@@ -213,9 +265,21 @@ class PackageHandler(object):
                                           patch_name=os.path.join(self.new_dir,
                                                                   patch_name),
                                           patch_num=patch_number,
-                                          package=package.filename)
+                                          package=package.filename,
+                                          dst_hash=package.file_hash)
+                        # Anchors are kept to make future skip patches
+                        anchors = self._get_anchors(self.json_data,
+                                                    package.name,
+                                                    package.platform)
+                        self._remove_old_anchors(self.json_data, package,
+                                                 anchors, path[2])
+                        if path[2] in anchors:
+                            patch_info['keep_src'] = True
                         # ready for patching
                         patch_manifest.append(patch_info)
+                        patch_manifest += self._get_skip_patches(
+                            self.json_data, package, anchors, path[2],
+                            os.path.abspath(p))
                     else:
                         log.warning('No source file to patch from')
 
@@ -258,27 +322,121 @@ class PackageHandler(object):
             return
         log.info('Cleaning up files directory')
         for p in patch_manifest:
+            # Anchors are needed for future skip patches
+            if p.get('keep_src') is True:
+                continue
             if os.path.exists(p['src']):
                 basename = os.path.basename(p['src'])
                 log.info('Removing {}'.format(basename))
                 os.remove(p['src'])
 
-    def _make_patches(self, patch_manifest):
-        pool_output = list()
-        if len(patch_manifest) < 1:
-            return pool_output
-        log.info('Starting patch creation')
+    @staticmethod
+    def _get_worker_count():
         try:
             cpu_count = multiprocessing.cpu_count() * 2
         except Exception as err:
             log.debug(str(err), exc_info=True)
             log.warning('Cannot get cpu count from os. Using default 2')
             cpu_count = 2
+        return cpu_count
 
-        pool = multiprocessing.Pool(processes=cpu_count)
-        pool_output = pool.map(_make_patch, patch_manifest)
+    def _make_patches(self, patch_manifest):
+        # Creates patches in worker processes. bsdiff needs many times
+        # the size of the source file in memory, so jobs are only
+        # started while their estimated memory fits the budget.
+        # Largest jobs go first so they don't run alone at the end.
+        pool_output = list()
+        if len(patch_manifest) < 1:
+            return pool_output
+        log.info('Starting patch creation')
+        cpu_count = self._get_worker_count()
+        budget = self.patch_memory_budget * 1024 * 1024
+
+        engine = get_engine(self.patch_engine)
+        for p in patch_manifest:
+            p['cache_dir'] = self.patch_cache_dir
+            p['patch_engine'] = engine.name
+            p['archive_patches'] = self.archive_patches
+        jobs = [(_estimate_patch_memory(p), i, p)
+                for i, p in enumerate(patch_manifest)]
+        jobs.sort(key=lambda j: j[0], reverse=True)
+        total = len(jobs)
+        results = [None] * total
+        running = {}
+        started = 0
+        done = 0
+        # Workers say which process runs each job, so jobs of
+        # killed workers can be found. SimpleQueue writes right away
+        # so it works even if the worker dies next.
+        started_jobs = SimpleQueue()
+        workers = {}
+        lost = False
+
+        pool = multiprocessing.Pool(processes=cpu_count,
+                                    initializer=_init_patch_worker,
+                                    initargs=(started_jobs,))
+        try:
+            while len(jobs) > 0 or len(running) > 0:
+                used = sum([m for m, r in running.values()])
+                for job in list(jobs):
+                    if len(running) >= cpu_count:
+                        break
+                    memory, index, patch_info = job
+                    # A job bigger then the budget runs on its own
+                    if used + memory > budget and len(running) > 0:
+                        continue
+                    jobs.remove(job)
+                    used += memory
+                    started += 1
+                    log.info('Starting patch {} of {}: {} ({} MB '
+                             'estimated)'.format(started, total,
+                                                 patch_info['package'],
+                                                 memory // 1048576))
+                    result = pool.apply_async(_make_patch_job,
+                                              (index, patch_info))
+                    running[index] = (memory, result)
+
+                index, patch, error = self._wait_for_patch(running,
+                                                           started_jobs,
+                                                           workers)
+                del running[index]
+                if error == _WORKER_DIED:
+                    lost = True
+                if error is not None:
+                    log.error('Failed to create patch for {}: '
+                              '{}'.format(patch_manifest[index]['package'],
+                                          error))
+                results[index] = patch
+                done += 1
+                log.info('Finished patch {} of {}'.format(done, total))
+        finally:
+            # The pool waits forever for results of killed workers
+            if lost is True or len(running) > 0:
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+        pool_output = [r for r in results if r is not None]
         return pool_output
 
+    @staticmethod
+    def _wait_for_patch(running, started_jobs, workers):
+        # Blocks until a patch job finishes or its worker dies. Killed
+        # workers, i.e. out of memory, never return a result. Their
+        # jobs fail so a full update is used. Uses a timeout so
+        # ctrl-c still works
+        while 1:
+            while not started_jobs.empty():
+                index, pid = started_jobs.get()
+                workers[index] = pid
+            alive = set([p.pid for p in multiprocessing.active_children()])
+            for index, (memory, result) in running.items():
+                if result.ready():
+                    return result.get()
+                if index in workers and workers[index] not in alive:
+                    return index, None, _WORKER_DIED
+            time.sleep(0.1)
+
     def _add_patches_to_packages(self, package_manifest, patches):
         # ToDo: Increase the efficiency of this double for
         #       loop. Not sure if it can be done though
@@ -294,14 +452,33 @@ class PackageHandler(object):
                 for pm in package_manifest:
                     #
                     if p.dst_filename == pm.filename:
-                        pm.patch_info['patch_name'] = \
-                            os.path.basename(p.patch_name)
                         # Don't try to get hash on a ghost file
                         if not os.path.exists(p.patch_name):
                             p_name = ''
+                            p_size = None
                         else:
                             p_name = gph(p.patch_name)
+                            p_size = os.path.getsize(p.patch_name)
+                        if p.src_version is not None:
+                            # Skip patch from an older anchor version
+                            skip = {'src': p.src_version,
+                                    'patch_name':
+                                        os.path.basename(p.patch_name),
+                                    'patch_hash': p_name,
+                                    'patch_size': p_size,
+                                    'patch_engine': p.patch_engine}
+                            if p.archive is not None:
+                                skip['patch_archive'] = p.archive
+                            if 'skip_patches' not in pm.patch_info:
+                                pm.patch_info['skip_patches'] = []
+                            pm.patch_info['skip_patches'].append(skip)
+                            break
+                        pm.patch_info['patch_name'] = \
+                            os.path.basename(p.patch_name)
                         pm.patch_info['patch_hash'] = p_name
+                        pm.patch_info['patch_size'] = p_size
+                        pm.patch_info['patch_engine'] = p.patch_engine
+                        pm.patch_info['patch_archive'] = p.archive
                         # No need to keep searching
                         # We have the info we need for this patch
                         break
@@ -323,9 +500,23 @@ class PackageHandler(object):
             # Converting info to format compatible for version file
             info = {'file_hash': p.file_hash,
                     'filename': p.filename}
+            if p.file_size is not None:
+                info['file_size'] = p.file_size
             if patch_name and patch_hash:
                 info['patch_name'] = patch_name
                 info['patch_hash'] = patch_hash
+                patch_size = p.patch_info.get('patch_size')
+                if patch_size is not None:
+                    info['patch_size'] = patch_size
+                info['patch_engine'] = p.patch_info.get('patch_engine')
+                patch_archive = p.patch_info.get('patch_archive')
+                if patch_archive is not None:
+                    info['patch_archive'] = patch_archive
+            # Patches straight from older anchor versions
+            skip_patches = [sp for sp in p.patch_info.get('skip_patches', [])
+                            if sp['patch_hash']]
+            if len(skip_patches) > 0:
+                info['skip_patches'] = skip_patches
 
             version_key = '{}*{}*{}'.format(settings.UPDATES_KEY,
                                             p.name, p.version)
@@ -370,9 +561,13 @@ class PackageHandler(object):
             return
         log.info('Moving packages to deploy folder')
         for p in package_manifest:
-            patch = p.patch_info.get('patch_name')
+            patches = [p.patch_info.get('patch_name')]
+            for sp in p.patch_info.get('skip_patches', []):
+                patches.append(sp['patch_name'])
             with jms_utils.paths.ChDir(self.new_dir):
-                if patch:
+                for patch in patches:
+                    if not patch:
+                        continue
                     if os.path.exists(os.path.join(self.deploy_dir, patch)):
                         os.remove(os.path.join(self.deploy_dir, patch))
                     log.debug('Moving {} to {}'.format(patch,
@@ -410,8 +605,10 @@ class PackageHandler(object):
         # make patch updates
         # Also calculates patch number
         log.info('Checking if patch creation is possible')
-        if bsdiff4 is None:
-            log.warning('Bsdiff is missing. Cannot create patches')
+        engine = get_engine(self.patch_engine)
+        if engine.available is False:
+            log.warning('{} is missing. Cannot create '
+                        'patches'.format(engine.name))
             return None
         src_file_path = None
         if os.path.exists(self.files_dir):
@@ -434,25 +631,234 @@ class PackageHandler(object):
                 return None
             src_file_path = os.path.join(self.files_dir, filename)
 
+            num = self._get_patch_number(name)
+            return src_file_path, num, latest
+        return None
+
+    def _get_patch_number(self, name):
+        # Gets the next patch number for name
+        try:
+            patch_num = self.config['patches'][name]
+            self.config['patches'][name] += 1
+        except KeyError:
+            # If no patch number we will start at 100
+            try:
+                patch_num = self.config['boot_strap']
+            except KeyError:
+                patch_num = 100
+            if 'patches' not in self.config.keys():
+                self.config['patches'] = {}
+            if name not in self.config['patches'].keys():
+                self.config['patches'][name] = patch_num + 1
+        num = patch_num + 1
+        log.debug('Patch Number: {}'.format(num))
+        return num
+
+    def _get_anchors(self, json_data, name, platform):
+        # Every Nth release of name & platform is an anchor.
+        # Anchor archives stay in the files dir so patches can be
+        # made from them straight to newer versions. Clients far
+        # behind then apply a few patches instead of one per release.
+        if self.skip_patch_interval < 1:
+            return []
+        versions = json_data[settings.UPDATES_KEY].get(name, {})
+        versions = [v for v in versions.keys()
+                    if platform in versions[v].keys()]
+        versions = sorted(versions, key=Version)
+        anchors = versions[::self.skip_patch_interval]
+        # Only the most recent anchors are used, so build time & the
+        # number of patches don't grow with the version history
+        return anchors[max(len(anchors) - self.skip_patch_anchors, 0):]
+
+    def _remove_old_anchors(self, json_data, package, anchors, latest):
+        # Archives of versions that aren't anchors anymore are removed.
+        # Latest is removed after its regular patch is made.
+        versions = json_data[settings.UPDATES_KEY].get(package.name, {})
+        for version, platforms in versions.items():
+            if version in anchors or version == latest:
+                continue
+            filename = platforms.get(package.platform, {}).get('filename')
+            if filename is None:
+                continue
+            path = os.path.join(self.files_dir, filename)
+            if os.path.exists(path):
+                log.info('Removing old anchor {}'.format(filename))
+                os.remove(path)
+
+    def _get_skip_patches(self, json_data, package, anchors, latest, dst):
+        # Creates patch info for skip patches from each anchor
+        # to package. The latest version already gets a regular patch.
+        skip_patches = []
+        for anchor in anchors:
+            if anchor == latest:
+                continue
             try:
-                patch_num = self.config['patches'][name]
-                self.config['patches'][name] += 1
+                platforms = json_data[settings.UPDATES_KEY][package.name]
+                filename = platforms[anchor][package.platform]['filename']
             except KeyError:
-                # If no patch number we will start at 100
-                try:
-                    patch_num = self.config['boot_strap']
-                except KeyError:
-                    patch_num = 100
-                if 'patches' not in self.config.keys():
-                    self.config['patches'] = {}
-                if name not in self.config['patches'].keys():
-                    self.config['patches'][name] = patch_num + 1
-            num = patch_num + 1
-            log.debug('Patch Number: {}'.format(num))
-            return src_file_path, num
+                continue
+            src_path = os.path.join(self.files_dir, filename)
+            if not os.path.exists(src_path):
+                log.debug('Anchor archive missing: {}'.format(filename))
+                continue
+            log.info('Found anchor {} to create skip patch'.format(anchor))
+            patch_name = package.name + '-' + package.platform
+            skip_patches.append(dict(src=src_path, dst=dst,
+                                     patch_name=os.path.join(self.new_dir,
+                                                             patch_name),
+                                     patch_num=self._get_patch_number(
+                                         package.name),
+                                     package=package.filename,
+                                     dst_hash=package.file_hash,
+                                     src_version=anchor,
+                                     keep_src=True))
+        return skip_patches
+
+
+def _get_package_info(filename):
+    # Gets meta-data & hash of a package. Used with a thread pool
+    package = Package(filename)
+    if package.info['status'] is True:
+        package.file_hash = gph(package.filename)
+        # Lets clients compare patch & full download cost
+        package.file_size = os.path.getsize(package.filename)
+    return package
+
+
+def _get_default_memory_budget():
+    # Half of physical memory in MB. 2048 if it can't be found
+    try:
+        memory = os.sysconf(str('SC_PAGE_SIZE')) * \
+            os.sysconf(str('SC_PHYS_PAGES'))
+    except (AttributeError, ValueError, OSError):
+        return 2048
+    return max(memory // 2 // 1048576, 1)
+
+
+def _estimate_patch_memory(patch_info):
+    # Bytes of memory the diff engine needs for this patch.
+    # Archive patches diff the uncompressed data.
+    archive = 'src' in patch_info and 'dst' in patch_info and \
+        _use_archive_patch(patch_info)
+    sizes = []
+    for key in ['src', 'dst']:
+        try:
+            if archive is True:
+                sizes.append(archive_patch.get_size(patch_info[key]))
+            else:
+                sizes.append(os.path.getsize(patch_info[key]))
+        except (KeyError, IOError, OSError, UtilsError):
+            sizes.append(0)
+    engine = get_engine(patch_info.get('patch_engine'))
+    return engine.estimate_memory(sizes[0], sizes[1])
+
+
+# Queue patch workers report the jobs they start to
+_started_jobs = None
+
+# Error of jobs whose worker process died
+_WORKER_DIED = 'Worker process died'
+
+
+def _init_patch_worker(started_jobs):
+    global _started_jobs
+    _started_jobs = started_jobs
+
+
+def _make_patch_job(index, patch_info):
+    # Runs _make_patch in a worker process. Errors are returned so
+    # one bad patch doesn't stop the rest.
+    if _started_jobs is not None:
+        _started_jobs.put((index, os.getpid()))
+    try:
+        return index, _make_patch(patch_info), None
+    except Exception as err:
+        return index, None, str(err)
+
+
+def _get_patch_cache_path(patch_info):
+    # Patches are cached by the hash of src, dst & the diff engine.
+    # The same files always give the same patch. Hashes of src & dst
+    # are kept in the name so old patches can be pruned.
+    cache_dir = patch_info.get('cache_dir')
+    if cache_dir is None:
+        return None
+    engine = get_engine(patch_info.get('patch_engine'))
+    key = '{}-{}'.format(engine.name, engine.version)
+    if _use_archive_patch(patch_info):
+        key += '-archive'
+    dst_hash = patch_info.get('dst_hash')
+    if dst_hash is None:
+        dst_hash = gph(patch_info['dst'])
+    name = '{}-{}-{}'.format(gph(patch_info['src']), dst_hash,
+                             get_hash(key.encode('utf-8')))
+    return os.path.join(cache_dir, name)
+
+
+def _get_cached_archive_info(cache_path):
+    # Archive info is kept next to the cached patch
+    try:
+        with open(cache_path + '.json', 'r') as f:
+            return json.loads(f.read()).get('archive')
+    except (IOError, OSError, ValueError):
         return None
 
 
+def _add_patch_to_cache(patch_path, cache_path, archive=None):
+    # Copied to a temp file first so a half written patch is
+    # never used
+    temp_path = cache_path + '.tmp'
+    try:
+        cache_dir = os.path.dirname(cache_path)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        if archive is not None:
+            with open(cache_path + '.json', 'w') as f:
+                f.write(json.dumps({'archive': archive}))
+        shutil.copy(patch_path, temp_path)
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        os.rename(temp_path, cache_path)
+    except (IOError, OSError) as err:
+        log.debug(str(err), exc_info=True)
+        log.warning('Cannot add patch to cache')
+
+
+def _use_archive_patch(patch_info):
+    # Archive patches need both files in the same supported format
+    if patch_info.get('archive_patches') is not True:
+        return False
+    src_format = archive_patch.get_format(patch_info['src'])
+    dst_format = archive_patch.get_format(patch_info['dst'])
+    return src_format is not None and src_format == dst_format
+
+
+def _make_archive_patch(engine, src_path, dst_path, patch_path):
+    # Diffs the uncompressed data of both archives. Returns the info
+    # a client needs to rebuild dst_path. If dst_path can't be rebuilt
+    # byte for byte no patch is made & None is returned.
+    temp_dir = tempfile.mkdtemp(dir=os.path.dirname(patch_path))
+    try:
+        src_data = os.path.join(temp_dir, 'src')
+        dst_data = os.path.join(temp_dir, 'dst')
+        rebuilt = os.path.join(temp_dir, 'rebuilt')
+        try:
+            archive_patch.unpack_file(src_path, src_data)
+            archive = archive_patch.unpack_file(dst_path, dst_data)
+        except UtilsError as err:
+            log.debug(str(err), exc_info=True)
+            return None
+        archive_patch.pack_file(dst_data, rebuilt, archive)
+        if gph(rebuilt) != gph(dst_path):
+            log.info('Cannot rebuild {}. Making regular '
+                     'patch'.format(os.path.basename(dst_path)))
+            return None
+        engine.file_diff(src_data, dst_data, patch_path)
+        return archive
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
 def _make_patch(patch_info):
     # Does with the name implies. Used with multiprocessing
     patch = Patch(patch_info)
@@ -470,11 +876,27 @@ def _make_patch(patch_info):
         log.debug('Patch source path:{}'.format(src_path))
         log.debug('Patch destination path: {}'.format(dst_path))
         if patch.ready is True:
+            cache_path = _get_patch_cache_path(patch_info)
+            if cache_path is not None and os.path.exists(cache_path):
+                log.info('Using cached patch... '
+                         '{}'.format(os.path.basename(patch_name)))
+                shutil.copy(cache_path, patch.patch_name)
+                patch.archive = _get_cached_archive_info(cache_path)
+                return patch
             log.info("Creating patch... "
                      "{}".format(os.path.basename(patch_name)))
-            bsdiff4.file_diff(src_path, patch.dst_path, patch.patch_name)
+            engine = get_engine(patch.patch_engine)
+            if _use_archive_patch(patch_info):
+                patch.archive = _make_archive_patch(engine, src_path,
+                                                    patch.dst_path,
+                                                    patch.patch_name)
+            if patch.archive is None:
+                engine.file_diff(src_path, patch.dst_path, patch.patch_name)
             base_name = os.path.basename(patch_name)
             log.info('Done creating patch... {}'.format(base_name))
+            if cache_path is not None:
+                _add_patch_to_cache(patch.patch_name, cache_path,
+                                    patch.archive)
         else:
             log.error('Missing patch attr')
     return patch
@@ -24,6 +24,10 @@ CONFIG_DATA_FOLDER = '.pyupdater'
 # User config file
 CONFIG_FILE_USER = 'pyuconfig.db'
 
+# Folder in CONFIG_DATA_FOLDER where created patches are kept
+# for reuse
+PATCH_CACHE_FOLDER = 'patch-cache'
+
 CONFIG_DB_KEY_APP_CONFIG = 'app_config'
 CONFIG_DB_KEY_KEYS = 'signing_keys'
 CONFIG_DB_KEY_VERSION_META = 'version_meta'
@@ -54,6 +58,42 @@ UPDATES_KEY = 'updates'
 # Folder on client system where updates are stored
 UPDATE_FOLDER = 'update'
 
+# File on client system where mirror performance is kept
+MIRROR_SCORES_FILE = 'mirrors.json'
+
+# File on client system where hashes of update archives are kept
+HASH_CACHE_FILE = 'hashes.json'
+
 # Name of version file place in online repo
 VERSION_FILE = 'versions.gz'
+
+# Signature of the uncompressed version file bytes as uploaded
+VERSION_FILE_SIG = 'versions.sig'
+
+# Changes to the version file since an older version file.
+# Formatted with the serial of the older version file
+VERSION_FILE_DELTA = 'versions-delta-{}.gz'
+
+# Signed list of version file shards
+VERSION_FILE_INDEX = 'versions-index.gz'
+
+# Part of the version file for one app on one platform.
+# Formatted with name & platform
+VERSION_FILE_SHARD = 'versions-{}-{}.gz'
+
+# Folder on client system where version file shards are kept
+VERSION_FILE_SHARD_FOLDER = 'version-shards'
+
+# Folder in CONFIG_DATA_FOLDER where recent version files are kept
+# to make deltas from
+VERSION_FILE_HISTORY_FOLDER = 'version-history'
+
+# File on client system with the validators & digest of the
+# downloaded version file
+VERSION_FILE_VALIDATORS = 'versions-validators.json'
+
+# File on client system where the checked version data is kept
+# in a format that loads faster then the version file
+VERSION_FILE_CACHE = 'versions.cache'
+
 VERSION_FILE_OLD = 'version.json'
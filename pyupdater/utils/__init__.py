@@ -87,6 +87,12 @@ class _LazyImport(object):
         return bool(self._pyu_lazy_target)
 
 
+@lazy_import
+def binascii():
+    import binascii
+    return binascii
+
+
 @lazy_import
 def bz2():
     import bz2
@@ -105,6 +111,12 @@ def hashlib():
     return hashlib
 
 
+@lazy_import
+def mmap():
+    import mmap
+    return mmap
+
+
 @lazy_import
 def os():
     import os
@@ -129,6 +141,12 @@ def StringIO():
     return StringIO
 
 
+@lazy_import
+def struct():
+    import struct
+    return struct
+
+
 @lazy_import
 def subprocess():
     import subprocess
@@ -283,6 +301,57 @@ def get_mac_dot_app_dir(directory):
     return os.path.dirname(os.path.dirname(os.path.dirname(directory)))
 
 
+# Bytes read at a time when hashing files
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def get_file_hashes(filename, algorithms=None, use_mmap=False):
+    """Hashes a file one chunk at a time. Memory usage stays the same
+    regardless of file size. Several digests are made in one pass.
+
+    Args:
+
+        filename (str): Name of file to hash
+
+    Kwargs:
+
+        algorithms (list): Names of hashlib algorithms. Default sha256
+
+        use_mmap (bool) Meaning:
+
+            True: Map the file into memory instead of reading it
+
+            False: Read the file
+
+    Returns:
+
+        (dict): Hex digest of each algorithm
+    """
+    if algorithms is None:
+        algorithms = ['sha256']
+    hashers = [(a, hashlib.new(a)) for a in algorithms]
+    filename = os.path.abspath(filename)
+    with open(filename, 'rb') as f:
+        # Empty files cannot be mapped
+        if use_mmap is True and os.path.getsize(filename) > 0:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for i in range(0, len(data), HASH_CHUNK_SIZE):
+                    chunk = data[i:i + HASH_CHUNK_SIZE]
+                    for _, h in hashers:
+                        h.update(chunk)
+            finally:
+                data.close()
+        else:
+            while 1:
+                chunk = f.read(HASH_CHUNK_SIZE)
+                if len(chunk) == 0:
+                    break
+                for _, h in hashers:
+                    h.update(chunk)
+    return dict((a, h.hexdigest()) for a, h in hashers)
+
+
 def get_package_hashes(filename):
     """Provides hash of given filename.
 
@@ -295,11 +364,7 @@ def get_package_hashes(filename):
         (str): sha256 hash
     """
     log.debug('Getting package hashes')
-    filename = os.path.abspath(filename)
-    with open(filename, 'rb') as f:
-        data = f.read()
-
-    _hash = hashlib.sha256(data).hexdigest()
+    _hash = get_file_hashes(filename)['sha256']
     log.debug('Hash for file {}: {}'.format(filename, _hash))
     return _hash
 
@@ -617,6 +682,133 @@ def _decode_offt(bytes):
     return x
 
 
+def _decode_control(data):
+    """Decode all control tuples of a patch in one go.
+
+    Each tuple is 3 off_t values. Values are unpacked in bulk as
+    unsigned little endian then converted from sign-magnitude.
+    """
+    count = len(data) // 24 * 3
+    values = struct.unpack(str('<{}Q'.format(count)), data[:count * 8])
+    sign = 1 << 63
+    values = [v if v < sign else -(v - sign) for v in values]
+    return list(zip(values[0::3], values[1::3], values[2::3]))
+
+
+def _get_numpy():
+    # Numpy is optional. Only used to speed up bsdiff4_py if found.
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+# Bytes added per big int in _add_bytes
+_ADD_CHUNK_SIZE = 1024 * 256
+
+
+def _add_bytes(diff_data, orig_data):
+    """Adds two equal length byte strings byte by byte, mod 256.
+
+    Uses numpy if available. Otherwise each chunk is turned into one
+    big int & all bytes are added at once. The high bit of each byte
+    is masked off so carries can't spill into the next byte, then
+    put back with xor.
+    """
+    if len(diff_data) != len(orig_data):
+        raise ValueError('Patch reads past end of source')
+    if len(diff_data) == 0:
+        return b''
+    numpy = _get_numpy()
+    if numpy is not None:
+        result = numpy.frombuffer(diff_data, numpy.uint8) + \
+            numpy.frombuffer(orig_data, numpy.uint8)
+        return result.tobytes()
+
+    result = []
+    masks = {}
+    for i in range(0, len(diff_data), _ADD_CHUNK_SIZE):
+        diff_chunk = diff_data[i:i + _ADD_CHUNK_SIZE]
+        orig_chunk = orig_data[i:i + _ADD_CHUNK_SIZE]
+        length = len(diff_chunk)
+        if length not in masks:
+            masks[length] = (int('7f' * length, 16), int('80' * length, 16))
+        low, high = masks[length]
+        if sys.version_info[0] < 3:
+            a = int(binascii.hexlify(diff_chunk), 16)
+            b = int(binascii.hexlify(orig_chunk), 16)
+        else:
+            a = int.from_bytes(diff_chunk, 'big')
+            b = int.from_bytes(orig_chunk, 'big')
+        added = ((a & low) + (b & low)) ^ ((a ^ b) & high)
+        if sys.version_info[0] < 3:
+            hex_str = '{:0{}x}'.format(added, length * 2)
+            result.append(binascii.unhexlify(hex_str))
+        else:
+            result.append(added.to_bytes(length, 'big'))
+    return b''.join(result)
+
+
+class _BZ2Reader(object):
+    """Reads a bz2 compressed section of a file a little at a time.
+
+    Args:
+
+        f (file): File object positioned at the start of the section
+
+        length (int): Compressed size of the section. None reads to
+        the end of the file.
+    """
+
+    # Compressed bytes decompressed at once. Kept small since a
+    # block of zeros can decompress to many times its size.
+    read_size = 4096
+
+    def __init__(self, f, length=None):
+        self._file = f
+        self._remaining = length
+        self._decompressor = bz2.BZ2Decompressor()
+        self._buffer = b''
+        self._pos = 0
+
+    def read(self, size):
+        "Returns up to size decompressed bytes"
+        pieces = []
+        while size > 0:
+            if self._pos >= len(self._buffer):
+                if self._fill() is False:
+                    break
+            piece = self._buffer[self._pos:self._pos + size]
+            self._pos += len(piece)
+            size -= len(piece)
+            pieces.append(piece)
+        return b''.join(pieces)
+
+    def _fill(self):
+        # Decompresses more data into the buffer
+        while 1:
+            size = self.read_size
+            if self._remaining is not None:
+                size = min(size, self._remaining)
+            if size == 0:
+                return False
+            data = self._file.read(size)
+            if len(data) == 0:
+                return False
+            if self._remaining is not None:
+                self._remaining -= len(data)
+            try:
+                data = self._decompressor.decompress(data)
+            except EOFError:
+                # Past the end of the compressed stream
+                return False
+            if len(data) > 0:
+                self._buffer = data
+                self._pos = 0
+                return True
+
+
 class bsdiff4_py(object):
     """Pure-python version of bsdiff4 module that can only patch, not diff.
 
@@ -625,7 +817,7 @@ class bsdiff4_py(object):
     the patch-applying algorithm is very simple.
     """
     @staticmethod
-    def patch(source, patch):  # pragma: no cover
+    def patch(source, patch):
         #  Read the length headers
         l_bcontrol = _decode_offt(patch[8:16])
         l_bdiff = _decode_offt(patch[16:24])
@@ -636,32 +828,90 @@ class bsdiff4_py(object):
         bdiff = bz2.decompress(patch[e_bcontrol:e_bdiff])
         bextra = bz2.decompress(patch[e_bdiff:])
         #  Decode the control tuples
-        tcontrol = []
-        for i in xrange(0, len(bcontrol), 24):
-            tcontrol.append((
-                _decode_offt(bcontrol[i:i+8]),
-                _decode_offt(bcontrol[i+8:i+16]),
-                _decode_offt(bcontrol[i+16:i+24]),
-            ))
+        tcontrol = _decode_control(bcontrol)
         #  Actually do the patching.
-        #  This is the bdiff4 patch algorithm in slow, pure python.
-        source = six.BytesIO(source)
-        result = six.BytesIO()
-        bdiff = six.BytesIO(bdiff)
-        bextra = six.BytesIO(bextra)
+        #  Diff data is added to the source a whole control block
+        #  at a time instead of byte by byte.
+        result = []
+        src_pos = 0
+        diff_pos = 0
+        extra_pos = 0
         for (x, y, z) in tcontrol:
-            diff_data = bdiff.read(x)
-            orig_data = source.read(x)
-            if sys.version_info[0] < 3:
-                for i in xrange(len(diff_data)):
-                    result.write(chr((ord(diff_data[i]) +
-                                 ord(orig_data[i])) % 256))
-            else:
-                for i in xrange(len(diff_data)):
-                    result.write(bytes([(diff_data[i] + orig_data[i]) % 256]))
-            result.write(bextra.read(y))
-            source.seek(z, os.SEEK_CUR)
-        return result.getvalue()
+            result.append(_add_bytes(bdiff[diff_pos:diff_pos + x],
+                                     source[src_pos:src_pos + x]))
+            diff_pos += x
+            result.append(bextra[extra_pos:extra_pos + y])
+            extra_pos += y
+            src_pos += x + z
+        return b''.join(result)
+
+    # Bytes of output produced at once by file_patch
+    block_size = 1024 * 1024
+
+    @staticmethod
+    def file_patch(src_path, dst_path, patch_path):
+        """Applies patch_path to src_path & writes the result to dst_path.
+
+        Control, diff & extra data are decompressed a little at a time
+        and the output is written in blocks, so memory usage stays the
+        same regardless of file size.
+
+        Args:
+
+            src_path (str): Path to file to patch
+
+            dst_path (str): Path to write patched file to
+
+            patch_path (str): Path to bsdiff4 patch
+        """
+        with open(patch_path, 'rb') as f:
+            header = f.read(32)
+        l_bcontrol = _decode_offt(header[8:16])
+        l_bdiff = _decode_offt(header[16:24])
+
+        # Each section is read with its own file handle
+        control_file = open(patch_path, 'rb')
+        diff_file = open(patch_path, 'rb')
+        extra_file = open(patch_path, 'rb')
+        try:
+            control_file.seek(32)
+            diff_file.seek(32 + l_bcontrol)
+            extra_file.seek(32 + l_bcontrol + l_bdiff)
+            control = _BZ2Reader(control_file, l_bcontrol)
+            bdiff = _BZ2Reader(diff_file, l_bdiff)
+            bextra = _BZ2Reader(extra_file)
+            with open(src_path, 'rb') as src:
+                with open(dst_path, 'wb') as dst:
+                    bsdiff4_py._stream_patch(src, dst, control, bdiff,
+                                             bextra)
+        finally:
+            control_file.close()
+            diff_file.close()
+            extra_file.close()
+
+    @staticmethod
+    def _stream_patch(src, dst, control, bdiff, bextra):
+        # Applies control tuples one block at a time
+        block_size = bsdiff4_py.block_size
+        while 1:
+            data = control.read(24 * 1024)
+            if len(data) == 0:
+                break
+            if len(data) % 24 != 0:
+                raise ValueError('Corrupt patch')
+            for (x, y, z) in _decode_control(data):
+                while x > 0:
+                    size = min(x, block_size)
+                    dst.write(_add_bytes(bdiff.read(size), src.read(size)))
+                    x -= size
+                while y > 0:
+                    size = min(y, block_size)
+                    extra = bextra.read(size)
+                    if len(extra) != size:
+                        raise ValueError('Corrupt patch')
+                    dst.write(extra)
+                    y -= size
+                src.seek(z, os.SEEK_CUR)
 
 
 class EasyAccessDict(object):
@@ -0,0 +1,254 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+# Patches of compressed archives are made from the uncompressed data,
+# since one changed byte scrambles the rest of a gzip stream. The
+# client unpacks the old archive, patches it & packs it again. Packing
+# must give the exact same bytes the archive had, so only archives
+# that can be rebuilt that way get archive patches.
+from __future__ import unicode_literals
+
+import binascii
+import io
+import logging
+import struct
+import zlib
+
+from pyupdater.utils.exceptions import UtilsError
+
+log = logging.getLogger(__name__)
+
+# Archive formats archive patches can be made for
+FORMATS = ['tar.gz']
+
+# Gzip header flags
+_FHCRC = 2
+_FEXTRA = 4
+_FNAME = 8
+_FCOMMENT = 16
+
+# Bytes read & written at once
+_CHUNK_SIZE = 1024 * 64
+
+
+def get_format(filename):
+    """Gets the archive format of filename
+
+    Args:
+
+        filename (str): Archive filename
+
+    Returns:
+
+        (str) Meanings:
+
+            Format - One of FORMATS
+
+            None - Archive patches aren't supported for filename
+    """
+    for f in FORMATS:
+        if filename.endswith('.' + f):
+            return f
+    return None
+
+
+def get_size(filename):
+    """Gets the uncompressed size of archive filename from its gzip
+    trailer without reading the whole file.
+
+    Args:
+
+        filename (str): Path to archive
+
+    Returns:
+
+        (int): Bytes. The trailer only keeps the size mod 4GB, so it's
+        never less then the size of the archive itself.
+
+    Raises:
+
+        UtilsError: Not a gzip file
+    """
+    with open(filename, 'rb') as f:
+        if f.read(3) != b'\x1f\x8b\x08':
+            raise UtilsError('Not a gzip file')
+        f.seek(-4, 2)
+        size = struct.unpack(str('<I'), _read_exact(f, 4))[0]
+        return max(size, f.tell())
+
+
+def _read_exact(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise UtilsError('Truncated gzip file')
+    return data
+
+
+def _read_header(f):
+    # Returns the gzip header as is, so it can be written again
+    header = _read_exact(f, 10)
+    if header[:3] != b'\x1f\x8b\x08':
+        raise UtilsError('Not a gzip file')
+    flags = struct.unpack(str('<B'), header[3:4])[0]
+    if flags & _FEXTRA:
+        extra_len = _read_exact(f, 2)
+        header += extra_len + _read_exact(
+            f, struct.unpack(str('<H'), extra_len)[0])
+    for flag in (_FNAME, _FCOMMENT):
+        if flags & flag:
+            while 1:
+                c = _read_exact(f, 1)
+                header += c
+                if c == b'\x00':
+                    break
+    if flags & _FHCRC:
+        header += _read_exact(f, 2)
+    return header
+
+
+def _get_level(header):
+    # Extra flags byte says if max or fastest compression was used
+    xfl = struct.unpack(str('<B'), header[8:9])[0]
+    if xfl == 4:
+        return 1
+    if xfl == 2:
+        return 9
+    return 6
+
+
+def _unpack_stream(src, dst):
+    # Writes the uncompressed data of gzip file src to dst.
+    # Returns archive info needed to pack it again.
+    header = _read_header(src)
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    crc = 0
+    size = 0
+    while 1:
+        data = src.read(_CHUNK_SIZE)
+        if len(data) == 0:
+            raise UtilsError('Truncated gzip file')
+        data = decompressor.decompress(data)
+        crc = zlib.crc32(data, crc)
+        size += len(data)
+        dst.write(data)
+        if len(decompressor.unused_data) > 0:
+            break
+    data = decompressor.flush()
+    crc = zlib.crc32(data, crc)
+    size += len(data)
+    dst.write(data)
+    # Only a single member with nothing after it can be rebuilt
+    trailer = decompressor.unused_data + src.read()
+    if len(trailer) != 8:
+        raise UtilsError('Unsupported gzip file')
+    if trailer != struct.pack(str('<II'), crc & 0xffffffff,
+                              size & 0xffffffff):
+        raise UtilsError('Corrupt gzip file')
+    return {'format': 'tar.gz',
+            'gzip_header': binascii.hexlify(header).decode('ascii'),
+            'gzip_level': _get_level(header)}
+
+
+def _pack_stream(src, dst, archive):
+    # Writes src to dst as a gzip file, the same way the gzip &
+    # tarfile modules do
+    if archive.get('format') not in FORMATS:
+        raise UtilsError('Unsupported archive format')
+    dst.write(binascii.unhexlify(archive['gzip_header']))
+    compressor = zlib.compressobj(archive['gzip_level'], zlib.DEFLATED,
+                                  -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, 0)
+    crc = 0
+    size = 0
+    while 1:
+        data = src.read(_CHUNK_SIZE)
+        if len(data) == 0:
+            break
+        crc = zlib.crc32(data, crc)
+        size += len(data)
+        dst.write(compressor.compress(data))
+    dst.write(compressor.flush())
+    dst.write(struct.pack(str('<II'), crc & 0xffffffff, size & 0xffffffff))
+
+
+def unpack_file(src_path, dst_path):
+    """Writes the uncompressed data of archive src_path to dst_path
+
+    Args:
+
+        src_path (str): Path to archive
+
+        dst_path (str): Path to write uncompressed data to
+
+    Returns:
+
+        (dict): Archive info used to pack the data again
+
+    Raises:
+
+        UtilsError: Archive can't be unpacked
+    """
+    with open(src_path, 'rb') as src:
+        with open(dst_path, 'wb') as dst:
+            return _unpack_stream(src, dst)
+
+
+def pack_file(src_path, dst_path, archive):
+    """Packs uncompressed data src_path into archive dst_path
+
+    Args:
+
+        src_path (str): Path to uncompressed data
+
+        dst_path (str): Path to write archive to
+
+        archive (dict): Archive info from unpack_file
+    """
+    with open(src_path, 'rb') as src:
+        with open(dst_path, 'wb') as dst:
+            _pack_stream(src, dst, archive)
+
+
+def unpack(data):
+    """Same as unpack_file but in memory
+
+    Args:
+
+        data (bytes): Archive
+
+    Returns:
+
+        (bytes): Uncompressed data
+    """
+    dst = io.BytesIO()
+    _unpack_stream(io.BytesIO(data), dst)
+    return dst.getvalue()
+
+
+def pack(data, archive):
+    """Same as pack_file but in memory
+
+    Args:
+
+        data (bytes): Uncompressed data
+
+        archive (dict): Archive info from unpack_file
+
+    Returns:
+
+        (bytes): Archive
+    """
+    dst = io.BytesIO()
+    _pack_stream(io.BytesIO(data), dst, archive)
+    return dst.getvalue()
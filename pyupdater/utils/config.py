@@ -133,5 +133,22 @@ SetupConfig = {
     'COMPANY_NAME': settings.GENERIC_APP_NAME,
 
     # Support for patch updates
-    'UPDATE_PATCHES': True
+    'UPDATE_PATCHES': True,
+
+    # Make patches straight to the newest version from every
+    # Nth release. 0 to disable
+    'SKIP_PATCH_INTERVAL': 0,
+
+    # Skip patches are only made from the N most recent anchors
+    'SKIP_PATCH_ANCHORS': 3,
+
+    # Diff engine used to create patches. bsdiff4 or blockdelta
+    'PATCH_ENGINE': 'bsdiff4',
+
+    # Patch the uncompressed data of .tar.gz archives
+    'ARCHIVE_PATCHES': False,
+
+    # Also upload a signed index & one version file shard per
+    # app & platform
+    'SHARD_VERSION_FILE': False
     }
@@ -0,0 +1,381 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import logging
+import mmap
+import os
+import struct
+import zlib
+
+try:
+    import bsdiff4
+except ImportError:  # pragma: no cover
+    bsdiff4 = None
+
+from pyupdater.utils import _BZ2Reader, bsdiff4_py
+from pyupdater.utils.exceptions import UtilsError
+
+log = logging.getLogger(__name__)
+
+# Engine used when a patch doesn't say which one made it
+DEFAULT_ENGINE = 'bsdiff4'
+
+
+class DiffEngine(object):
+    """Creates & applies patches. Subclasses are registered in ENGINES
+    by name. The name is saved with each patch in the version manifest
+    so the client knows how to apply it.
+    """
+
+    name = None
+
+    # False if patches can't be created on this system
+    available = True
+
+    @property
+    def version(self):
+        "Changes when patches made by this engine change"
+        raise NotImplementedError
+
+    def estimate_memory(self, src_size, dst_size):
+        """Bytes of memory needed to create a patch
+
+        Args:
+
+            src_size (int): Size of old file
+
+            dst_size (int): Size of new file
+
+        Returns:
+
+            (int): Bytes
+        """
+        return src_size + dst_size
+
+    def file_diff(self, src_path, dst_path, patch_path):
+        """Creates a patch from src_path to dst_path
+
+        Args:
+
+            src_path (str): Path to old file
+
+            dst_path (str): Path to new file
+
+            patch_path (str): Path to write patch to
+        """
+        raise NotImplementedError
+
+    def patch(self, source, patch):
+        """Applies patch to source in memory
+
+        Args:
+
+            source (bytes): Old file
+
+            patch (bytes): Patch
+
+        Returns:
+
+            (bytes): New file
+        """
+        raise NotImplementedError
+
+    def file_patch(self, src_path, dst_path, patch_path):
+        """Applies patch_path to src_path without loading either into
+        memory.
+
+        Args:
+
+            src_path (str): Path to old file
+
+            dst_path (str): Path to write new file to
+
+            patch_path (str): Path to patch
+        """
+        raise NotImplementedError
+
+
+class Bsdiff4Engine(DiffEngine):
+    "Patches made with bsdiff4. Small patches but slow to create."
+
+    name = 'bsdiff4'
+
+    available = bsdiff4 is not None
+
+    @property
+    def version(self):
+        if bsdiff4 is None:  # pragma: no cover
+            return None
+        return getattr(bsdiff4, '__version__', None)
+
+    def estimate_memory(self, src_size, dst_size):
+        # Suffix sorting needs about 9x the source size
+        return src_size * 9 + dst_size
+
+    def file_diff(self, src_path, dst_path, patch_path):
+        if bsdiff4 is None:  # pragma: no cover
+            raise UtilsError('bsdiff4 is required to create patches',
+                             expected=True)
+        bsdiff4.file_diff(src_path, dst_path, patch_path)
+
+    def patch(self, source, patch):
+        if bsdiff4 is None:  # pragma: no cover
+            return bsdiff4_py.patch(source, patch)
+        return bsdiff4.patch(source, patch)
+
+    def file_patch(self, src_path, dst_path, patch_path):
+        # bsdiff4.file_patch loads both files & the result into
+        # memory. Only the pure python version streams them.
+        bsdiff4_py.file_patch(src_path, dst_path, patch_path)
+
+
+class _ZlibReader(_BZ2Reader):
+    "Reads a zlib compressed section of a file a little at a time."
+
+    def __init__(self, f, length=None):
+        super(_ZlibReader, self).__init__(f, length)
+        self._decompressor = zlib.decompressobj()
+
+
+def _open_map(f):
+    # Memory maps f so only the pages in use are kept in memory.
+    # Empty files can't be mapped.
+    if os.fstat(f.fileno()).st_size == 0:
+        return b''
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _match_length(a, a_pos, b, b_pos, limit):
+    # Number of equal bytes from a_pos & b_pos. Slices are compared
+    # so most of the work is done in C.
+    length = 0
+    size = 4096
+    while length < limit:
+        size = min(size, limit - length)
+        if a[a_pos + length:a_pos + length + size] == \
+                b[b_pos + length:b_pos + length + size]:
+            length += size
+            size *= 2
+        elif size == 1:
+            break
+        else:
+            # Narrow down where the difference is
+            size //= 2
+    return length
+
+
+class BlockDeltaEngine(DiffEngine):
+    """Patches made by matching blocks of the new file to blocks of the
+    old file. Much faster to create & uses a lot less memory then
+    bsdiff4, but patches are bigger when most of the file changed.
+
+    Every index_stride bytes of the old file are indexed by the hash of
+    the key_size bytes found there. Each position of the new file is
+    looked up in the index & matches are grown in both directions.
+    Both files are memory mapped.
+
+    The patch is a header followed by a zlib compressed list of copy &
+    insert instructions.
+    """
+
+    name = 'blockdelta'
+
+    # Bump when the patch format or matching changes
+    format_version = 1
+
+    header = b'PYUBDLT1'
+
+    # Bytes hashed at each position
+    key_size = 32
+
+    # Distance between indexed positions of the old file. Memory used
+    # by the index is about 100 bytes per stride.
+    index_stride = 256
+
+    # Bytes of output produced at once
+    block_size = 1024 * 1024
+
+    # Instructions
+    _END = 0
+    _COPY = 1
+    _INSERT = 2
+
+    @property
+    def version(self):
+        return str(self.format_version)
+
+    def estimate_memory(self, src_size, dst_size):
+        # Both files are memory mapped so only the index counts
+        return src_size // self.index_stride * 100
+
+    def file_diff(self, src_path, dst_path, patch_path):
+        with open(src_path, 'rb') as src_file:
+            with open(dst_path, 'rb') as dst_file:
+                src = _open_map(src_file)
+                dst = _open_map(dst_file)
+                try:
+                    with open(patch_path, 'wb') as patch_file:
+                        patch_file.write(self.header)
+                        compressor = zlib.compressobj(9)
+                        for data in self._diff(src, dst):
+                            patch_file.write(compressor.compress(data))
+                        patch_file.write(compressor.flush())
+                finally:
+                    for m in (src, dst):
+                        if isinstance(m, mmap.mmap):
+                            m.close()
+
+    def _index(self, src):
+        # Hash of key_size bytes -> first offset in src
+        index = {}
+        key_size = self.key_size
+        for pos in range(0, len(src) - key_size + 1, self.index_stride):
+            index.setdefault(hash(src[pos:pos + key_size]), pos)
+        return index
+
+    def _diff(self, src, dst):
+        # Yields encoded instructions that turn src into dst
+        index = self._index(src)
+        key_size = self.key_size
+        src_len = len(src)
+        dst_len = len(dst)
+        # Start of bytes not yet covered by an instruction
+        insert_pos = 0
+        pos = 0
+        last = dst_len - key_size
+        while pos <= last:
+            src_pos = index.get(hash(dst[pos:pos + key_size]))
+            if src_pos is None or \
+                    src[src_pos:src_pos + key_size] != \
+                    dst[pos:pos + key_size]:
+                pos += 1
+                continue
+            # Grow match backwards over bytes waiting to be inserted
+            back = 0
+            while back < pos - insert_pos and back < src_pos and \
+                    src[src_pos - back - 1] == dst[pos - back - 1]:
+                back += 1
+            forward = _match_length(src, src_pos + key_size,
+                                    dst, pos + key_size,
+                                    min(src_len - src_pos,
+                                        dst_len - pos) - key_size)
+            if pos - back > insert_pos:
+                yield self._encode_insert(dst[insert_pos:pos - back])
+            yield struct.pack(str('<BQQ'), self._COPY, src_pos - back,
+                              back + key_size + forward)
+            pos += key_size + forward
+            insert_pos = pos
+        if dst_len > insert_pos:
+            yield self._encode_insert(dst[insert_pos:dst_len])
+        yield struct.pack(str('<B'), self._END)
+
+    def _encode_insert(self, data):
+        return struct.pack(str('<BQ'), self._INSERT, len(data)) + data
+
+    def patch(self, source, patch):
+        if patch[:len(self.header)] != self.header:
+            raise UtilsError('Not a {} patch'.format(self.name))
+        data = zlib.decompress(patch[len(self.header):])
+        result = []
+        pos = 0
+        while 1:
+            op = struct.unpack(str('<B'), data[pos:pos + 1])[0]
+            pos += 1
+            if op == self._END:
+                break
+            elif op == self._COPY:
+                offset, length = struct.unpack(str('<QQ'),
+                                               data[pos:pos + 16])
+                pos += 16
+                if offset + length > len(source):
+                    raise UtilsError('Patch reads past end of source')
+                result.append(source[offset:offset + length])
+            elif op == self._INSERT:
+                length = struct.unpack(str('<Q'), data[pos:pos + 8])[0]
+                pos += 8
+                result.append(data[pos:pos + length])
+                pos += length
+            else:
+                raise UtilsError('Corrupt patch')
+        return b''.join(result)
+
+    def file_patch(self, src_path, dst_path, patch_path):
+        with open(patch_path, 'rb') as patch_file:
+            if patch_file.read(len(self.header)) != self.header:
+                raise UtilsError('Not a {} patch'.format(self.name))
+            reader = _ZlibReader(patch_file)
+            with open(src_path, 'rb') as src:
+                with open(dst_path, 'wb') as dst:
+                    self._stream_patch(reader, src, dst)
+
+    def _stream_patch(self, reader, src, dst):
+        # Applies instructions one block at a time
+        src_len = os.fstat(src.fileno()).st_size
+        while 1:
+            op = reader.read(1)
+            if len(op) == 0:
+                raise UtilsError('Corrupt patch')
+            op = struct.unpack(str('<B'), op)[0]
+            if op == self._END:
+                break
+            elif op == self._COPY:
+                offset, length = struct.unpack(str('<QQ'), reader.read(16))
+                if offset + length > src_len:
+                    raise UtilsError('Patch reads past end of source')
+                src.seek(offset)
+                stream = src
+            elif op == self._INSERT:
+                length = struct.unpack(str('<Q'), reader.read(8))[0]
+                stream = reader
+            else:
+                raise UtilsError('Corrupt patch')
+            while length > 0:
+                data = stream.read(min(length, self.block_size))
+                if len(data) == 0:
+                    raise UtilsError('Corrupt patch')
+                dst.write(data)
+                length -= len(data)
+
+
+ENGINES = {}
+for _engine in (Bsdiff4Engine(), BlockDeltaEngine()):
+    ENGINES[_engine.name] = _engine
+
+
+def get_engine(name=None):
+    """Gets a diff engine by name
+
+    Kwargs:
+
+        name (str): Name of engine. If None the default engine is
+        returned.
+
+    Returns:
+
+        (DiffEngine): Engine
+
+    Raises:
+
+        UtilsError: No engine with that name
+    """
+    if name is None:
+        name = DEFAULT_ENGINE
+    engine = ENGINES.get(name)
+    if engine is None:
+        raise UtilsError('Unknown diff engine: {}'.format(name),
+                         expected=True)
+    return engine
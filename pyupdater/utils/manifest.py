@@ -0,0 +1,93 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import logging
+
+from pyupdater.utils.exceptions import UtilsError
+
+log = logging.getLogger(__name__)
+
+
+def make_delta(old, new):
+    """Gets the changes that turn version file old into new
+
+    Args:
+
+        old (dict): Older version file data
+
+        new (dict): Newer version file data
+
+    Returns:
+
+        (dict): Keys set & deleted. Each key is given as a list with
+        the path of keys leading to it.
+    """
+    delta = {'set': [], 'delete': []}
+    _diff(old, new, [], delta)
+    return delta
+
+
+def _diff(old, new, path, delta):
+    for key in sorted(new.keys()):
+        value = new[key]
+        if key not in old:
+            delta['set'].append([path + [key], value])
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            _diff(old[key], value, path + [key], delta)
+        elif old[key] != value:
+            delta['set'].append([path + [key], value])
+    for key in sorted(old.keys()):
+        if key not in new:
+            delta['delete'].append(path + [key])
+
+
+def apply_delta(data, delta):
+    """Applies changes from make_delta to data
+
+    Args:
+
+        data (dict): Version file data. Changed in place
+
+        delta (dict): Changes from make_delta
+
+    Returns:
+
+        (dict): data
+
+    Raises:
+
+        UtilsError: Delta doesn't fit data
+    """
+    for path in delta.get('delete', []):
+        parent = _walk(data, path)
+        parent.pop(path[-1], None)
+    for path, value in delta.get('set', []):
+        parent = _walk(data, path)
+        parent[path[-1]] = value
+    return data
+
+
+def _walk(data, path):
+    # Returns the dict holding the last key in path.
+    # Missing dicts along the way are created.
+    if len(path) == 0:
+        raise UtilsError('Empty delta path')
+    for key in path[:-1]:
+        data = data.setdefault(key, {})
+        if not isinstance(data, dict):
+            raise UtilsError('Delta path not found: {}'.format(path))
+    return data
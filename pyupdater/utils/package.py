@@ -38,6 +38,13 @@ class Patch(object):
         self.dst_path = patch_info.get('dst')
         self.patch_name = patch_info.get('patch_name')
         self.dst_filename = patch_info.get('package')
+        # Version the patch starts from. Only set for skip patches
+        self.src_version = patch_info.get('src_version')
+        # Name of the diff engine that creates the patch
+        self.patch_engine = patch_info.get('patch_engine')
+        # Info needed to rebuild an archive from its uncompressed
+        # data. Only set for archive patches
+        self.archive = None
         self.ready = self._check_attrs()
 
     def _check_attrs(self):
@@ -70,6 +77,7 @@ class Package(object):
         self.version = None
         self.filename = filename
         self.file_hash = None
+        self.file_size = None
         self.platform = None
         self.info = dict(status=False, reason='')
         self.patch_info = {}
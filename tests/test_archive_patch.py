@@ -0,0 +1,86 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tarfile
+
+import pytest
+
+from pyupdater.utils import archive_patch
+from pyupdater.utils.exceptions import UtilsError
+
+
+@pytest.mark.usefixtures('cleandir')
+class TestArchivePatch(object):
+
+    def test_get_format(self):
+        assert archive_patch.get_format('app-mac-0.1.0.tar.gz') == 'tar.gz'
+        assert archive_patch.get_format('app-win-0.1.0.zip') is None
+
+    def test_rebuild_tarfile(self):
+        with open('app', 'wb') as f:
+            f.write(os.urandom(10000) + b'0' * 10000)
+        with tarfile.open('app.tar.gz', 'w:gz') as tar:
+            tar.add('app')
+        archive = archive_patch.unpack_file('app.tar.gz', 'app.tar')
+        archive_patch.pack_file('app.tar', 'rebuilt.tar.gz', archive)
+        with open('app.tar.gz', 'rb') as f:
+            data = f.read()
+        with open('rebuilt.tar.gz', 'rb') as f:
+            assert f.read() == data
+        assert archive_patch.pack(archive_patch.unpack(data),
+                                  archive) == data
+
+    def test_rebuild_make_archive(self):
+        os.mkdir('app')
+        with open(os.path.join('app', 'app'), 'wb') as f:
+            f.write(os.urandom(10000))
+        shutil.make_archive('app', 'gztar', os.getcwd(), 'app')
+        archive = archive_patch.unpack_file('app.tar.gz', 'app.tar')
+        archive_patch.pack_file('app.tar', 'rebuilt.tar.gz', archive)
+        with open('app.tar.gz', 'rb') as f:
+            data = f.read()
+        with open('rebuilt.tar.gz', 'rb') as f:
+            assert f.read() == data
+
+    def test_get_size(self):
+        with open('app', 'wb') as f:
+            f.write(b'0' * 100000)
+        with tarfile.open('app.tar.gz', 'w:gz') as tar:
+            tar.add('app')
+        archive_patch.unpack_file('app.tar.gz', 'app.tar')
+        assert archive_patch.get_size('app.tar.gz') == \
+            os.path.getsize('app.tar')
+        with pytest.raises(UtilsError):
+            archive_patch.get_size('app')
+
+    def test_not_gzip(self):
+        with open('app.tar.gz', 'wb') as f:
+            f.write(os.urandom(1000))
+        with pytest.raises(UtilsError):
+            archive_patch.unpack_file('app.tar.gz', 'app.tar')
+
+    def test_extra_data(self):
+        with open('app', 'wb') as f:
+            f.write(os.urandom(1000))
+        with tarfile.open('app.tar.gz', 'w:gz') as tar:
+            tar.add('app')
+        with open('app.tar.gz', 'ab') as f:
+            f.write(b'extra')
+        with pytest.raises(UtilsError):
+            archive_patch.unpack_file('app.tar.gz', 'app.tar')
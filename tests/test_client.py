@@ -16,16 +16,28 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import gzip
+import io
 import json
+import logging
 import os
 import shutil
 import time
 
 from jms_utils.system import get_system
 from jms_utils.paths import ChDir
+import ed25519
 import pytest
 
+from pyupdater import settings
+import pyupdater.client as client_module
 from pyupdater.client import Client
+from pyupdater.client.mirrors import MirrorScoreboard
+import pyupdater.client.updates as updates_module
+from pyupdater.client.updates import LibUpdate
+from pyupdater.key_handler import KeyHandler
+from pyupdater.utils import EasyAccessDict, get_hash
+from pyupdater.utils.storage import Storage
 from tconfig import TConfig
 
 
@@ -241,3 +253,460 @@ class TestExtract(object):
                     shutil.rmtree(f, ignore_errors=True)
         if get_system() != 'win':
             assert update.extract() is False
+
+
+class FakePatcher(object):
+
+    def __init__(self, sizes):
+        self.sizes = sizes
+
+    def get_patch_sizes(self):
+        return self.sizes
+
+    def start(self):
+        return False
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestPatchCost(object):
+
+    @pytest.fixture
+    def update(self):
+        mb = 1024 * 1024
+        json_data = {
+            'updates': {'jms': {
+                '0.0.1.2.0': {'mac': {'filename': 'jms-mac-0.0.1.zip'}},
+                '0.0.3.2.0': {'mac': {'filename': 'jms-mac-0.0.3.zip',
+                                      'file_size': 10 * mb}}}},
+            'latest': {'jms': {'mac': '0.0.3.2.0'}}}
+        mirrors = MirrorScoreboard()
+        mirrors.record_response('https://a.example.com/', 0.1)
+        mirrors.record_throughput('https://a.example.com/', mb, 1.0)
+        data = {'name': 'jms', 'version': '0.0.1.2.0',
+                'update_urls': ['https://a.example.com/'],
+                'json_data': json_data,
+                'easy_data': EasyAccessDict(json_data),
+                'data_dir': os.getcwd(), 'platform': 'mac',
+                'max_concurrent_downloads': 4,
+                'mirrors': mirrors}
+        return LibUpdate(data)
+
+    def test_small_patches(self, update):
+        patcher = FakePatcher([1024 * 100] * 2)
+        assert update._full_update_is_cheaper('jms', '0.0.3.2.0',
+                                              patcher) is False
+
+    def test_large_patch_chain(self, update):
+        patcher = FakePatcher([1024 * 1024] * 30)
+        assert update._full_update_is_cheaper('jms', '0.0.3.2.0',
+                                              patcher) is True
+
+    def test_no_sizes(self, update):
+        assert update._full_update_is_cheaper('jms', '0.0.3.2.0',
+                                              FakePatcher(None)) is False
+
+    def _download(self, update, monkeypatch, patcher):
+        if not os.path.exists(update.update_folder):
+            os.makedirs(update.update_folder)
+        with open(os.path.join(update.update_folder,
+                               'jms-mac-0.0.1.zip'), 'w') as f:
+            f.write('')
+        monkeypatch.setattr(updates_module, 'Patcher',
+                            lambda **kwargs: patcher)
+        monkeypatch.setattr(update, '_full_update', lambda name: True)
+        return update._download()
+
+    def test_download_cheaper_full_update(self, update, monkeypatch,
+                                          caplog):
+        caplog.set_level(logging.DEBUG)
+        patcher = FakePatcher([1024 * 1024] * 30)
+        assert self._download(update, monkeypatch, patcher) is True
+        assert 'Full update is cheaper' in caplog.text
+        assert 'Patch update failed' not in caplog.text
+
+    def test_download_patch_failed(self, update, monkeypatch, caplog):
+        caplog.set_level(logging.DEBUG)
+        patcher = FakePatcher([1024 * 100] * 2)
+        assert self._download(update, monkeypatch, patcher) is True
+        assert 'Patch update failed' in caplog.text
+
+
+def gzip_compress(data):
+    f = io.BytesIO()
+    with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+        gz.write(data)
+    return f.getvalue()
+
+
+class FakeManifestDownloader(object):
+    # Serves a version file. Answers not modified if given the
+    # validators it sent last.
+    data = None
+    requests = 0
+
+    def __init__(self, filename, urls, validators=None, **kwargs):
+        self.filename = filename
+        self.validators = validators
+        self.not_modified = False
+        self.response_validators = {urls[0] + filename:
+                                    {'etag': get_hash(self.data),
+                                     'last_modified': None}}
+
+    def download_verify_return(self):
+        if self.filename != settings.VERSION_FILE:
+            return None
+        FakeManifestDownloader.requests += 1
+        if self.validators == self.response_validators:
+            self.not_modified = True
+            return None
+        return gzip_compress(self.data)
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestConditionalManifest(object):
+
+    @pytest.fixture
+    def client(self, monkeypatch):
+        signing_key, verifying_key = ed25519.create_keypair()
+        data = {'updates': {}, 'latest': {}}
+        sig = signing_key.sign(json.dumps(data, sort_keys=True).encode(
+            'utf-8'), encoding='base64')
+        data['sigs'] = [sig.decode('utf-8')]
+        FakeManifestDownloader.data = json.dumps(data).encode('utf-8')
+        FakeManifestDownloader.requests = 0
+        monkeypatch.setattr(client_module, 'FileDownloader',
+                            FakeManifestDownloader)
+        t_config = TConfig()
+        t_config.DATA_DIR = os.getcwd()
+        t_config.PUBLIC_KEYS = [verifying_key.to_ascii(
+            encoding='base64').decode('utf-8')]
+        client = Client(t_config, test=True)
+        client.verify_calls = 0
+        verify_sig = client._verify_sig
+
+        def counting_verify(data):
+            client.verify_calls += 1
+            return verify_sig(data)
+        client._verify_sig = counting_verify
+        return client
+
+    def test_not_modified(self, client):
+        client.refresh()
+        assert client.verify_calls == 1
+        assert client.ready is True
+        client.refresh()
+        # Version file on disk was used without checking it again
+        assert FakeManifestDownloader.requests == 2
+        assert client.verify_calls == 1
+        assert client.verified is True
+        assert client.json_data == {'updates': {}, 'latest': {}}
+
+    def test_not_verified(self, client):
+        client.public_keys = []
+        client._verifying_keys = []
+        client.refresh()
+        assert client.verified is False
+        client.refresh()
+        # Unverified version file isn't reused. Downloaded again
+        # without validators.
+        assert FakeManifestDownloader.requests == 2
+        assert client.verify_calls == 2
+        assert client.verified is False
+
+    def test_changed_on_disk(self, client):
+        client.refresh()
+        client._write_manifest_2_filesystem(b'{}')
+        client.refresh()
+        # Downloaded again without validators
+        assert FakeManifestDownloader.requests == 3
+        assert client.verify_calls == 2
+
+    def test_new_keys(self, client):
+        client.refresh()
+        client.public_keys = client.public_keys + ['new key']
+        client.refresh()
+        assert client.verify_calls == 2
+
+    def test_cache(self, client, monkeypatch):
+        client.refresh()
+
+        def fail_load():
+            raise AssertionError('Version file loaded from disk')
+        monkeypatch.setattr(client, '_get_manifest_filesystem', fail_load)
+        client.refresh()
+        assert client.verify_calls == 1
+        assert client.json_data == {'updates': {}, 'latest': {}}
+
+    def test_stale_cache(self, client):
+        client.refresh()
+        path = os.path.join(client.data_dir, settings.VERSION_FILE_CACHE)
+        with open(path, 'wb') as f:
+            f.write(b'bad cache')
+        client.refresh()
+        assert client.verify_calls == 1
+        assert client.json_data == {'updates': {}, 'latest': {}}
+
+
+class DeployDownloader(object):
+    # Serves files from the deploy dir
+    deploy_dir = None
+    requests = []
+
+    def __init__(self, filename, urls, hexdigest=None, validators=None,
+                 **kwargs):
+        self.filename = filename
+        self.hexdigest = hexdigest
+        self.not_modified = False
+        self.response_validators = {}
+
+    def download_verify_return(self):
+        DeployDownloader.requests.append(self.filename)
+        path = os.path.join(self.deploy_dir, self.filename)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            data = f.read()
+        if self.hexdigest is not None and \
+                get_hash(data) != self.hexdigest:
+            return None
+        return data
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestDeltaManifest(object):
+
+    def publish(self, version):
+        updates = {'jms': {version: {'mac': {'filename': version}}}}
+        data = self.db.load(settings.CONFIG_DB_KEY_VERSION_META) or {}
+        data['updates'] = updates
+        data['latest'] = {'jms': {'mac': version}}
+        self.db.save(settings.CONFIG_DB_KEY_VERSION_META, data)
+        self.kh.sign_update()
+
+    @pytest.fixture
+    def client(self, monkeypatch):
+        self.db = Storage()
+        os.makedirs(os.path.join(settings.USER_DATA_FOLDER, 'deploy'))
+        self.kh = KeyHandler({'APP_NAME': 'jms', 'DATA_DIR': os.getcwd()},
+                             self.db)
+        self.kh.make_keys(2)
+        DeployDownloader.deploy_dir = self.kh.deploy_dir
+        DeployDownloader.requests = []
+        monkeypatch.setattr(client_module, 'FileDownloader',
+                            DeployDownloader)
+        t_config = TConfig()
+        t_config.DATA_DIR = os.path.abspath('client')
+        t_config.PUBLIC_KEYS = self.kh.get_public_keys()
+        self.publish('0.0.1.2.0')
+        client = Client(t_config, refresh=True, test=True)
+        assert client.verified is True
+        assert DeployDownloader.requests == ['versions.gz', 'versions.sig']
+        return client
+
+    def test_delta(self, client):
+        self.publish('0.0.2.2.0')
+        DeployDownloader.requests = []
+        client.refresh()
+        assert DeployDownloader.requests == ['versions-delta-1.gz']
+        assert client.verified is True
+        assert client.json_data['latest'] == {'jms': {'mac': '0.0.2.2.0'}}
+        assert client.json_data == \
+            self.db.load(settings.CONFIG_DB_KEY_VERSION_META)
+
+        # Nothing new. Checked with the full version file since
+        # deltas aren't signed.
+        DeployDownloader.requests = []
+        client.refresh()
+        assert DeployDownloader.requests == ['versions-delta-2.gz',
+                                             'versions.gz', 'versions.sig']
+        assert client.verified is True
+        assert client.json_data['serial'] == 2
+
+    def test_expired(self, client):
+        self.kh.delta_history = 0
+        self.publish('0.0.2.2.0')
+        self.publish('0.0.3.2.0')
+        DeployDownloader.requests = []
+        client.refresh()
+        assert DeployDownloader.requests == ['versions-delta-1.gz',
+                                             'versions.gz', 'versions.sig']
+        assert client.verified is True
+        assert client.json_data['serial'] == 3
+
+    def test_bad_delta(self, client):
+        self.publish('0.0.2.2.0')
+        # Delta for another version file
+        with open(os.path.join(self.kh.deploy_dir,
+                               'versions-delta-1.gz'), 'wb') as f:
+            f.write(gzip_compress(json.dumps(
+                {'from_serial': 1, 'serial': 2, 'set': [],
+                 'delete': [], 'sigs': []}).encode('utf-8')))
+        DeployDownloader.requests = []
+        client.refresh()
+        assert DeployDownloader.requests == ['versions-delta-1.gz',
+                                             'versions.gz', 'versions.sig']
+        assert client.verified is True
+        assert client.json_data['serial'] == 2
+
+    def test_no_changes_delta(self, client):
+        self.publish('0.0.2.2.0')
+        # Stale mirror says nothing changed since serial 1
+        with open(os.path.join(self.kh.deploy_dir,
+                               'versions-delta-1.gz'), 'wb') as f:
+            f.write(gzip_compress(json.dumps(
+                {'from_serial': 1, 'serial': 1, 'set': [],
+                 'delete': []}).encode('utf-8')))
+        DeployDownloader.requests = []
+        client.refresh()
+        assert DeployDownloader.requests == ['versions-delta-1.gz',
+                                             'versions.gz', 'versions.sig']
+        assert client.verified is True
+        assert client.json_data['serial'] == 2
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestShardedManifest(object):
+
+    def publish(self, version):
+        data = self.db.load(settings.CONFIG_DB_KEY_VERSION_META) or {}
+        data['updates'] = {
+            'jms': {version: {'mac': {'filename': version},
+                              'win': {'filename': version}}},
+            'other': {'0.0.1.2.0': {'mac': {'filename': 'other'}}}}
+        data['latest'] = {'jms': {'mac': version, 'win': version},
+                          'other': {'mac': '0.0.1.2.0'}}
+        self.db.save(settings.CONFIG_DB_KEY_VERSION_META, data)
+        self.kh.sign_update()
+
+    @pytest.fixture
+    def client(self, monkeypatch):
+        self.db = Storage()
+        os.makedirs(os.path.join(settings.USER_DATA_FOLDER, 'deploy'))
+        self.kh = KeyHandler({'APP_NAME': 'jms', 'DATA_DIR': os.getcwd(),
+                              'SHARD_VERSION_FILE': True}, self.db)
+        self.kh.make_keys(2)
+        DeployDownloader.deploy_dir = self.kh.deploy_dir
+        DeployDownloader.requests = []
+        monkeypatch.setattr(client_module, 'FileDownloader',
+                            DeployDownloader)
+        t_config = TConfig()
+        t_config.DATA_DIR = os.path.abspath('client')
+        t_config.PUBLIC_KEYS = self.kh.get_public_keys()
+        t_config.SHARD_VERSION_FILE = True
+        self.publish('0.0.1.2.0')
+        client = Client(t_config, refresh=True, test=True)
+        assert client.verified is True
+        assert DeployDownloader.requests == ['versions-index.gz',
+                                             'versions-jms-mac.gz']
+        return client
+
+    def test_shards(self, client):
+        assert client.json_data['updates'] == \
+            {'jms': {'0.0.1.2.0': {'mac': {'filename': '0.0.1.2.0'}}}}
+        assert client.json_data['latest'] == {'jms': {'mac': '0.0.1.2.0'}}
+
+        # Other shards are downloaded when needed
+        DeployDownloader.requests = []
+        client.update_check('other', '0.0.1')
+        assert DeployDownloader.requests == ['versions-other-mac.gz']
+        assert client.json_data['latest']['other'] == {'mac': '0.0.1.2.0'}
+
+        # Shards that didn't change aren't downloaded again
+        self.publish('0.0.2.2.0')
+        DeployDownloader.requests = []
+        client.refresh()
+        assert DeployDownloader.requests == ['versions-index.gz',
+                                             'versions-jms-mac.gz']
+        assert client.verified is True
+        assert client.json_data['latest'] == \
+            {'jms': {'mac': '0.0.2.2.0'}, 'other': {'mac': '0.0.1.2.0'}}
+
+    def test_bad_index(self, client):
+        with open(os.path.join(self.kh.deploy_dir,
+                               'versions-index.gz'), 'wb') as f:
+            f.write(gzip_compress(json.dumps(
+                {'serial': 1, 'shards': {}, 'sigs': []}).encode('utf-8')))
+        DeployDownloader.requests = []
+        client.refresh()
+        assert DeployDownloader.requests[0] == 'versions-index.gz'
+        assert DeployDownloader.requests[-2:] == ['versions.gz',
+                                                  'versions.sig']
+        assert client.verified is True
+        assert client.json_data['latest']['other'] == {'mac': '0.0.1.2.0'}
+
+    def test_bad_shard(self, client):
+        # Shard doesn't match the hash in the index
+        with open(os.path.join(self.kh.deploy_dir,
+                               'versions-jms-mac.gz'), 'wb') as f:
+            f.write(gzip_compress(b'{}'))
+        shard_dir = os.path.join(client.data_dir, 'version-shards')
+        os.remove(os.path.join(shard_dir, 'versions-jms-mac.gz'))
+        client.refresh()
+        assert client.json_data['updates'] == {}
+        assert client.update_check('jms', '0.0.1') is None
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestDetachedSig(object):
+
+    @pytest.fixture
+    def client(self, monkeypatch):
+        self.db = Storage()
+        os.makedirs(os.path.join(settings.USER_DATA_FOLDER, 'deploy'))
+        self.kh = KeyHandler({'APP_NAME': 'jms', 'DATA_DIR': os.getcwd()},
+                             self.db)
+        self.kh.make_keys(2)
+        self.db.save(settings.CONFIG_DB_KEY_VERSION_META,
+                     {'updates': {'jms': {'0.0.1.2.0': {'mac': {}}}},
+                      'latest': {'jms': {'mac': '0.0.1.2.0'}}})
+        self.kh.sign_update()
+        DeployDownloader.deploy_dir = self.kh.deploy_dir
+        DeployDownloader.requests = []
+        monkeypatch.setattr(client_module, 'FileDownloader',
+                            DeployDownloader)
+        t_config = TConfig()
+        t_config.DATA_DIR = os.path.abspath('client')
+        t_config.PUBLIC_KEYS = self.kh.get_public_keys()
+        client = Client(t_config, test=True)
+
+        def fail_verify(data):
+            raise AssertionError('Version file dumped again')
+        monkeypatch.setattr(client, '_verify_sig', fail_verify)
+        return client
+
+    def test_detached_sig(self, client):
+        client.refresh()
+        assert client.verified is True
+        assert 'sigs' not in client.json_data
+        assert client.json_data['latest'] == {'jms': {'mac': '0.0.1.2.0'}}
+
+    def test_offline(self, client):
+        client.refresh()
+        # Version file on disk is checked with the saved signature
+        DeployDownloader.deploy_dir = os.path.abspath('missing')
+        client._manifest_validators = None
+        os.remove(os.path.join(client.data_dir,
+                               settings.VERSION_FILE_VALIDATORS))
+        client.refresh()
+        assert client.verified is True
+        assert client.json_data['latest'] == {'jms': {'mac': '0.0.1.2.0'}}
+
+    def test_offline_cache(self, client, monkeypatch):
+        client.refresh()
+        DeployDownloader.deploy_dir = os.path.abspath('missing')
+
+        def fail_load():
+            raise AssertionError('Version file loaded from disk')
+        monkeypatch.setattr(client, '_get_manifest_filesystem', fail_load)
+        client.refresh()
+        assert client.verified is True
+        assert client.json_data['latest'] == {'jms': {'mac': '0.0.1.2.0'}}
+
+    def test_bad_detached_sig(self, client):
+        with open(os.path.join(self.kh.deploy_dir,
+                               settings.VERSION_FILE_SIG), 'w') as f:
+            f.write(json.dumps({'file_hash': 'bad', 'sigs': []}))
+        # Falls back to the signatures in the version file
+        del client._verify_sig
+        client.refresh()
+        assert client.verified is True
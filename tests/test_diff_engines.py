@@ -0,0 +1,82 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import os
+
+import pytest
+
+from pyupdater.utils.diff_engines import ENGINES, get_engine
+from pyupdater.utils.exceptions import UtilsError
+
+
+def make_files(src, dst):
+    with open('src', 'wb') as f:
+        f.write(src)
+    with open('dst', 'wb') as f:
+        f.write(dst)
+
+
+@pytest.mark.usefixtures('cleandir')
+class TestDiffEngines(object):
+
+    @pytest.mark.parametrize('name', sorted(ENGINES.keys()))
+    def test_round_trip(self, name):
+        engine = get_engine(name)
+        src = os.urandom(50000)
+        dst = b'header' + src[:20000] + os.urandom(300) + src[20100:] + \
+            src[:5000]
+        make_files(src, dst)
+        engine.file_diff('src', 'dst', 'patch')
+        with open('patch', 'rb') as f:
+            assert engine.patch(src, f.read()) == dst
+        engine.file_patch('src', 'out', 'patch')
+        with open('out', 'rb') as f:
+            assert f.read() == dst
+
+    @pytest.mark.parametrize('src,dst', [(b'', b''),
+                                         (b'', b'new'),
+                                         (b'old', b''),
+                                         (b'0' * 100, b'0' * 10000)])
+    def test_block_delta_edges(self, src, dst):
+        engine = get_engine('blockdelta')
+        make_files(src, dst)
+        engine.file_diff('src', 'dst', 'patch')
+        engine.file_patch('src', 'out', 'patch')
+        with open('out', 'rb') as f:
+            assert f.read() == dst
+
+    def test_block_delta_small_patch(self):
+        engine = get_engine('blockdelta')
+        src = os.urandom(100000)
+        make_files(src, src[:50000] + b'change' + src[50000:])
+        engine.file_diff('src', 'dst', 'patch')
+        assert os.path.getsize('patch') < 200
+
+    def test_block_delta_bad_source(self):
+        engine = get_engine('blockdelta')
+        src = os.urandom(10000)
+        make_files(src, src + b'more')
+        engine.file_diff('src', 'dst', 'patch')
+        with open('src', 'wb') as f:
+            f.write(src[:100])
+        with pytest.raises(UtilsError):
+            engine.file_patch('src', 'out', 'patch')
+
+    def test_default_engine(self):
+        assert get_engine().name == 'bsdiff4'
+        with pytest.raises(UtilsError):
+            get_engine('missing')
@@ -15,9 +15,14 @@
 # --------------------------------------------------------------------------
 from __future__ import unicode_literals
 
+from io import BytesIO
+import hashlib
+import os
+
 import pytest
 
 from pyupdater.client.downloader import FileDownloader
+from pyupdater.client.mirrors import MirrorScoreboard
 
 
 FILENAME = 'dont+delete+pyu+test.txt'
@@ -26,6 +31,50 @@ FILE_HASH = '9da856b0b8b77c838d6945e0bfbc62fff978a9dd5256eed231fc499b5d4b183c'
 URL = 'https://s3-us-west-1.amazonaws.com/pyupdater-test/'
 
 
+class FakeResponse(object):
+
+    def __init__(self, data, status=200, headers=None, fail_after=None):
+        self.status = status
+        self.headers = {'Content-Length': str(len(data))}
+        if headers is not None:
+            self.headers.update(headers)
+        self._data = BytesIO(data)
+        self._fail_after = fail_after
+
+    def read(self, size):
+        if self._fail_after is not None and \
+                self._data.tell() >= self._fail_after:
+            raise IOError('Connection reset')
+        return self._data.read(size)
+
+    def release_conn(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakePool(object):
+    # Serves data with support for range requests
+
+    def __init__(self, data):
+        self.data = data
+        self.requests = []
+
+    def urlopen(self, method, url, headers=None, preload_content=True):
+        self.requests.append(headers)
+        if headers is None or 'Range' not in headers:
+            return FakeResponse(self.data)
+        start, end = headers['Range'][6:].split('-')
+        start = int(start)
+        if end == '':
+            end = len(self.data) - 1
+        end = int(end)
+        content_range = 'bytes {}-{}/{}'.format(start, end, len(self.data))
+        return FakeResponse(self.data[start:end + 1], status=206,
+                            headers={'Content-Range': content_range})
+
+
 @pytest.mark.usefixtue("cleandir")
 class TestData(object):
 
@@ -73,3 +122,222 @@ class TestContentLength(object):
         fd = FileDownloader(FILENAME, URL, FILE_HASH)
         fd.download_verify_return()
         assert fd.content_length == 60000
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestStorage(object):
+    data = b'PyUpdater streaming test data' * 5000
+
+    def test_write(self):
+        hexdigest = hashlib.sha256(self.data).hexdigest()
+        fd = FileDownloader('stream.bin', URL, hexdigest)
+        fd._create_response = lambda *args: FakeResponse(self.data)
+        assert fd.download_verify_write() is True
+        assert fd.file_binary_data is None
+        assert os.path.exists(fd.temp_filename) is False
+        with open('stream.bin', 'rb') as f:
+            assert f.read() == self.data
+
+    def test_return_hash(self):
+        hexdigest = hashlib.sha256(self.data).hexdigest()
+        fd = FileDownloader('stream.bin', URL, hexdigest)
+        fd._create_response = lambda *args: FakeResponse(self.data)
+        assert fd.download_verify_return() == self.data
+        assert fd.file_hash == hexdigest
+
+    def test_write_fail(self):
+        fd = FileDownloader('stream.bin', URL, 'JKFEIFJILEFJ983NKFNKL')
+        fd._create_response = lambda *args: FakeResponse(self.data)
+        assert fd.download_verify_write() is False
+        assert os.path.exists('stream.bin') is False
+        assert os.path.exists(fd.temp_filename) is False
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestResume(object):
+    data = b'PyUpdater resume test data' * 5000
+
+    def _interrupted(self, hexdigest):
+        fd = FileDownloader('resume.bin', URL, hexdigest)
+        fd._create_response = lambda *args: FakeResponse(self.data,
+                                                         fail_after=1000)
+        assert fd.download_verify_write() is False
+        assert os.path.exists(fd.temp_filename) is True
+        assert os.path.exists(fd.resume_filename) is True
+        return fd
+
+    def test_resume(self):
+        hexdigest = hashlib.sha256(self.data).hexdigest()
+        self._interrupted(hexdigest)
+        requests = []
+
+        def create_response(headers=None, first_url=None):
+            requests.append(headers)
+            offset = int(headers['Range'][6:-1])
+            content_range = 'bytes {}-{}/{}'.format(offset,
+                                                    len(self.data) - 1,
+                                                    len(self.data))
+            return FakeResponse(self.data[offset:], status=206,
+                                headers={'Content-Range': content_range})
+
+        fd = FileDownloader('resume.bin', URL, hexdigest)
+        fd._create_response = create_response
+        assert fd.download_verify_write() is True
+        assert requests[0]['Range'] != 'bytes=0-'
+        assert os.path.exists(fd.resume_filename) is False
+        with open('resume.bin', 'rb') as f:
+            assert f.read() == self.data
+
+    def test_short_read(self):
+        # Connection closed early without an error
+        hexdigest = hashlib.sha256(self.data).hexdigest()
+        fd = FileDownloader('resume.bin', URL, hexdigest)
+        response = FakeResponse(self.data[:1000])
+        response.headers['Content-Length'] = str(len(self.data))
+        fd._create_response = lambda *args: response
+        assert fd.download_verify_write() is False
+        assert os.path.exists(fd.temp_filename) is True
+        assert fd._get_resume_info()[0] == 1000
+
+    def test_resume_range_ignored(self):
+        hexdigest = hashlib.sha256(self.data).hexdigest()
+        self._interrupted(hexdigest)
+        fd = FileDownloader('resume.bin', URL, hexdigest)
+        fd._create_response = lambda *args: FakeResponse(self.data)
+        assert fd.download_verify_write() is True
+        with open('resume.bin', 'rb') as f:
+            assert f.read() == self.data
+
+    def test_resume_different_hash(self):
+        self._interrupted(hashlib.sha256(b'old').hexdigest())
+        hexdigest = hashlib.sha256(self.data).hexdigest()
+        fd = FileDownloader('resume.bin', URL, hexdigest)
+        assert fd._get_resume_info() == (0, None)
+        assert os.path.exists(fd.temp_filename) is False
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestSegments(object):
+    data = os.urandom(1024 * 64 + 7)
+
+    def test_segments(self):
+        hexdigest = hashlib.sha256(self.data).hexdigest()
+        fd = FileDownloader('segments.bin', [URL, URL + 'mirror/'],
+                            hexdigest, max_segments=4)
+        fd.min_segment_size = 1024
+        fd.http_pool = FakePool(self.data)
+        assert fd.download_verify_write() is True
+        # Probe + 4 segments
+        assert len(fd.http_pool.requests) == 5
+        with open('segments.bin', 'rb') as f:
+            assert f.read() == self.data
+
+    def test_segments_too_small(self):
+        hexdigest = hashlib.sha256(self.data).hexdigest()
+        fd = FileDownloader('segments.bin', URL, hexdigest, max_segments=4)
+        fd.http_pool = FakePool(self.data)
+        assert fd.download_verify_write() is True
+        # Probe + normal download
+        assert len(fd.http_pool.requests) == 2
+        with open('segments.bin', 'rb') as f:
+            assert f.read() == self.data
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestSharedPool(object):
+    data = b'PyUpdater shared pool test data' * 100
+
+    def test_shared_pool(self):
+        hexdigest = hashlib.sha256(self.data).hexdigest()
+        pool = FakePool(self.data)
+        for name in ['one.bin', 'two.bin']:
+            fd = FileDownloader(name, URL, hexdigest, http_pool=pool)
+            assert fd.http_pool is pool
+            assert fd.download_verify_write() is True
+        assert len(pool.requests) == 2
+
+
+class ConditionalPool(FakePool):
+    # Answers 304 when the If-None-Match header matches the ETag
+
+    etag = '"v1"'
+
+    def urlopen(self, method, url, headers=None, preload_content=True):
+        if headers is not None and \
+                headers.get('If-None-Match') == self.etag:
+            self.requests.append(headers)
+            return FakeResponse(b'', status=304)
+        response = super(ConditionalPool, self).urlopen(method, url,
+                                                        headers,
+                                                        preload_content)
+        response.headers['ETag'] = self.etag
+        return response
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestValidators(object):
+    data = b'PyUpdater validators test data' * 100
+
+    def test_not_modified(self):
+        pool = ConditionalPool(self.data)
+        fd = FileDownloader('versions.gz', URL, http_pool=pool)
+        assert fd.download_verify_return() == self.data
+        assert fd.not_modified is False
+        assert fd.response_validators == {
+            URL + 'versions.gz': {'etag': '"v1"', 'last_modified': None}}
+
+        fd = FileDownloader('versions.gz', URL, http_pool=pool,
+                            validators=fd.response_validators)
+        assert fd.download_verify_return() is None
+        assert fd.not_modified is True
+        assert pool.requests[-1] == {'If-None-Match': '"v1"'}
+
+    def test_modified(self):
+        pool = ConditionalPool(self.data)
+        validators = {URL + 'versions.gz': {'etag': '"v0"',
+                                            'last_modified': None}}
+        fd = FileDownloader('versions.gz', URL, http_pool=pool,
+                            validators=validators)
+        assert fd.download_verify_return() == self.data
+        assert fd.not_modified is False
+
+    def test_other_url(self):
+        # Validators are only sent to the url they came from
+        pool = ConditionalPool(self.data)
+        validators = {'https://other.example.com/versions.gz':
+                      {'etag': '"v1"', 'last_modified': None}}
+        fd = FileDownloader('versions.gz', URL, http_pool=pool,
+                            validators=validators)
+        assert fd.download_verify_return() == self.data
+        assert pool.requests == [None]
+
+
+class StatusPool(FakePool):
+    # Answers every request with status
+
+    def __init__(self, status):
+        super(StatusPool, self).__init__(b'')
+        self.status = status
+
+    def urlopen(self, method, url, headers=None, preload_content=True):
+        self.requests.append(headers)
+        return FakeResponse(b'', status=self.status)
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestMirrorFailures(object):
+
+    def test_missing_file(self):
+        # Optional files are missing on older repos
+        mirrors = MirrorScoreboard()
+        fd = FileDownloader('versions.sig', URL, http_pool=StatusPool(404),
+                            mirrors=mirrors)
+        assert fd.download_verify_return() is None
+        assert mirrors.scores[URL]['failures'] == 0
+
+    def test_server_error(self):
+        mirrors = MirrorScoreboard()
+        fd = FileDownloader('versions.sig', URL, http_pool=StatusPool(503),
+                            mirrors=mirrors)
+        assert fd.download_verify_return() is None
+        assert mirrors.scores[URL]['failures'] > 0
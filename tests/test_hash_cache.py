@@ -0,0 +1,72 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import os
+
+import pytest
+
+from pyupdater import settings
+from pyupdater.client import hash_cache
+from pyupdater.client.hash_cache import HashCache
+from pyupdater.utils import get_package_hashes
+
+
+@pytest.mark.usefixtures('cleandir')
+class TestHashCache(object):
+
+    @pytest.fixture
+    def counter(self, monkeypatch):
+        calls = []
+
+        def counting_hasher(filename):
+            calls.append(filename)
+            return get_package_hashes(filename)
+        monkeypatch.setattr(hash_cache, 'get_package_hashes',
+                            counting_hasher)
+        with open('archive.zip', 'wb') as f:
+            f.write(b'PyUpdater hash cache test' * 100)
+        return calls
+
+    def test_cache_hit(self, counter):
+        cache = HashCache(os.getcwd())
+        file_hash = cache.get_hash('archive.zip')
+        assert file_hash == get_package_hashes('archive.zip')
+        assert cache.get_hash('archive.zip') == file_hash
+        assert len(counter) == 1
+
+    def test_changed_file(self, counter):
+        cache = HashCache(os.getcwd())
+        cache.get_hash('archive.zip')
+        with open('archive.zip', 'ab') as f:
+            f.write(b'more data')
+        assert cache.get_hash('archive.zip') == \
+            get_package_hashes('archive.zip')
+        assert len(counter) == 2
+
+    def test_save_load(self, counter):
+        cache = HashCache(os.getcwd())
+        cache.get_hash('archive.zip')
+        assert os.path.exists(settings.HASH_CACHE_FILE)
+        cache = HashCache(os.getcwd())
+        cache.get_hash('archive.zip')
+        assert len(counter) == 1
+
+    def test_add(self, counter):
+        cache = HashCache()
+        cache.add('archive.zip', 'knownhash')
+        assert cache.get_hash('archive.zip') == 'knownhash'
+        assert len(counter) == 0
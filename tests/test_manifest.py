@@ -0,0 +1,55 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import copy
+
+import pytest
+
+from pyupdater.utils.exceptions import UtilsError
+from pyupdater.utils.manifest import apply_delta, make_delta
+
+
+class TestDelta(object):
+
+    def test_round_trip(self):
+        old = {'serial': 1,
+               'latest': {'jms': {'mac': '0.0.1.2.0'}},
+               'updates': {'jms': {
+                   '0.0.1.2.0': {'mac': {'filename': 'jms-0.0.1'}},
+                   '0.0.0.2.0': {'mac': {'filename': 'jms-0.0.0'}}}}}
+        new = copy.deepcopy(old)
+        new['serial'] = 2
+        new['latest']['jms']['mac'] = '0.0.2.2.0'
+        new['updates']['jms']['0.0.2.2.0'] = {'mac': {'filename': 'jms'}}
+        del new['updates']['jms']['0.0.0.2.0']
+        delta = make_delta(old, new)
+        assert delta['delete'] == [['updates', 'jms', '0.0.0.2.0']]
+        assert len(delta['set']) == 3
+        assert apply_delta(copy.deepcopy(old), delta) == new
+
+    def test_no_changes(self):
+        data = {'updates': {'jms': {}}}
+        assert make_delta(data, data) == {'set': [], 'delete': []}
+
+    def test_type_change(self):
+        old = {'a': {'b': 1}}
+        new = {'a': 1}
+        assert apply_delta(old, make_delta(old, new)) == new
+
+    def test_bad_path(self):
+        with pytest.raises(UtilsError):
+            apply_delta({'a': 1}, {'set': [[['a', 'b'], 1]]})
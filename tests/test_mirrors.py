@@ -0,0 +1,65 @@
+# --------------------------------------------------------------------------
+# Copyright 2014 Digital Sapphire Development Team
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# --------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import os
+
+import pytest
+
+from pyupdater import settings
+from pyupdater.client.mirrors import MirrorScoreboard
+
+FAST = 'https://fast.example.com/'
+SLOW = 'https://slow.example.com/'
+DEAD = 'https://dead.example.com/'
+
+
+@pytest.mark.usefixtures('cleandir')
+class TestMirrorScoreboard(object):
+
+    @pytest.fixture
+    def scoreboard(self):
+        scoreboard = MirrorScoreboard(os.getcwd())
+        scoreboard.explore_rate = 0
+        scoreboard.record_response(FAST, 0.05)
+        scoreboard.record_throughput(FAST, 1024 * 1024, 0.5)
+        scoreboard.record_response(SLOW, 0.5)
+        scoreboard.record_throughput(SLOW, 1024 * 1024, 10)
+        scoreboard.record_failure(DEAD)
+        return scoreboard
+
+    def test_rank(self, scoreboard):
+        assert scoreboard.rank([DEAD, SLOW, FAST]) == [FAST, SLOW, DEAD]
+
+    def test_rank_unknown_first(self, scoreboard):
+        new = 'https://new.example.com/'
+        assert scoreboard.rank([SLOW, new, FAST])[0] == new
+
+    def test_failures(self, scoreboard):
+        for _ in range(10):
+            scoreboard.record_failure(FAST)
+        assert scoreboard.rank([FAST, SLOW]) == [SLOW, FAST]
+
+    def test_explore(self, scoreboard):
+        scoreboard.explore_rate = 1
+        assert scoreboard.rank([FAST, SLOW, DEAD])[0] != FAST
+
+    def test_save_load(self, scoreboard):
+        scoreboard.save()
+        assert os.path.exists(settings.MIRROR_SCORES_FILE)
+        loaded = MirrorScoreboard(os.getcwd())
+        loaded.explore_rate = 0
+        assert loaded.rank([DEAD, SLOW, FAST]) == [FAST, SLOW, DEAD]
@@ -15,12 +15,19 @@
 # --------------------------------------------------------------------------
 from __future__ import unicode_literals
 
+import hashlib
+import io
 import os
+import tarfile
 
 import pytest
 
 from pyupdater import settings
-from pyupdater.package_handler import PackageHandler
+from pyupdater import package_handler
+from pyupdater.package_handler import (_estimate_patch_memory,
+                                       _make_patch,
+                                       PackageHandler)
+from pyupdater.utils import archive_patch
 from pyupdater.utils.config import TransistionDict
 from pyupdater.utils.exceptions import PackageHandlerError
 from tconfig import TConfig
@@ -65,7 +72,272 @@ class TestExecution(object):
         p = PackageHandler(config, db)
         p.process_packages()
 
+    def test_file_size(self, db):
+        data_dir = os.getcwd()
+        t_config = TConfig()
+        t_config.DATA_DIR = data_dir
+        t_config.UPDATE_PATCHES = False
+        config = TransistionDict()
+        config.from_object(t_config)
+        p = PackageHandler(config, db)
+        filename = 'Acme-mac-0.1.0.zip'
+        with open(os.path.join(p.new_dir, filename), 'wb') as f:
+            f.write(b'0' * 1000)
+        p.process_packages()
+        info = p.json_data['updates']['Acme']['0.1.0.2.0']['mac']
+        assert info['file_size'] == 1000
+
+    def test_many_packages(self, db):
+        data_dir = os.getcwd()
+        t_config = TConfig()
+        t_config.DATA_DIR = data_dir
+        t_config.UPDATE_PATCHES = False
+        config = TransistionDict()
+        config.from_object(t_config)
+        p = PackageHandler(config, db)
+        hashes = {}
+        for name in ['Acme', 'Bolt', 'Cog']:
+            for plat in ['mac', 'win', 'nix']:
+                filename = '{}-{}-0.1.0.zip'.format(name, plat)
+                data = os.urandom(1000)
+                with open(os.path.join(p.new_dir, filename), 'wb') as f:
+                    f.write(data)
+                hashes[(name, plat)] = hashlib.sha256(data).hexdigest()
+        with open(os.path.join(p.new_dir, 'notes.txt'), 'w') as f:
+            f.write('Not a package')
+        p.process_packages()
+        for (name, plat), file_hash in hashes.items():
+            info = p.json_data['updates'][name]['0.1.0.2.0'][plat]
+            assert info['file_hash'] == file_hash
+
+    def test_skip_patches(self, db):
+        data_dir = os.getcwd()
+        t_config = TConfig()
+        t_config.DATA_DIR = data_dir
+        t_config.UPDATE_PATCHES = True
+        t_config.SKIP_PATCH_INTERVAL = 2
+        config = TransistionDict()
+        config.from_object(t_config)
+        p = PackageHandler(config, db)
+        for i in range(1, 5):
+            filename = 'Acme-mac-0.{}.0.zip'.format(i)
+            with open(os.path.join(p.new_dir, filename), 'wb') as f:
+                f.write(os.urandom(100) + b'0' * 1000 * i)
+            p.process_packages()
+        versions = p.json_data['updates']['Acme']
+        assert 'skip_patches' not in versions['0.2.0.2.0']['mac']
+        skip = versions['0.3.0.2.0']['mac']['skip_patches']
+        assert [x['src'] for x in skip] == ['0.1.0.2.0']
+        skip = versions['0.4.0.2.0']['mac']['skip_patches']
+        assert [x['src'] for x in skip] == ['0.1.0.2.0']
+        assert os.path.exists(os.path.join(p.deploy_dir,
+                                           skip[0]['patch_name']))
+        # Anchors & latest are kept. Others are removed
+        assert sorted(os.listdir(p.files_dir)) == ['Acme-mac-0.1.0.zip',
+                                                   'Acme-mac-0.3.0.zip',
+                                                   'Acme-mac-0.4.0.zip']
+
+    def test_skip_patch_anchors(self, db):
+        data_dir = os.getcwd()
+        t_config = TConfig()
+        t_config.DATA_DIR = data_dir
+        t_config.UPDATE_PATCHES = True
+        t_config.SKIP_PATCH_INTERVAL = 1
+        t_config.SKIP_PATCH_ANCHORS = 2
+        config = TransistionDict()
+        config.from_object(t_config)
+        p = PackageHandler(config, db)
+        for i in range(1, 6):
+            filename = 'Acme-mac-0.{}.0.zip'.format(i)
+            with open(os.path.join(p.new_dir, filename), 'wb') as f:
+                f.write(os.urandom(100) + b'0' * 1000 * i)
+            p.process_packages()
+        versions = p.json_data['updates']['Acme']
+        # Only the most recent anchors are used
+        skip = versions['0.5.0.2.0']['mac']['skip_patches']
+        assert [x['src'] for x in skip] == ['0.3.0.2.0']
+        assert sorted(os.listdir(p.files_dir)) == ['Acme-mac-0.3.0.zip',
+                                                   'Acme-mac-0.4.0.zip',
+                                                   'Acme-mac-0.5.0.zip']
+
     def test_process_packages_fail(self, db):
         with pytest.raises(PackageHandlerError):
             p = PackageHandler()
             p.process_packages()
+
+
+@pytest.mark.usefixtures('cleandir', 'db', 'pyu')
+class TestPatchScheduler(object):
+
+    def test_estimate(self):
+        with open('src', 'wb') as f:
+            f.write(b'0' * 100)
+        with open('dst', 'wb') as f:
+            f.write(b'0' * 50)
+        assert _estimate_patch_memory({'src': 'src', 'dst': 'dst'}) == 950
+        assert _estimate_patch_memory({'src': 'missing'}) == 0
+
+    def test_estimate_archive(self):
+        with open('app', 'wb') as f:
+            f.write(b'0' * 100000)
+        for name in ('src', 'dst'):
+            with tarfile.open(name + '.tar.gz', 'w:gz') as tar:
+                tar.add('app')
+        patch_info = {'src': 'src.tar.gz', 'dst': 'dst.tar.gz'}
+        compressed = _estimate_patch_memory(patch_info)
+        # Archive patches diff the uncompressed tar data
+        patch_info['archive_patches'] = True
+        tar_size = archive_patch.get_size('src.tar.gz')
+        assert tar_size > 100000
+        assert _estimate_patch_memory(patch_info) == tar_size * 10
+        assert _estimate_patch_memory(patch_info) > compressed * 10
+
+    def test_small_budget(self, db):
+        data_dir = os.getcwd()
+        t_config = TConfig()
+        t_config.DATA_DIR = data_dir
+        # Smaller then any job so they run one at a time
+        t_config.PATCH_MEMORY_BUDGET = 0
+        config = TransistionDict()
+        config.from_object(t_config)
+        p = PackageHandler(config, db)
+        patch_manifest = []
+        for i in range(1, 4):
+            src = os.path.abspath('src{}'.format(i))
+            dst = os.path.abspath('dst{}'.format(i))
+            data = os.urandom(1000 * i)
+            with open(src, 'wb') as f:
+                f.write(data)
+            with open(dst, 'wb') as f:
+                f.write(data + os.urandom(10))
+            patch_manifest.append(dict(src=src, dst=dst,
+                                       patch_name=os.path.abspath('patch'),
+                                       patch_num=i,
+                                       package='dst{}'.format(i)))
+        patches = p._make_patches(patch_manifest)
+        # Same order as the manifest
+        assert [x.dst_filename for x in patches] == ['dst1', 'dst2', 'dst3']
+        for x in patches:
+            assert os.path.exists(x.patch_name)
+
+    def test_killed_worker(self, db, monkeypatch):
+        data_dir = os.getcwd()
+        t_config = TConfig()
+        t_config.DATA_DIR = data_dir
+        config = TransistionDict()
+        config.from_object(t_config)
+        p = PackageHandler(config, db)
+
+        def make_patch(patch_info):
+            # Killed like the out of memory killer would
+            if patch_info['package'] == 'dst1':
+                os._exit(1)
+            return _make_patch(patch_info)
+        monkeypatch.setattr(package_handler, '_make_patch', make_patch)
+        patch_manifest = []
+        for i in range(1, 3):
+            src = os.path.abspath('src{}'.format(i))
+            dst = os.path.abspath('dst{}'.format(i))
+            with open(src, 'wb') as f:
+                f.write(b'0' * 1000)
+            with open(dst, 'wb') as f:
+                f.write(b'0' * 1000 + b'new')
+            patch_manifest.append(dict(src=src, dst=dst,
+                                       patch_name=os.path.abspath('patch'),
+                                       patch_num=i,
+                                       package='dst{}'.format(i)))
+        patches = p._make_patches(patch_manifest)
+        # Job of the killed worker fails instead of hanging
+        assert [x.dst_filename for x in patches] == ['dst2']
+
+    def test_patch_cache(self):
+        data = os.urandom(1000)
+        with open('src', 'wb') as f:
+            f.write(data)
+        with open('dst', 'wb') as f:
+            f.write(data + os.urandom(10))
+        cache_dir = os.path.abspath('cache')
+        patch_info = dict(src=os.path.abspath('src'),
+                          dst=os.path.abspath('dst'),
+                          patch_name=os.path.abspath('patch'),
+                          patch_num=1, package='dst',
+                          cache_dir=cache_dir)
+        first = _make_patch(patch_info)
+        assert len(os.listdir(cache_dir)) == 1
+        with open(first.patch_name, 'rb') as f:
+            first_data = f.read()
+        os.remove(first.patch_name)
+
+        second = _make_patch(patch_info)
+        with open(second.patch_name, 'rb') as f:
+            assert f.read() == first_data
+
+        # A changed source can't use the cached patch
+        with open('src', 'wb') as f:
+            f.write(os.urandom(1000))
+        _make_patch(patch_info)
+        assert len(os.listdir(cache_dir)) == 2
+
+    def test_prune_patch_cache(self, db):
+        data_dir = os.getcwd()
+        t_config = TConfig()
+        t_config.DATA_DIR = data_dir
+        config = TransistionDict()
+        config.from_object(t_config)
+        p = PackageHandler(config, db)
+        with open('src', 'wb') as f:
+            f.write(b'src')
+        with open('dst', 'wb') as f:
+            f.write(b'dst')
+        src_hash = hashlib.sha256(b'src').hexdigest()
+        patch_info = dict(src=os.path.abspath('src'),
+                          dst=os.path.abspath('dst'),
+                          patch_name=os.path.abspath('patch'),
+                          patch_num=1, package='dst',
+                          cache_dir=p.patch_cache_dir,
+                          dst_hash='dsthash')
+        _make_patch(patch_info)
+        # Known hash of dst is used
+        cached = os.listdir(p.patch_cache_dir)
+        assert cached[0].startswith(src_hash + '-dsthash-')
+        with open(os.path.join(p.patch_cache_dir, 'old'), 'wb') as f:
+            f.write(b'old')
+
+        json_data = {'updates': {'Acme': {
+            '0.1.0.2.0': {'mac': {'file_hash': src_hash}},
+            '0.2.0.2.0': {'mac': {'file_hash': 'dsthash'}}}}}
+        p._prune_patch_cache(json_data)
+        assert os.listdir(p.patch_cache_dir) == cached
+        # Source version was removed from the version file
+        del json_data['updates']['Acme']['0.1.0.2.0']
+        p._prune_patch_cache(json_data)
+        assert os.listdir(p.patch_cache_dir) == []
+
+    def test_archive_patch(self):
+        # Compressible so the change in the middle alters the rest of
+        # the gzip stream. Fixed tar headers keep the sizes the same
+        # every run.
+        data = ''.join(['line {}\n'.format(i)
+                        for i in range(20000)]).encode('ascii')
+        dst_data = data[:80000] + b'new' + data[80000:]
+        for name, content in [('src', data), ('dst', dst_data)]:
+            with tarfile.open(name + '.tar.gz', 'w:gz') as tar:
+                info = tarfile.TarInfo('app')
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+        patch_info = dict(src=os.path.abspath('src.tar.gz'),
+                          dst=os.path.abspath('dst.tar.gz'),
+                          patch_name=os.path.abspath('patch'),
+                          patch_num=1, package='dst.tar.gz',
+                          cache_dir=os.path.abspath('cache'))
+        regular = _make_patch(patch_info)
+        assert regular.archive is None
+        regular_size = os.path.getsize(regular.patch_name)
+
+        patch_info['archive_patches'] = True
+        patch = _make_patch(patch_info)
+        assert patch.archive['format'] == 'tar.gz'
+        assert os.path.getsize(patch.patch_name) * 10 < regular_size
+        # Archive info is cached with the patch
+        os.remove(patch.patch_name)
+        assert _make_patch(patch_info).archive == patch.archive
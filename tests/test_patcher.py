@@ -17,12 +17,22 @@ from __future__ import unicode_literals
 
 import json
 import os
+import io
 import shutil
+import tarfile
+import threading
+import time
 import urllib2
 
+import bsdiff4
 import pytest
 
+from pyupdater.client import patcher
+from pyupdater.client.hash_cache import HashCache
 from pyupdater.client.patcher import Patcher
+from pyupdater.utils import archive_patch, get_package_hashes
+from pyupdater.utils.exceptions import PatcherError
+from pyupdater.utils.diff_engines import get_engine
 
 TEST_DATA_DIR = os.path.join(os.getcwd(), 'tests', 'test data',
                              'patcher-test-data')
@@ -85,3 +95,270 @@ class TestPatcher(object):
     #     data['update_folder'] = setup
     #     p = Patcher(**data)
     #     assert p.start() is True
+
+
+def make_chain_data(count):
+    # Manifest with versions 0.0.1 through 0.0.count
+    versions = {}
+    for i in range(1, count + 1):
+        version = '0.0.{}.2.0'.format(i)
+        versions[version] = {
+            'mac': {
+                'filename': 'jms-mac-{}.zip'.format(version),
+                'file_hash': 'hash{}'.format(i),
+                'patch_name': 'jms-mac-{}'.format(i),
+                'patch_hash': 'patchhash{}'.format(i),
+                }
+            }
+    data = update_data.copy()
+    data['json_data'] = {'updates': {'jms': versions}}
+    data['highest_version'] = '0.0.{}.2.0'.format(count)
+    data['update_folder'] = os.getcwd()
+    data['progress_hooks'] = []
+    return data
+
+
+def make_chain_patches(count):
+    # Binaries for versions 1 through count & the patches between them
+    binaries = [os.urandom(1024)]
+    for i in range(2, count + 1):
+        binaries.append(binaries[-1][:512] + os.urandom(512))
+    patches = {}
+    for i in range(2, count + 1):
+        patches['jms-mac-{}'.format(i)] = bsdiff4.diff(binaries[i - 2],
+                                                        binaries[i - 1])
+    return binaries, patches
+
+
+def make_archive_chain(count, regular=()):
+    # Archives for versions 1 through count & patches of their
+    # uncompressed data. Patches to versions in regular are made
+    # from the archives instead.
+    data = make_chain_data(count)
+    content = os.urandom(4096)
+    binaries = []
+    for i in range(1, count + 1):
+        content = content[:2048] + os.urandom(64) + content[2048 + 64:]
+        f = io.BytesIO()
+        tar = tarfile.open(fileobj=f, mode='w:gz')
+        tar_info = tarfile.TarInfo('app')
+        tar_info.size = len(content)
+        tar.addfile(tar_info, io.BytesIO(content))
+        tar.close()
+        binaries.append(f.getvalue())
+    patches = {}
+    for i in range(2, count + 1):
+        name = 'jms-mac-{}'.format(i)
+        if i in regular:
+            patches[name] = bsdiff4.diff(binaries[i - 2], binaries[i - 1])
+            continue
+        with open('dst.tar.gz', 'wb') as f:
+            f.write(binaries[i - 1])
+        info = data['json_data']['updates']['jms']['0.0.{}.2.0'.format(i)]
+        info['mac']['patch_archive'] = archive_patch.unpack_file(
+            'dst.tar.gz', 'dst.tar')
+        with open('dst.tar', 'rb') as f:
+            dst = f.read()
+        patches[name] = bsdiff4.diff(archive_patch.unpack(binaries[i - 2]),
+                                     dst)
+    os.remove('dst.tar.gz')
+    os.remove('dst.tar')
+    return data, binaries, patches
+
+
+class FakeDownloader(object):
+    # Returns patches from FakeDownloader.patches. Earlier patches
+    # take longer so they finish out of order.
+    fail = None
+    started = []
+    patches = {}
+
+    def __init__(self, filename, urls, hexdigest=None, verify=True,
+                 **kwargs):
+        self.filename = filename
+        self.cancelled = threading.Event()
+
+    def download_verify_return(self):
+        FakeDownloader.started.append(self.filename)
+        if self.filename == FakeDownloader.fail:
+            return None
+        number = int(self.filename.split('-')[-1])
+        # Waits until cancelled or a short time has passed
+        self.cancelled.wait(0.05 / number)
+        if self.cancelled.is_set():
+            return None
+        return FakeDownloader.patches[self.filename]
+
+    def download_verify_write(self):
+        data = self.download_verify_return()
+        if data is None:
+            return False
+        with open(self.filename, 'wb') as f:
+            f.write(data)
+        return True
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestPatchChain(object):
+
+    @pytest.fixture
+    def fake_downloader(self, monkeypatch):
+        FakeDownloader.fail = None
+        FakeDownloader.started = []
+        monkeypatch.setattr(patcher, 'FileDownloader', FakeDownloader)
+
+    def test_required_patches_in_order(self):
+        p = Patcher(**make_chain_data(12))
+        names = [x['patch_name'] for x in p._get_required_patches('jms')]
+        assert names == ['jms-mac-{}'.format(i) for i in range(2, 13)]
+
+    def test_skip_patches(self):
+        data = make_chain_data(12)
+        latest = data['json_data']['updates']['jms']['0.0.12.2.0']['mac']
+        latest['skip_patches'] = [
+            {'src': '0.0.1.2.0', 'patch_name': 'jms-mac-skip1',
+             'patch_hash': 'skiphash1'},
+            {'src': '0.0.5.2.0', 'patch_name': 'jms-mac-skip5',
+             'patch_hash': 'skiphash5'},
+            ]
+        p = Patcher(**data)
+        names = [x['patch_name'] for x in p._get_required_patches('jms')]
+        assert names == ['jms-mac-skip1']
+
+        data['current_version'] = '0.0.3'
+        p = Patcher(**data)
+        names = [x['patch_name'] for x in p._get_required_patches('jms')]
+        assert names == ['jms-mac-4', 'jms-mac-5', 'jms-mac-skip5']
+
+    def test_missing_patch(self):
+        data = make_chain_data(6)
+        del data['json_data']['updates']['jms']['0.0.4.2.0']['mac'][
+            'patch_name']
+        p = Patcher(**data)
+        assert p._get_required_patches('jms') is None
+        assert p._get_patch_info('jms') is False
+
+    def test_patches_in_order(self, fake_downloader):
+        binaries, FakeDownloader.patches = make_chain_patches(6)
+        data = make_chain_data(6)
+        data['max_concurrent_downloads'] = 4
+        p = Patcher(**data)
+        p.og_binary = binaries[0]
+        assert p._get_patch_info('jms') is True
+        assert p._download_apply_patches() is True
+        assert p.new_binary == binaries[-1]
+        # Only the patched binary is kept
+        assert p.og_binary is None
+
+    def test_cancel_on_failure(self, fake_downloader):
+        FakeDownloader.fail = 'jms-mac-2'
+        data = make_chain_data(10)
+        data['max_concurrent_downloads'] = 2
+        p = Patcher(**data)
+        p.og_binary = b''
+        assert p._get_patch_info('jms') is True
+        start = time.time()
+        assert p._download_apply_patches() is False
+        assert time.time() - start < 0.5
+        # Queued patches never started
+        assert len(FakeDownloader.started) < 9
+
+    def test_low_memory(self, fake_downloader, monkeypatch):
+        def file_patch(*args):
+            raise AssertionError('Patch loaded into memory')
+        # Loads the whole binary into memory
+        monkeypatch.setattr(bsdiff4, 'file_patch', file_patch)
+        binaries, FakeDownloader.patches = make_chain_patches(6)
+        data = make_chain_data(6)
+        data['max_concurrent_downloads'] = 4
+        data['low_memory'] = True
+        data['current_filename'] = 'jms-mac-0.0.1.zip'
+        with open(data['current_filename'], 'wb') as f:
+            f.write(binaries[0])
+        p = Patcher(**data)
+        assert p._get_patch_info('jms') is True
+        assert p._download_apply_patches() is True
+        assert p.new_binary is None
+        with open(p.new_filename, 'rb') as f:
+            assert f.read() == binaries[-1]
+        # Installed binary is kept. Patches & intermediates are not
+        assert sorted(os.listdir(os.getcwd())) == \
+            sorted([data['current_filename'], p.new_filename])
+
+    def test_mixed_engines(self, fake_downloader):
+        binaries, FakeDownloader.patches = make_chain_patches(6)
+        data = make_chain_data(6)
+        engine = get_engine('blockdelta')
+        # Every other patch made by blockdelta
+        for i in range(3, 7, 2):
+            with open('src', 'wb') as f:
+                f.write(binaries[i - 2])
+            with open('dst', 'wb') as f:
+                f.write(binaries[i - 1])
+            engine.file_diff('src', 'dst', 'patch')
+            with open('patch', 'rb') as f:
+                FakeDownloader.patches['jms-mac-{}'.format(i)] = f.read()
+            info = data['json_data']['updates']['jms'][
+                '0.0.{}.2.0'.format(i)]['mac']
+            info['patch_engine'] = 'blockdelta'
+        p = Patcher(**data)
+        p.og_binary = binaries[0]
+        assert p._get_patch_info('jms') is True
+        assert [x['patch_engine'] for x in p.patch_data] == \
+            ['bsdiff4', 'blockdelta', 'bsdiff4', 'blockdelta', 'bsdiff4']
+        assert p._download_apply_patches() is True
+        assert p.new_binary == binaries[-1]
+
+    def test_unknown_engine(self):
+        data = make_chain_data(6)
+        info = data['json_data']['updates']['jms']['0.0.4.2.0']['mac']
+        info['patch_engine'] = 'from-the-future'
+        p = Patcher(**data)
+        # Full update is used instead
+        assert p._get_patch_info('jms') is False
+
+    def test_archive_patches(self, fake_downloader):
+        data, binaries, FakeDownloader.patches = make_archive_chain(
+            6, regular=(4,))
+        p = Patcher(**data)
+        p.og_binary = binaries[0]
+        assert p._get_patch_info('jms') is True
+        assert p._download_apply_patches() is True
+        assert p.new_binary == binaries[-1]
+
+    def test_archive_patches_low_memory(self, fake_downloader):
+        data, binaries, FakeDownloader.patches = make_archive_chain(
+            6, regular=(3, 6))
+        data['low_memory'] = True
+        data['current_filename'] = 'jms-mac-0.0.1.tar.gz'
+        with open(data['current_filename'], 'wb') as f:
+            f.write(binaries[0])
+        p = Patcher(**data)
+        assert p._get_patch_info('jms') is True
+        assert p._download_apply_patches() is True
+        with open(p.new_filename, 'rb') as f:
+            assert f.read() == binaries[-1]
+        assert sorted(os.listdir(os.getcwd())) == \
+            sorted([data['current_filename'], p.new_filename])
+
+    def test_stale_hash_cache(self, monkeypatch):
+        data = make_chain_data(2)
+        filename = 'jms-mac-0.0.2.2.0.zip'
+        with open(filename, 'wb') as f:
+            f.write(b'good')
+        info = data['json_data']['updates']['jms']['0.0.2.2.0']['mac']
+        info['file_hash'] = get_package_hashes(filename)
+        # Rewritten file looks unchanged to the hash cache
+        monkeypatch.setattr(HashCache, '_get_stat',
+                            staticmethod(lambda path: [4, 0, 0]))
+        data['hash_cache'] = HashCache(os.getcwd())
+        data['hash_cache'].add(filename, info['file_hash'])
+        p = Patcher(**data)
+        p.name = 'jms'
+        p.new_binary = b'bad!'
+        with pytest.raises(PatcherError):
+            p._write_update_to_disk()
+        assert not os.path.exists(filename)
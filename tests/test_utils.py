@@ -16,13 +16,19 @@
 from __future__ import unicode_literals
 
 import os
+import struct
 
+import bsdiff4
 from jms_utils.paths import ChDir
 import pytest
 
-from pyupdater.utils import (check_repo,
+from pyupdater.utils import (_add_bytes,
+                             _decode_control,
+                             bsdiff4_py,
+                             check_repo,
                              convert_to_list,
                              EasyAccessDict,
+                             get_file_hashes,
                              get_hash,
                              get_mac_dot_app_dir,
                              get_package_hashes,
@@ -64,6 +70,23 @@ class TestUtils(object):
                   '6d5ac1468ca4d3635c4aa9b')
         assert digest == get_package_hashes('hash-test.txt')
 
+    def test_file_hashes(self, hasher):
+        digest = ('cb44ec613a594f3b20e46b768c5ee780e0a9b66ac'
+                  '6d5ac1468ca4d3635c4aa9b')
+        for use_mmap in [False, True]:
+            hashes = get_file_hashes('hash-test.txt', ['sha256', 'md5'],
+                                     use_mmap=use_mmap)
+            assert hashes['sha256'] == digest
+            assert hashes['md5'] == '8148a1b8face4f1cf5930a836c97727a'
+
+    def test_file_hashes_empty(self):
+        with open('empty.txt', 'wb'):
+            pass
+        digest = ('e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca'
+                  '495991b7852b855')
+        assert get_file_hashes('empty.txt', use_mmap=True) == \
+            {'sha256': digest}
+
     def test_get_hash(self):
         digest = ('380fd2bf3d78bb411e4c1801ce3ce7804bf5a22d79'
                   '405d950e5d5c8f3169fca0')
@@ -196,3 +219,63 @@ class TestUtils(object):
         info['package'] = None
         p = Patch(info)
         assert p.ready is False
+
+
+class TestBsdiff4Py(object):
+
+    def test_add_bytes(self):
+        diff = b'\xff\x80\x7f\x01\x00'
+        orig = b'\x01\x80\x01\xff\x00'
+        assert _add_bytes(diff, orig) == b'\x00\x00\x80\x00\x00'
+
+    def test_add_bytes_large(self):
+        diff = bytearray(os.urandom(1024 * 300))
+        orig = bytearray(os.urandom(1024 * 300))
+        expected = bytearray((a + b) % 256 for a, b in zip(diff, orig))
+        assert _add_bytes(bytes(diff), bytes(orig)) == bytes(expected)
+
+    def test_decode_control(self):
+        data = struct.pack(str('<6Q'), 5, (1 << 63) | 3, 0, 1, 2, 1 << 63)
+        assert _decode_control(data) == [(5, -3, 0), (1, 2, 0)]
+
+    def test_patch(self):
+        src = os.urandom(1024 * 64)
+        dst = bytearray(src)
+        for i in range(0, len(dst), 100):
+            dst[i] = (dst[i] + 200) % 256
+        dst = bytes(dst[:30000] + os.urandom(5000) + dst[30000:])
+        patch = bsdiff4.diff(src, dst)
+        assert bsdiff4_py.patch(src, patch) == dst
+
+
+@pytest.mark.usefixtures('cleandir')
+class TestBsdiff4PyFile(object):
+
+    def test_file_patch(self, monkeypatch):
+        # Small blocks so every control tuple is split up
+        monkeypatch.setattr(bsdiff4_py, 'block_size', 1000)
+        src = os.urandom(1024 * 64)
+        dst = bytearray(src)
+        for i in range(0, len(dst), 100):
+            dst[i] = (dst[i] + 200) % 256
+        dst = bytes(dst[:30000] + os.urandom(5000) + dst[30000:])
+        with open('src', 'wb') as f:
+            f.write(src)
+        with open('dst', 'wb') as f:
+            f.write(dst)
+        bsdiff4.file_diff('src', 'dst', 'patch')
+        bsdiff4_py.file_patch('src', 'new', 'patch')
+        with open('new', 'rb') as f:
+            assert f.read() == dst
+
+    def test_file_patch_bad_src(self):
+        src = os.urandom(1024 * 64)
+        with open('src', 'wb') as f:
+            f.write(src)
+        with open('dst', 'wb') as f:
+            f.write(src + os.urandom(100))
+        bsdiff4.file_diff('src', 'dst', 'patch')
+        with open('src', 'wb') as f:
+            f.write(os.urandom(100))
+        with pytest.raises(ValueError):
+            bsdiff4_py.file_patch('src', 'new', 'patch')